@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# coding=utf-8
+
+"""
+Reports missing indexes and slow queries per tenant.
+"""
+
+import pprint
+import pymongo
+import sys
+
+import ConfigParser
+
+from urlparse import urlparse
+
+from suricate.data import indexes
+
+__author__ = 'tmetsch'
+
+config = ConfigParser.RawConfigParser()
+config.read('app.conf')
+# MongoDB connection
+mongo = config.get('mongo', 'uri')
+adm = config.get('mongo', 'admin')
+pwd = config.get('mongo', 'pwd')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise AttributeError('please provide one or more tenant ids to '
+                             'audit as arguments!')
+
+    tmp = urlparse(mongo)
+    uri = 'mongodb://' + adm + ':' + pwd + '@' + tmp.hostname + ':' + \
+          str(tmp.port) + '/admin'
+    client = pymongo.MongoClient(uri)
+
+    for user in sys.argv[1:]:
+        print 'Tenant:', user
+        pprint.pprint(indexes.audit(client[user]))
+    client.disconnect()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# coding=utf-8
+
+"""
+Runs the daemon triggering the scheduled notebooks of a tenant.
+
+Like for the ingest daemon the token of the tenant is read from the
+SURICATE_TOKEN environment variable.
+"""
+
+import os
+import sys
+
+import ConfigParser
+
+from suricate.analytics import cron
+
+__author__ = 'tmetsch'
+
+config = ConfigParser.RawConfigParser()
+config.read('app.conf')
+# MongoDB connection
+mongo = config.get('mongo', 'uri')
+# Rabbit part
+broker = config.get('rabbit', 'uri')
+# seconds between checks for due schedules.
+tick = 1.0
+if config.has_option('cron', 'tick'):
+    tick = config.getfloat('cron', 'tick')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise AttributeError('please provide a tenant id as argument!')
+    if 'SURICATE_TOKEN' not in os.environ:
+        raise AttributeError('please provide the token of the tenant in the '
+                             'SURICATE_TOKEN environment variable!')
+
+    user = sys.argv[1]
+    token = os.environ['SURICATE_TOKEN']
+    cron.CronDaemon(mongo, broker, user, token, tick=tick).run()
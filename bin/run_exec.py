@@ -22,6 +22,16 @@ mongo = config.get('mongo', 'uri')
 broker = config.get('rabbit', 'uri')
 # SDK
 sdk = config.get('suricate', 'python_sdk')
+# Resource limits per run & quotas per project
+limits = {}
+quotas = {}
+if config.has_section('limits'):
+    for key in ['cpu', 'memory', 'wall', 'output']:
+        if config.has_option('limits', key):
+            limits[key] = config.getint('limits', key)
+    for key in ['cpu', 'wall']:
+        if config.has_option('limits', 'project_' + key):
+            quotas[key] = config.getfloat('limits', 'project_' + key)
 
 
 if __name__ == '__main__':
@@ -30,4 +40,5 @@ if __name__ == '__main__':
                              'node as first argument!')
 
     user = sys.argv[1]
-    exec_node.ExecNode(mongo, broker, sdk, user)
+    exec_node.ExecNode(mongo, broker, sdk, user, limits=limits,
+                       quotas=quotas)
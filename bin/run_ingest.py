@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# coding=utf-8
+
+"""
+Runs an ingest daemon for the streams of a tenant.
+
+The token of the tenant is read from the SURICATE_TOKEN environment variable
+so it does not show up in the process list.
+"""
+
+import os
+import sys
+
+import ConfigParser
+
+from suricate.data import ingest
+
+__author__ = 'tmetsch'
+
+config = ConfigParser.RawConfigParser()
+config.read('app.conf')
+# MongoDB connection
+mongo = config.get('mongo', 'uri')
+# Rabbit broker of the execution nodes - for the triggers of the streams.
+broker = config.get('rabbit', 'uri')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise AttributeError('please provide a tenant id as first argument - '
+                             'optionally followed by the shard number and '
+                             'number of shards!')
+    if 'SURICATE_TOKEN' not in os.environ:
+        raise AttributeError('please provide the token of the tenant in the '
+                             'SURICATE_TOKEN environment variable!')
+
+    user = sys.argv[1]
+    token = os.environ['SURICATE_TOKEN']
+    shard = 0
+    shards = 1
+    if len(sys.argv) > 3:
+        shard = int(sys.argv[2])
+        shards = int(sys.argv[3])
+    daemon = ingest.IngestDaemon(mongo, user, token, shard, shards,
+                                 amqp_uri=broker)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.service.stop()
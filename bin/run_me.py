@@ -9,14 +9,18 @@ Runs the analytics service in a development environment.
 __author__ = 'tmetsch'
 
 import bottle
+import os
 import pymongo
 import subprocess
 import sys
 
 import ConfigParser
+import SocketServer
 
 from urlparse import urlparse
+from wsgiref import simple_server
 
+from suricate.data import indexes
 from suricate.ui import ui_app
 
 config = ConfigParser.RawConfigParser()
@@ -27,6 +31,12 @@ adm = config.get('mongo', 'admin')
 pwd = config.get('mongo', 'pwd')
 # Rabbit broker
 broker = config.get('rabbit', 'uri')
+# Resource limits per run - the UI waits for runs up to the wall clock limit.
+limits = {}
+if config.has_section('limits'):
+    for key in ['cpu', 'memory', 'wall', 'output']:
+        if config.has_option('limits', key):
+            limits[key] = config.getint('limits', key)
 
 # dict with <username>:(<token>,<db_exists>)
 USERS = {'foo': ('bar', False)}
@@ -54,6 +64,8 @@ def check_database(user_id):
         USERS[user_id] = (USERS[user_id][0], True)
     else:
         USERS[user_id] = (USERS[user_id][0], True)
+    # make sure the queries on tags, names & streams are indexed.
+    indexes.ensure_indexes(client[user_id])
     client.disconnect()
 
 
@@ -86,19 +98,42 @@ class SessionMiddleWare(object):
             environ['HTTP_X_TOKEN'] = USERS[user_id][0]
             return self.wrap_app(environ, start_response)
 
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    """
+    WSGI server handling each request in its own thread - the run pages keep
+    their (server-sent events) request open while a notebook runs, which
+    would block all other requests on the single threaded default server.
+    """
+
+    daemon_threads = True
+
+
 if __name__ == '__main__':
-    # start execution node for each user.
+    # start execution node, ingest & cron daemon for each user.
     processes = []
     for user in USERS.keys():
         p = subprocess.Popen([sys.executable, 'run_exec.py', user])
         processes.append(p)
+        check_database(user)
+        # tokens are handed over in the environment - not visible in ps.
+        env = dict(os.environ, SURICATE_TOKEN=USERS[user][0])
+        p = subprocess.Popen([sys.executable, 'run_ingest.py', user],
+                             env=env)
+        processes.append(p)
+        p = subprocess.Popen([sys.executable, 'run_cron.py', user],
+                             env=env)
+        processes.append(p)
 
     # launch web app
-    app = ui_app.AnalyticsApp(mongo, broker).get_wsgi_app()
+    app = ui_app.AnalyticsApp(mongo, broker, limits=limits).get_wsgi_app()
     app = SessionMiddleWare(app)
 
     bottle.TEMPLATE_PATH.insert(0, '../suricate/ui/views')
-    bottle.run(app=app, host='localhost')
+    # for production use a threaded or async server (e.g. paste, cheroot or
+    # gevent) - bottle.run(app=app, server='paste').
+    bottle.run(app=app, host='localhost', server_class=ThreadingWSGIServer)
 
     # let's cleanup shall we?
     for process in processes:
@@ -8,10 +8,14 @@ __author__ = 'tmetsch'
 
 # basic imports
 import base64
+import csv
 import json
 import os
+import time
 import urllib
+import uuid
 
+from bson import Binary
 from StringIO import StringIO
 
 # graphing imports
@@ -24,6 +28,8 @@ except UserWarning:
 import mpld3
 
 # internal imports
+from suricate.data import aggregates
+from suricate.data import columnar
 from suricate.data import object_store
 from suricate.data import streaming
 
@@ -32,19 +38,16 @@ import numpy as np
 import pandas as pd
 
 # Storage access.
-obj_str = object_store.MongoStore(OBJECT_STORE_URI)
+obj_str = object_store.get_object_stor(OBJECT_STORE_URI, cached=True)
 stm_str = streaming.StreamClient(OBJECT_STORE_URI)
 
-# setup figure
+# figure setup
 params = {'legend.fontsize': 9.0,
           'legend.linewidth': 0.5,
           'font.size': 9.0,
           'axes.linewidth': 0.5,
           'lines.linewidth': 0.5,
           'grid.linewidth':   0.5}
-fig = plt.figure(1, figsize=(6, 4))
-plt.rcParams.update(params)
-plt.clf()
 
 # To hide some stuff from the user.
 os.environ = {}
@@ -53,6 +56,21 @@ os.environ = {}
 D3_URL = 'https://cdnjs.cloudflare.com/ajax/libs/d3/3.4.8/d3.min.js'
 
 
+def reset():
+    """
+    Reset the figure - called before each run by warm interpreters which do
+    not re-run this preload.
+    """
+    global fig
+    plt.close('all')
+    fig = plt.figure(1, figsize=(6, 4))
+    plt.rcParams.update(params)
+    plt.clf()
+
+
+reset()
+
+
 def show():
     """
     Show a matplotlib fig and stores it to be displayed as inline image.
@@ -97,43 +115,80 @@ def list_objects(tag='', with_meta=False):
         query = {'meta.tags':  tag}
     else:
         query = {}
-    ids = obj_str.list_objects(str(UID), str(TOKEN), query=query)
     if with_meta:
+        ids = obj_str.iter_objects(str(UID), str(TOKEN), query=query)
         res = [item for item in ids]
     else:
+        ids = obj_str.iter_objects(str(UID), str(TOKEN), query=query,
+                                   fields=[])
         res = [item[0] for item in ids]
     return res
 
 
 def create_object(data):
     """
-    Create a new obj.
+    Create a new obj. Dicts of numeric arrays/lists and numeric DataFrames
+    are stored in a binary columnar format - everything else as JSON.
 
     :param data: Content to be stored.
     """
+    if columnar.is_columnar(data):
+        buf, columns = columnar.encode(data)
+        meta = {'name': str(uuid.uuid4()),
+                'mime-type': columnar.MIME_TYPE,
+                'tags': [],
+                'columns': [{'name': col['name'],
+                             'dtype': col['dtype'],
+                             'shape': col['shape']} for col in columns]}
+        return obj_str.create_object(str(UID), str(TOKEN), Binary(buf),
+                                     meta=meta)
     return obj_str.create_object(str(UID), str(TOKEN), json.dumps(data))
 
 
-def retrieve_object(iden):
+def retrieve_object(iden, offset=None, length=None, as_frame=None):
     """
-    Retrieve an previously store data obj.
+    Retrieve an previously store data obj. If an offset or length is given
+    only that range of the raw content is read. Columnar objects are
+    returned as dict of (read-only) numpy arrays or as DataFrame.
 
     :param iden: Identifier of the object.
+    :param offset: Optional position to start reading from.
+    :param length: Optional number of bytes to read.
+    :param as_frame: Return columnar objects as pandas DataFrame.
     """
+    if offset is not None or length is not None:
+        return obj_str.read_object(str(UID), str(TOKEN), iden, offset or 0,
+                                   length)
     tmp = obj_str.retrieve_object(str(UID), str(TOKEN), iden)
-    if isinstance(tmp['value'], unicode):
+    mime = tmp['meta'].get('mime-type')
+    if columnar.is_encoded(tmp['value']):
+        return columnar.decode(tmp['value'], as_frame=as_frame)
+    elif isinstance(tmp['value'], unicode):
         return json.loads(tmp['value'])
+    elif isinstance(tmp['value'], str) and mime == 'application/json':
+        return json.loads(tmp['value'].decode('utf-8-sig'))
+    elif isinstance(tmp['value'], str) and mime == 'text/csv':
+        return [row for row in csv.DictReader(StringIO(tmp['value']))]
     return tmp['value']
 
 
 def update_object(iden, data):
     """
-    update an previously sotred data obj.
+    update an previously sotred data obj. The mime-type & columns of the
+    meta data are updated along with the content.
 
     :param iden: Identifier of the object.
     :param data: new contents.
     """
-    obj_str.update_object(str(UID), str(TOKEN), iden, data)
+    meta = {'mime-type': 'N/A', 'columns': None}
+    if columnar.is_columnar(data):
+        buf, columns = columnar.encode(data)
+        data = Binary(buf)
+        meta = {'mime-type': columnar.MIME_TYPE,
+                'columns': [{'name': col['name'],
+                             'dtype': col['dtype'],
+                             'shape': col['shape']} for col in columns]}
+    obj_str.update_object(str(UID), str(TOKEN), iden, data, meta=meta)
 
 
 def list_streams(tag=''):
@@ -150,14 +205,128 @@ def list_streams(tag=''):
     return ids
 
 
-def retrieve_from_stream(iden, interval=60):
+def retrieve_from_stream(iden, interval=60, resolution=None, limit=None,
+                         latest_first=False, query=None):
     """
     Return messages from a stream.
 
     :param iden: Identifier of the stream.
     :param interval: defaults to messages of last 60 seconds.
+    :param resolution: Return the rollups (count, min, max, mean) of the
+        numeric messages per 1 or 60 seconds instead of the messages.
+    :param limit: Maximum number of messages.
+    :param latest_first: Return the latest messages first.
+    :param query: Filter on the body (e.g. {'body.host': 'server1'}).
+    """
+    order = -1 if latest_first else 1
+    return list(stm_str.get_messages(str(UID), str(TOKEN), interval, iden,
+                                     resolution=resolution, limit=limit,
+                                     order=order, query=query))
+
+
+def latest(iden, n=1):
+    """
+    Return the latest messages of a stream - latest first. Up to the last
+    20 messages are served without querying the messages.
+
+    :param iden: Identifier of the stream.
+    :param n: Number of messages.
+    """
+    return stm_str.latest(str(UID), str(TOKEN), iden, n)
+
+
+def count_stream(iden, interval=60, query=None):
+    """
+    Return the number of messages a stream received.
+
+    :param iden: Identifier of the stream.
+    :param interval: defaults to messages of last 60 seconds.
+    :param query: Filter on the body (e.g. {'body.host': 'server1'}).
+    """
+    return stm_str.get_messages(str(UID), str(TOKEN), interval, iden,
+                                query=query, count_only=True)
+
+
+def tail_stream(iden, since=None, timeout=None, batch_size=100,
+                batched=False):
+    """
+    Iterate over new messages of a stream as they arrive. Each message has
+    its body and time - pass the last time as since to resume.
+
+    :param iden: Identifier of the stream.
+    :param since: Only messages after this time - defaults to now.
+    :param timeout: Stop after this many seconds without new messages -
+        defaults to wait forever.
+    :param batch_size: Maximum number of messages fetched at once.
+    :param batched: Yield lists of messages instead of single ones.
+    """
+    for batch in stm_str.tail(str(UID), str(TOKEN), iden, since=since,
+                              batch_size=batch_size, timeout=timeout):
+        if batched:
+            yield batch
+        else:
+            for msg in batch:
+                yield msg
+
+
+def stream_window(iden, name, size=60, kind='sliding',
+                  quantiles=(0.5, 0.9, 0.99)):
+    """
+    Return a window of incremental aggregates (count, sum, mean, variance,
+    min, max & quantiles) over a stream. Windows are persisted under their
+    name - use update_window to bring them up to date.
+
+    :param iden: Identifier of the stream.
+    :param name: Name of the window.
+    :param size: Size of the window in seconds.
+    :param kind: sliding or tumbling.
+    :param quantiles: The quantiles to estimate.
+    """
+    window = stm_str.load_window(str(UID), str(TOKEN), iden, name)
+    if window is None:
+        window = aggregates.create(kind, size, quantiles)
+    return window
+
+
+def update_window(iden, name, size=60, kind='sliding',
+                  quantiles=(0.5, 0.9, 0.99)):
+    """
+    Feed the messages received after the last one consumed into a window,
+    persist it and return its aggregates. Non-numeric messages are skipped.
+
+    :param iden: Identifier of the stream.
+    :param name: Name of the window.
+    :param size: Size of the window in seconds.
+    :param kind: sliding or tumbling.
+    :param quantiles: The quantiles to estimate.
+    """
+    window = stream_window(iden, name, size, kind, quantiles)
+    # resume after the last message consumed - not the time of the last
+    # update, as messages are stored a little after they were received.
+    since = window.consumed
+    if since is None:
+        since = time.time() - window.size
+    for batch in stm_str.tail(str(UID), str(TOKEN), iden, since=since,
+                              timeout=0):
+        for msg in batch:
+            try:
+                window.add(msg['time'], float(msg['body']))
+            except (TypeError, ValueError):
+                window.consumed = msg['time']
+    window.advance(time.time())
+    stm_str.save_window(str(UID), str(TOKEN), iden, name, window)
+    return window.result()
+
+
+def save_window(iden, name, window):
+    """
+    Persist a window - e.g. after feeding it from tail_stream.
+
+    :param iden: Identifier of the stream.
+    :param name: Name of the window.
+    :param window: The window.
     """
-    return stm_str.get_messages(str(UID), str(TOKEN), interval, iden)
+    stm_str.save_window(str(UID), str(TOKEN), iden, name, window)
 
 
 def run_analytics(iden):
@@ -18,4 +18,4 @@ setup(name='suricate',
       packages=['suricate', 'suricate.ui',
                 'suricate.data', 'suricate.analytics'],
       # for prod also requires whatever you put in sdk.
-      requires=['bottle', 'pymongo', 'matplotlib', 'pika', 'mox'])
+      requires=['bottle', 'pymongo', 'matplotlib', 'numpy', 'pika', 'mox'])
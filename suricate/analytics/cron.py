@@ -0,0 +1,256 @@
+# coding=utf-8
+
+"""
+Scheduled notebooks - runs notebooks as jobs on cron expressions or fixed
+intervals.
+"""
+
+__author__ = 'tmetsch'
+
+import calendar
+import datetime
+import time
+
+from pymongo import errors
+
+from suricate import rpc
+from suricate.analytics import proj_ntb_store
+
+# (min, max) of the minute, hour, day of month, month & day of week fields.
+FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+# what to do with occurrences missed by more than GRACE seconds: run once
+# for all of them (coalesce) or skip them.
+MISFIRE = ('coalesce', 'skip')
+GRACE = 30
+# errors after which the daemon backs off instead of failing the schedule.
+TRANSIENT = (errors.PyMongoError, rpc.RPCTimeout)
+
+
+class CronExpression(object):
+    """
+    A cron expression: minute hour day-of-month month day-of-week. Fields
+    can hold *, lists (1,2), ranges (1-5) and steps (*/15). Times are UTC.
+    """
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise AttributeError('Cron expressions need 5 fields: ' + expr)
+        self.expr = expr
+        self.fields = [_parse_field(part, low, high)
+                       for part, (low, high) in zip(parts, FIELDS)]
+        # day of month & week are OR'ed if both are restricted.
+        self.any_dom = parts[2] == '*'
+        self.any_dow = parts[4] == '*'
+
+    def _day_matches(self, when):
+        dom = when.day in self.fields[2]
+        dow = (when.weekday() + 1) % 7 in self.fields[4]
+        if self.any_dom or self.any_dow:
+            return dom and dow
+        return dom or dow
+
+    def next_time(self, after):
+        """
+        Return the next time matching the expression.
+
+        :param after: Time (seconds since epoch) after which to search.
+        :return: Seconds since epoch.
+        """
+        minutes, hours, _, months, _ = self.fields
+        when = datetime.datetime.utcfromtimestamp(int(after))
+        when = when.replace(second=0) + datetime.timedelta(minutes=1)
+        limit = when + datetime.timedelta(days=5 * 366)
+        while when < limit:
+            if when.month not in months:
+                year = when.year + when.month // 12
+                when = datetime.datetime(year, when.month % 12 + 1, 1)
+            elif not self._day_matches(when):
+                when = datetime.datetime(when.year, when.month, when.day) + \
+                    datetime.timedelta(days=1)
+            elif when.hour not in hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(when.timetuple())
+        raise AttributeError('Cron expression never matches: ' + self.expr)
+
+
+def _parse_field(text, low, high):
+    """
+    Parse a field of a cron expression.
+
+    :return: Set of the matching values.
+    """
+    res = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(item) for item in part.split('-', 1)]
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if high == 6 and end == 7:
+            # Sunday can be 0 or 7.
+            res.add(0)
+            if start == 7:
+                continue
+            end = 6
+        if start < low or end > high or start > end or step < 1:
+            raise AttributeError('Invalid cron field: ' + text)
+        res.update(range(start, end + 1, step))
+    return res
+
+
+def next_run(schedule, now):
+    """
+    Return the next time a schedule is due after now - missed occurrences
+    are coalesced.
+
+    :param schedule: The schedule (with a cron expression or an interval).
+    :param now: The current time.
+    """
+    if schedule.get('cron'):
+        return CronExpression(schedule['cron']).next_time(now)
+    interval = schedule['interval']
+    last = schedule.get('next_run') or now
+    if last > now:
+        return last
+    # stay in phase with the previous occurrences.
+    return last + (int((now - last) // interval) + 1) * interval
+
+
+def validate(cron=None, interval=None, misfire='coalesce'):
+    """
+    Check the timing of a schedule.
+
+    :param cron: A cron expression.
+    :param interval: Or an interval in seconds.
+    :param misfire: coalesce or skip.
+    """
+    if (cron is None) == (interval is None):
+        raise AttributeError('Provide either a cron expression or an '
+                             'interval.')
+    if cron is not None:
+        CronExpression(cron)
+    elif interval <= 0:
+        raise AttributeError('Interval needs to be positive.')
+    if misfire not in MISFIRE:
+        raise AttributeError('Misfire policy needs to be one of: ' +
+                             ', '.join(MISFIRE))
+
+
+class CronDaemon(object):
+    """
+    Triggers the due schedules of a tenant by submitting jobs to the
+    tenant's execution node. Jobs of a schedule never overlap - if the
+    previous job is still queued or running the occurrence is skipped.
+    Jobs of a project share its warm interpreter so frequent schedules are
+    cheap.
+    """
+
+    def __init__(self, mongo_uri, amqp_uri, uid, token, tick=1.0,
+                 max_backoff=60.0):
+        self.uid = uid
+        self.token = token
+        self.tick = tick
+        self.max_backoff = max_backoff
+        self.schedules = proj_ntb_store.ScheduleStore(mongo_uri)
+        self.jobs = proj_ntb_store.JobStore(mongo_uri)
+        self.stor = proj_ntb_store.NotebookStore(mongo_uri, uid)
+        self.rpc = rpc.RPCClient(amqp_uri)
+        self.running = True
+
+    def check(self, now):
+        """
+        Trigger all schedules which are due. Broken schedules are disabled
+        so they can't stop the others.
+
+        :param now: The current time.
+        """
+        for schedule in self.schedules.due(self.uid, self.token, now):
+            try:
+                self.trigger(schedule, now)
+            except TRANSIENT:
+                raise
+            except Exception as err:
+                self.schedules.update_schedule(schedule['_id'], self.uid,
+                                               self.token, enabled=False,
+                                               last_error=str(err))
+
+    def trigger(self, schedule, now):
+        """
+        Submit a job for a due schedule - unless it is late & should be
+        skipped or its previous job did not finish yet. If the job can't be
+        submitted (e.g. the project is over its quota) the error is
+        recorded & the occurrence skipped.
+
+        :param schedule: The schedule.
+        :param now: The current time.
+        """
+        iden = schedule['_id']
+        update = {'next_run': next_run(schedule, now)}
+        late = now - schedule['next_run'] > GRACE
+        if late and schedule.get('misfire') == 'skip':
+            self.schedules.update_schedule(iden, self.uid, self.token,
+                                           inc='skipped', **update)
+            return
+        last_job = schedule.get('last_job')
+        if last_job is not None:
+            job = self.jobs.retrieve_job(last_job, self.uid, self.token)
+            if job is not None and job['state'] in ('queued', 'running'):
+                self.schedules.update_schedule(iden, self.uid, self.token,
+                                               inc='skipped', **update)
+                return
+        try:
+            ntb = self.stor.retrieve_notebook(schedule['project'],
+                                              schedule['ntb_id'], self.uid,
+                                              self.token)
+            job_id = self.rpc.call(self.uid,
+                                   {'uid': self.uid,
+                                    'token': self.token,
+                                    'project_id': schedule['project'],
+                                    'notebook_id': schedule['ntb_id'],
+                                    'src': ntb['src'],
+                                    'priority': schedule.get('priority', 0),
+                                    'schedule': iden,
+                                    'call': 'run_job'})['job_id']
+        except TRANSIENT:
+            raise
+        except Exception as err:
+            self.schedules.update_schedule(iden, self.uid, self.token,
+                                           inc='failed', last_error=str(err),
+                                           **update)
+            return
+        self.schedules.update_schedule(iden, self.uid, self.token,
+                                       inc='runs', last_run=now,
+                                       last_job=job_id, last_error=None,
+                                       **update)
+
+    def run(self):
+        """
+        Check the schedules every tick until stopped. If the database
+        cannot be reached the daemon backs off exponentially.
+        """
+        self.rpc.start()
+        backoff = self.tick
+        while self.running:
+            try:
+                self.check(time.time())
+                backoff = self.tick
+            except TRANSIENT:
+                backoff = min(backoff * 2, self.max_backoff)
+            time.sleep(backoff)
+
+    def stop(self):
+        """
+        Stop the daemon.
+        """
+        self.running = False
@@ -4,14 +4,32 @@ Execution node - listens to messages and executes notebooks etc.
 """
 
 import json
-import thread
 import pika
-import uuid
+import Queue
+import threading
 
 from time import time
 
+from suricate.analytics import cron
 from suricate.analytics import wrapper
 from suricate.analytics import proj_ntb_store
+from suricate.analytics import scheduler
+
+# calls which need the interpreter of a project - all others only touch the
+# store and are served right away.
+INTERPRETER_CALLS = ('run_notebook', 'interact')
+# calls which queue work for the interpreter of a project & return.
+SUBMIT_CALLS = ('run_job', 'submit_run', 'trigger_run')
+# unacknowledged messages - interpreter calls are acked once done.
+PREFETCH = 32
+# seconds to wait for AMQP events before sending the pending replies.
+TICK = 0.05
+# per project quotas: CPU & wall clock seconds consumed by the runs of a
+# project since the node started - None means unlimited.
+QUOTAS = {'cpu': None,
+          'wall': None}
+# interactive calls are served before jobs (default priority 0).
+INTERACTIVE_PRIORITY = 10
 
 
 class ExecNode(object):
@@ -19,25 +37,50 @@ class ExecNode(object):
     Implementation of an execution node - run per tenant.
     """
 
-    wrappers = {}
-    jobs = {}
-
-    def __init__(self, mongo_uri, amqp_uri, sdk, uid):
+    def __init__(self, mongo_uri, amqp_uri, sdk, uid, workers=4,
+                 limits=None, quotas=None):
         self.uid = uid
         self.uri = mongo_uri
         # store
         self.stor = proj_ntb_store.NotebookStore(self.uri, self.uid)
+        self.jobs = proj_ntb_store.JobStore(self.uri)
+        self.schedules = proj_ntb_store.ScheduleStore(self.uri)
+        # jobs of a previous run of the node are recovered on first use.
+        self.recovered = False
 
-        # sdk
+        # sdk - preloaded by a pool of warm interpreter processes; forked
+        # before any threads are started.
         self.sdk = sdk
+        self.pool = wrapper.InterpreterPool(self.uri, self.sdk, limits=limits)
+        # interpreter per project - the pool stops the worker processes of
+        # idle ones, they get a fresh worker on their next call.
+        self.wrappers = {}
+        self.quotas = dict(QUOTAS, **(quotas or {}))
+        self.usage = {}
+
+        # interpreter calls run on a pool - one lane per project.
+        self.lock = threading.Lock()
+        self.scheduler = scheduler.Scheduler(workers)
+        self.replies = Queue.Queue()
 
         # connect to AMQP broker
-        connection = pika.BlockingConnection(pika.URLParameters(amqp_uri))
-        self.channel = connection.channel()
+        self.connection = pika.BlockingConnection(
+            pika.URLParameters(amqp_uri))
+        self.channel = self.connection.channel()
         self.channel.queue_declare(queue=uid)
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=PREFETCH)
         self.channel.basic_consume(self.callback, queue=uid)
-        self.channel.start_consuming()
+        self.serve()
+
+    def serve(self):
+        """
+        Consume requests & send the replies of finished calls - pika is not
+        thread safe so only this thread talks to the broker.
+        """
+        while True:
+            self.connection.process_data_events(time_limit=TICK)
+            self.send_replies()
+            self.pool.reap()
 
     def callback(self, channel, method, props, body):
         """
@@ -49,15 +92,50 @@ class ExecNode(object):
         :param body: The message body.
         """
         tmp = json.loads(body)
-        response = self._handle(tmp)
+        call = tmp.get('call')
+        if call in INTERPRETER_CALLS:
+            def done(response, err):
+                """
+                Queue the reply - it is sent by the connection thread.
+                """
+                self.replies.put((method.delivery_tag, props,
+                                  _response(response, err)))
+            self.scheduler.submit(tmp.get('project_id'), call, self._handle,
+                                  (tmp,), done, INTERACTIVE_PRIORITY)
+        else:
+            start = time()
+            response = err = None
+            try:
+                response = self._handle(tmp)
+            except Exception as error:
+                err = error
+            self.scheduler.record(call, 0.0, time() - start)
+            self._reply(channel, method.delivery_tag, props,
+                        _response(response, err))
 
-        # set uuid so the right requester get the answer:-)
-        prop = pika.BasicProperties(correlation_id=props.correlation_id)
-        channel.basic_publish(exchange='',
-                              routing_key=props.reply_to,
-                              properties=prop,
-                              body=json.dumps(response))
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+    def send_replies(self):
+        """
+        Send the replies of the calls finished by the workers.
+        """
+        while True:
+            try:
+                tag, props, response = self.replies.get_nowait()
+            except Queue.Empty:
+                break
+            self._reply(self.channel, tag, props, response)
+
+    def _reply(self, channel, tag, props, response):
+        """
+        Send a reply and acknowledge the request.
+        """
+        if props.reply_to is not None:
+            # set uuid so the right requester get the answer:-)
+            prop = pika.BasicProperties(correlation_id=props.correlation_id)
+            channel.basic_publish(exchange='',
+                                  routing_key=props.reply_to,
+                                  properties=prop,
+                                  body=json.dumps(response))
+        channel.basic_ack(delivery_tag=tag)
 
     def _handle(self, body):
         """
@@ -68,12 +146,12 @@ class ExecNode(object):
         uid = body['uid']
         token = body['token']
         call = body['call']
-        try:
-            proj = body['project_id']
+        proj = body.get('project_id')
+        self._recover(uid, token)
+        interpreter = None
+        if proj is not None and call in INTERPRETER_CALLS + SUBMIT_CALLS:
+            self._check_quota(proj)
             interpreter = self._get_interpreter(proj, uid, token)
-        except KeyError:
-            proj = None
-            interpreter = None
         res = {}
         # interactions with interpreter
         if call == 'run_notebook':
@@ -81,6 +159,7 @@ class ExecNode(object):
             src = body['src']
             ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
             out, err = interpreter.run(src)
+            self._account(proj, interpreter)
             ntb['src'] = src
             ntb['out'] = out
             ntb['err'] = err
@@ -90,6 +169,7 @@ class ExecNode(object):
             ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
             loc = body['loc']
             tmp, err = interpreter.interact(loc)
+            self._account(proj, interpreter)
             out = ['# ' + loc]
             out.extend(tmp)
             ntb['out'].extend(out)
@@ -99,14 +179,70 @@ class ExecNode(object):
         elif call == 'run_job':
             ntb_id = body['notebook_id']
             src = body['src']
-            thread.start_new_thread(self._run_job, (proj, ntb_id, src,
-                                                    interpreter, uid, token))
+            priority = int(body.get('priority', 0))
+            ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
+            iden = self.jobs.create_job({'project': proj,
+                                         'ntb_id': ntb_id,
+                                         'ntb_name': ntb['meta']['name'],
+                                         'src': src,
+                                         'priority': priority,
+                                         'schedule': body.get('schedule')},
+                                        uid, token)
+            self._queue_job(iden, proj, interpreter, priority, uid, token)
+            res['job_id'] = iden
+        elif call == 'trigger_run':
+            # fired by the triggers of a stream - nobody waits for a reply.
+            # while a job of the trigger is queued the messages are added to
+            # it - so at most one job per trigger waits behind a running one.
+            iden = self.jobs.coalesce_job(body['trigger'], body['messages'],
+                                          uid, token, body.get('max_batch'))
+            if iden is None:
+                ntb_id = body['notebook_id']
+                priority = int(body.get('priority', 0))
+                ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
+                iden = self.jobs.create_job({'project': proj,
+                                             'ntb_id': ntb_id,
+                                             'ntb_name': ntb['meta']['name'],
+                                             'src': ntb['src'],
+                                             'priority': priority,
+                                             'trigger': body['trigger'],
+                                             'inputs': body['messages']},
+                                            uid, token)
+                self._queue_job(iden, proj, interpreter, priority, uid,
+                                token)
+            res['job_id'] = iden
+        elif call == 'submit_run':
+            ntb_id = body['notebook_id']
+            src = body['src']
+            run_id = self.stor.create_run(proj, ntb_id, uid, token)
+            self.scheduler.submit(proj, 'run_notebook', self._stream_run,
+                                  (run_id, proj, ntb_id, src, interpreter,
+                                   uid, token), None, INTERACTIVE_PRIORITY)
+            res['run_id'] = run_id
         elif call == 'list_jobs':
-            res['jobs'] = self.jobs
+            res['total'], res['jobs'] = self.jobs.list_jobs(
+                uid, token, body.get('skip', 0), body.get('limit'))
+        elif call == 'cancel_job':
+            job = self.jobs.cancel_job(body['job_id'], uid, token)
+            if job is not None and job['state'] == 'running' and \
+                    job['project'] in self.wrappers:
+                # stop the interpreter if it is running this job.
+                self.wrappers[job['project']].cancel(body['job_id'])
+            res['cancelled'] = job is not None
+        elif call == 'stats':
+            res['stats'] = self.scheduler.stats()
+            res['stats']['usage'] = self.usage
         elif call == 'clear_job_list':
-            for item in self.jobs.keys():
-                if self.jobs[item]['state'].find('done') == 0:
-                    self.jobs.pop(item)
+            self.jobs.clear_jobs(uid, token)
+        # schedules - triggered by the cron daemon of the tenant.
+        elif call == 'create_schedule':
+            res['schedule_id'] = self._create_schedule(proj, body, uid,
+                                                       token)
+        elif call == 'list_schedules':
+            res['schedules'] = self.schedules.list_schedules(uid, token,
+                                                             proj)
+        elif call == 'delete_schedule':
+            self.schedules.delete_schedule(body['schedule_id'], uid, token)
         # project - from here on interactions with the store not interpreter.
         elif call == 'list_projects':
             res['projects'] = self.stor.list_projects(uid, token)
@@ -114,6 +250,7 @@ class ExecNode(object):
             res['project'] = self.stor.retrieve_project(proj, uid, token)
         elif call == 'delete_project':
             res['project'] = self.stor.delete_project(proj, uid, token)
+            self.schedules.delete_schedules(proj, uid, token)
         # notebooks
         elif call == 'create_notebook':
             ntb_id = body['notebook_id']
@@ -131,6 +268,7 @@ class ExecNode(object):
         elif call == 'delete_notebook':
             ntb_id = body['notebook_id']
             self.stor.delete_notebook(proj, ntb_id, uid, token)
+            self.schedules.delete_schedules(proj, uid, token, ntb_id)
         else:
             raise AttributeError('Cannot handle this action: ' + call)
         return res
@@ -139,30 +277,169 @@ class ExecNode(object):
         """
         Return the interpreter per project, or create a new one.
         """
-        if project_id not in self.wrappers:
-            # TODO: make type configurable (Python, Julia, R, ...)
-            self.wrappers[project_id] = wrapper.PythonWrapper(uid,
-                                                              token,
-                                                              self.uri,
-                                                              self.sdk)
-        return self.wrappers[project_id]
+        with self.lock:
+            if project_id not in self.wrappers:
+                # TODO: make type configurable (Python, Julia, R, ...)
+                self.wrappers[project_id] = self.pool.wrapper(uid, token)
+            return self.wrappers[project_id]
 
-    def _run_job(self, proj, ntb_id, src, interpreter, uid, token):
+    def _check_quota(self, proj):
         """
-        Run a notebook as a long running job.
+        Refuse to run code for a project which used up its quota.
         """
-        iden = str(uuid.uuid4())
+        usage = self.usage.get(proj, {})
+        for key, quota in self.quotas.items():
+            if quota is not None and usage.get(key, 0) >= quota:
+                raise AttributeError('Project ' + str(proj) + ' exceeded '
+                                     'its ' + key + ' quota of ' +
+                                     str(quota) + 's.')
+
+    def _account(self, proj, interpreter):
+        """
+        Add the resources consumed by the last run to the project's usage.
+
+        :return: The resources consumed by the last run.
+        """
+        used = getattr(interpreter, 'usage', {})
+        with self.lock:
+            usage = self.usage.setdefault(proj, {'runs': 0, 'cpu': 0.0,
+                                                 'wall': 0.0, 'max_rss': 0})
+            usage['runs'] += 1
+            usage['cpu'] += used.get('cpu', 0.0)
+            usage['wall'] += used.get('wall', 0.0)
+            usage['max_rss'] = max(usage['max_rss'], used.get('max_rss', 0))
+        return used
+
+    def _stream_run(self, run_id, proj, ntb_id, src, interpreter, uid,
+                    token):
+        """
+        Run a notebook & stream its output to the run's document.
+        """
+        self.stor.update_run(run_id, uid, token, state='running')
+        output = RunOutput(self.stor, run_id, uid, token)
+        try:
+            out, err = interpreter.run(src, output.write)
+        except Exception as error:
+            self.stor.update_run(run_id, uid, token, state='failed',
+                                 err=str(error))
+            raise
+        used = self._account(proj, interpreter)
         ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
-        self.jobs[iden] = {'state': 'running',
-                           'project': proj,
-                           'ntb_id': ntb_id,
-                           'ntb_name': ntb['meta']['name']}
-        time_0 = time()
-        out, err = interpreter.run(src)
         ntb['src'] = src
         ntb['out'] = out
         ntb['err'] = err
+        self.stor.update_notebook(proj, ntb_id, ntb, uid, token)
+        self.stor.update_run(run_id, uid, token, lines=output.rest(),
+                             state='done', err=err, usage=used)
+
+    def _recover(self, uid, token):
+        """
+        Fail the jobs & runs which were running when the node stopped &
+        queue the jobs which were still waiting.
+        """
+        with self.lock:
+            if self.recovered:
+                return
+            self.recovered = True
+        self.jobs.interrupt_jobs(uid, token)
+        self.stor.interrupt_runs(uid, token)
+        for job in self.jobs.list_queued(uid, token):
+            interpreter = self._get_interpreter(job['project'], uid, token)
+            self._queue_job(job['_id'], job['project'], interpreter,
+                            job.get('priority', 0), uid, token)
+
+    def _create_schedule(self, proj, body, uid, token):
+        """
+        Validate & register a schedule - first due at its next occurrence.
+        """
+        ntb_id = body['notebook_id']
+        ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
+        schedule = {'project': proj,
+                    'ntb_id': ntb_id,
+                    'ntb_name': ntb['meta']['name'],
+                    'cron': body.get('cron'),
+                    'interval': body.get('interval'),
+                    'misfire': body.get('misfire', 'coalesce'),
+                    'priority': int(body.get('priority', 0))}
+        cron.validate(schedule['cron'], schedule['interval'],
+                      schedule['misfire'])
+        schedule['next_run'] = cron.next_run(schedule, time())
+        return self.schedules.create_schedule(schedule, uid, token)
+
+    def _queue_job(self, iden, proj, interpreter, priority, uid, token):
+        """
+        Queue a job - jobs share the lane of the project's interpreter.
+        """
+        self.scheduler.submit(proj, 'run_job', self._run_job,
+                              (iden, proj, interpreter, uid, token), None,
+                              priority)
+
+    def _run_job(self, iden, proj, interpreter, uid, token):
+        """
+        Run a notebook as a long running job.
+        """
+        job = self.jobs.start_job(iden, uid, token)
+        if job is None:
+            # cancelled while queued.
+            return
+        ntb_id = job['ntb_id']
+        src = job['src']
+        time_0 = time()
+        try:
+            out, err = interpreter.run(src, inputs=job.get('inputs'),
+                                       job=iden)
+        except Exception as error:
+            self.jobs.finish_job(iden, uid, token, state='failed',
+                                 error=str(error))
+            raise
+        used = self._account(proj, interpreter)
         time_1 = time()
+        ntb = self.stor.retrieve_notebook(proj, ntb_id, uid, token)
+        ntb['src'] = src
+        ntb['out'] = out
+        ntb['err'] = err
         self.stor.update_notebook(proj, ntb_id, ntb, uid, token)
-        self.jobs[iden]['state'] = 'done in ' + \
-                                   str(round(time_1 - time_0, 2)) + 's'
+        self.jobs.finish_job(iden, uid, token, usage=used,
+                             duration=round(time_1 - time_0, 2))
+
+
+class RunOutput(object):
+    """
+    Appends the output of a streamed run line by line to the run's document.
+    """
+
+    def __init__(self, stor, run_id, uid, token):
+        self.stor = stor
+        self.run_id = run_id
+        self.uid = uid
+        self.token = token
+        self.partial = ''
+
+    def write(self, text):
+        """
+        Store the complete lines of a chunk of output.
+
+        :param text: The chunk.
+        """
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        if len(lines) > 0:
+            self.stor.update_run(self.run_id, self.uid, self.token,
+                                 lines=lines)
+
+    def rest(self):
+        """
+        Return the last incomplete line.
+        """
+        res = [self.partial] if self.partial != '' else []
+        self.partial = ''
+        return res
+
+
+def _response(response, err):
+    """
+    Build the reply for a call - errors are reported to the caller.
+    """
+    if err is not None:
+        return {'error': str(err)}
+    return response
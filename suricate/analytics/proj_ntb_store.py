@@ -4,7 +4,21 @@ Mongo, etc). For now we'll support mongoDB.
 """
 
 import bson
-import pymongo
+import collections
+import time
+
+from suricate.data import connection
+
+# runs of notebooks whose output is streamed to the UI.
+RUNS = 'data_runs'
+# jobs of a tenant.
+JOBS = 'data_jobs'
+# states of jobs which will not change anymore.
+FINISHED = ('done', 'failed', 'cancelled')
+# fields of jobs which are not listed.
+HIDDEN = {'src': False, 'inputs': False}
+# scheduled notebooks of a tenant.
+SCHEDULES = 'data_schedules'
 
 
 class NotebookStore(object):
@@ -15,8 +29,8 @@ class NotebookStore(object):
     # TODO: work with IDs and name in meta!
 
     def __init__(self, uri, uid):
-        client = pymongo.MongoClient(uri)
-        self.database = client[uid]
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
 
     def list_projects(self, uid, token):
         """
@@ -25,14 +39,15 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        tmp = self.database.collection_names(include_system_collections=False)
-        res = []
-        # bit of a hack but each db in suricate is also used for data storage.
-        for item in tmp:
-            if item.find('data_') == -1:
-                res.append(item)
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            tmp = database.collection_names(include_system_collections=False)
+            res = []
+            # bit of a hack but each db in suricate is also used for data
+            # storage.
+            for item in tmp:
+                if item.find('data_') == -1:
+                    res.append(item)
+            return res
 
     def retrieve_project(self, project, uid, token):
         """
@@ -42,12 +57,12 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        res = []
-        tmp = self.database[project].find(fields={'_id': True, 'meta': True})
-        for item in tmp:
-            res.append((str(item['_id']), item['meta']))
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            res = []
+            tmp = database[project].find(fields={'_id': True, 'meta': True})
+            for item in tmp:
+                res.append((str(item['_id']), item['meta']))
+            return res
 
     def delete_project(self, project, uid, token):
         """
@@ -57,8 +72,8 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        self.database[project].drop()
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[project].drop()
 
     def retrieve_notebook(self, project, ntb_id, uid, token):
         """
@@ -69,10 +84,13 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        tmp = self.database[project].find_one({"_id": bson.ObjectId(ntb_id)})
-        tmp.pop('_id')
-        return tmp
+        with self.auth_cache.database(self.client, uid, token) as database:
+            tmp = database[project].find_one({"_id": bson.ObjectId(ntb_id)})
+            if tmp is None:
+                raise AttributeError('Notebook ' + str(ntb_id) + ' not found '
+                                     'in project ' + str(project) + '.')
+            tmp.pop('_id')
+            return tmp
 
     def update_notebook(self, project, ntb_id, content, uid, token):
         """
@@ -84,14 +102,14 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        coll = self.database[project]
-        if ntb_id is None:
-            ntb_id = coll.insert(content)
-        else:
-            coll.update({'_id': bson.ObjectId(ntb_id)},
-                        {"$set": content}, upsert=True)
-        return str(ntb_id)
+        with self.auth_cache.database(self.client, uid, token) as database:
+            coll = database[project]
+            if ntb_id is None:
+                ntb_id = coll.insert(content)
+            else:
+                coll.update({'_id': bson.ObjectId(ntb_id)},
+                            {"$set": content}, upsert=True)
+            return str(ntb_id)
 
     def delete_notebook(self, project, ntb_id, uid, token):
         """
@@ -102,5 +120,363 @@ class NotebookStore(object):
         :param uid: User id.
         :param token: Token for this user.
         """
-        self.database.authenticate(uid, token)
-        self.database[project].remove({'_id': bson.ObjectId(ntb_id)})
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[project].remove({'_id': bson.ObjectId(ntb_id)})
+
+    def create_run(self, project, ntb_id, uid, token):
+        """
+        Create a run of a notebook - finished runs of the notebook are
+        removed.
+
+        :param project: name of the project.
+        :param ntb_id: Identifier for the notebook.
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: Identifier of the run.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            coll = database[RUNS]
+            coll.remove({'project': project,
+                         'ntb_id': ntb_id,
+                         'state': {'$in': ['done', 'failed']}})
+            return str(coll.insert({'project': project,
+                                    'ntb_id': ntb_id,
+                                    'state': 'queued',
+                                    'created': time.time(),
+                                    'out': [],
+                                    'err': ''}))
+
+    def update_run(self, run_id, uid, token, lines=None, **kwargs):
+        """
+        Append output to a run and/or set its state, errors etc.
+
+        :param run_id: Identifier of the run.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param lines: Lines of output to append.
+        :param kwargs: Fields to set.
+        """
+        update = {}
+        if lines:
+            update['$push'] = {'out': {'$each': lines}}
+        if kwargs:
+            update['$set'] = kwargs
+        if not update:
+            return
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[RUNS].update({'_id': bson.ObjectId(run_id)}, update)
+
+    def interrupt_runs(self, uid, token):
+        """
+        Mark runs which were queued or running while the node stopped as
+        failed.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[RUNS].update({'state': {'$in': ['queued', 'running']}},
+                                  {'$set': {'state': 'failed',
+                                            'err': 'Interrupted.'}},
+                                  multi=True)
+
+    def retrieve_run(self, run_id, uid, token, offset=0):
+        """
+        Retrieve a run.
+
+        :param run_id: Identifier of the run.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param offset: Only return the output lines from this offset on.
+        :return: The run or None if it does not exist (anymore).
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            fields = {'_id': False}
+            if offset > 0:
+                fields['out'] = {'$slice': [offset, 2 ** 31 - 1]}
+            return database[RUNS].find_one({'_id': bson.ObjectId(run_id)},
+                                           fields=fields)
+
+
+class JobStore(object):
+    """
+    Persistent registry of the jobs of a tenant based on the MongoDB.
+    """
+
+    def __init__(self, uri):
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
+
+    def create_job(self, job, uid, token):
+        """
+        Register a new, queued job.
+
+        :param job: Dict describing the job (project, ntb_id, src, ...).
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: Identifier of the job.
+        """
+        job = dict(job, state='queued', created=time.time())
+        with self.auth_cache.database(self.client, uid, token) as database:
+            for key in ('schedule', 'trigger'):
+                if job.get(key) is not None:
+                    # scheduled & triggered jobs would pile up - keep the
+                    # latest only.
+                    database[JOBS].remove({key: job[key],
+                                           'state': {'$in': list(FINISHED)}})
+            return str(database[JOBS].insert(job))
+
+    def coalesce_job(self, trigger, inputs, uid, token, max_inputs=None):
+        """
+        Add inputs to the queued job of a trigger - if there is one.
+
+        :param trigger: Identifier of the trigger.
+        :param inputs: List of inputs (messages) to add.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param max_inputs: Only keep the latest inputs - all if None.
+        :return: Identifier of the job or None.
+        """
+        push = {'$each': inputs}
+        if max_inputs is not None:
+            push['$slice'] = -max_inputs
+        with self.auth_cache.database(self.client, uid, token) as database:
+            job = database[JOBS].find_and_modify(
+                {'trigger': trigger, 'state': 'queued'},
+                {'$push': {'inputs': push}}, fields={'_id': True})
+            if job is None:
+                return None
+            return str(job['_id'])
+
+    def retrieve_job(self, iden, uid, token):
+        """
+        Retrieve a job - without its source.
+
+        :param iden: Identifier of the job.
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: The job or None.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return database[JOBS].find_one({'_id': bson.ObjectId(iden)},
+                                           fields=HIDDEN)
+
+    def start_job(self, iden, uid, token):
+        """
+        Mark a queued job as running.
+
+        :param iden: Identifier of the job.
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: The job or None if it is not queued anymore (cancelled).
+        """
+        now = time.time()
+        with self.auth_cache.database(self.client, uid, token) as database:
+            job = database[JOBS].find_and_modify(
+                {'_id': bson.ObjectId(iden), 'state': 'queued'},
+                {'$set': {'state': 'running', 'started': now}})
+            if job is not None:
+                database[JOBS].update({'_id': job['_id']},
+                                      {'$set': {'wait': now -
+                                                job['created']}})
+            return job
+
+    def finish_job(self, iden, uid, token, state='done', **kwargs):
+        """
+        Mark a running job as finished - cancelled jobs stay cancelled.
+
+        :param iden: Identifier of the job.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param state: done or failed.
+        :param kwargs: Further fields to set (usage, error, ...).
+        """
+        fields = dict(kwargs, state=state, finished=time.time())
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[JOBS].update({'_id': bson.ObjectId(iden),
+                                   'state': 'running'},
+                                  {'$set': fields})
+
+    def cancel_job(self, iden, uid, token):
+        """
+        Cancel a queued or running job.
+
+        :param iden: Identifier of the job.
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: The job as it was before or None if it already finished.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return database[JOBS].find_and_modify(
+                {'_id': bson.ObjectId(iden),
+                 'state': {'$in': ['queued', 'running']}},
+                {'$set': {'state': 'cancelled', 'finished': time.time()}},
+                fields=HIDDEN)
+
+    def list_jobs(self, uid, token, skip=0, limit=None, states=None):
+        """
+        List the jobs - newest first.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        :param skip: Number of jobs to skip.
+        :param limit: Max. number of jobs to return.
+        :param states: Only list jobs in these states.
+        :return: Tuple with the total number of jobs & an ordered dict of
+            the jobs by identifier.
+        """
+        query = {}
+        if states is not None:
+            query['state'] = {'$in': list(states)}
+        with self.auth_cache.database(self.client, uid, token) as database:
+            cursor = database[JOBS].find(query, fields=HIDDEN,
+                                         sort=[('created', -1)],
+                                         skip=skip, limit=limit or 0)
+            res = collections.OrderedDict()
+            for item in cursor:
+                res[str(item.pop('_id'))] = item
+            return cursor.count(), res
+
+    def list_queued(self, uid, token):
+        """
+        List the queued jobs - oldest first - including their source.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            res = []
+            for item in database[JOBS].find({'state': 'queued'},
+                                            sort=[('created', 1)]):
+                item['_id'] = str(item['_id'])
+                res.append(item)
+            return res
+
+    def interrupt_jobs(self, uid, token):
+        """
+        Mark jobs which were running while the node stopped as failed.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[JOBS].update({'state': 'running'},
+                                  {'$set': {'state': 'failed',
+                                            'error': 'Interrupted.',
+                                            'finished': time.time()}},
+                                  multi=True)
+
+    def clear_jobs(self, uid, token):
+        """
+        Remove the finished jobs.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[JOBS].remove({'state': {'$in': list(FINISHED)}})
+
+
+class ScheduleStore(object):
+    """
+    Persistent registry of the scheduled notebooks of a tenant based on the
+    MongoDB.
+    """
+
+    def __init__(self, uri):
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
+
+    def create_schedule(self, schedule, uid, token):
+        """
+        Register a new schedule.
+
+        :param schedule: Dict describing the schedule (project, ntb_id, cron
+            or interval, next_run, ...).
+        :param uid: User id.
+        :param token: Token for this user.
+        :return: Identifier of the schedule.
+        """
+        schedule = dict(schedule, enabled=True, runs=0, skipped=0, failed=0,
+                        last_error=None, created=time.time())
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return str(database[SCHEDULES].insert(schedule))
+
+    def list_schedules(self, uid, token, project=None):
+        """
+        List the schedules.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        :param project: Only list the schedules of this project.
+        :return: Ordered dict of the schedules by identifier.
+        """
+        query = {}
+        if project is not None:
+            query['project'] = project
+        with self.auth_cache.database(self.client, uid, token) as database:
+            res = collections.OrderedDict()
+            for item in database[SCHEDULES].find(query,
+                                                 sort=[('created', 1)]):
+                res[str(item.pop('_id'))] = item
+            return res
+
+    def due(self, uid, token, now):
+        """
+        List the enabled schedules which are due.
+
+        :param uid: User id.
+        :param token: Token for this user.
+        :param now: The current time.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            res = []
+            for item in database[SCHEDULES].find({'enabled': True,
+                                                  'next_run': {'$lte': now}},
+                                                 sort=[('next_run', 1)]):
+                item['_id'] = str(item['_id'])
+                res.append(item)
+            return res
+
+    def update_schedule(self, iden, uid, token, inc=None, **kwargs):
+        """
+        Update a schedule.
+
+        :param iden: Identifier of the schedule.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param inc: Name of a counter to increment (runs, skipped,
+            failed).
+        :param kwargs: Fields to set (next_run, last_job, enabled, ...).
+        """
+        update = {'$set': kwargs}
+        if inc is not None:
+            update['$inc'] = {inc: 1}
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[SCHEDULES].update({'_id': bson.ObjectId(iden)}, update)
+
+    def delete_schedule(self, iden, uid, token):
+        """
+        Remove a schedule.
+
+        :param iden: Identifier of the schedule.
+        :param uid: User id.
+        :param token: Token for this user.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[SCHEDULES].remove({'_id': bson.ObjectId(iden)})
+
+    def delete_schedules(self, project, uid, token, ntb_id=None):
+        """
+        Remove the schedules of a deleted project or notebook.
+
+        :param project: Name of the project.
+        :param uid: User id.
+        :param token: Token for this user.
+        :param ntb_id: Only remove the schedules of this notebook.
+        """
+        query = {'project': project}
+        if ntb_id is not None:
+            query['ntb_id'] = ntb_id
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[SCHEDULES].remove(query)
@@ -0,0 +1,176 @@
+# coding=utf-8
+
+"""
+Scheduler for the execution node - runs calls on a bounded pool of workers
+with one serialized lane per key (e.g. per project interpreter).
+"""
+
+__author__ = 'tmetsch'
+
+import collections
+import heapq
+import itertools
+import Queue
+import threading
+import time
+
+
+class Scheduler(object):
+    """
+    Runs tasks on a bounded number of worker threads. Tasks with the same key
+    are run one after the other - higher priority first, equal priority in
+    the order they were submitted; tasks of different keys run concurrently.
+    Lanes whose next task has a higher priority are served first - lanes of
+    equal priority in FIFO order.
+    """
+
+    def __init__(self, workers=4):
+        if workers < 1:
+            raise AttributeError('Need at least one worker.')
+        self.lock = threading.Lock()
+        # (-priority, sequence, key) of lanes with pending tasks which no
+        # worker is working on - a lane can be listed more than once.
+        self.ready = Queue.PriorityQueue()
+        # per key a heap of (-priority, sequence, task).
+        self.sequence = itertools.count()
+        self.lanes = {}
+        self.active = set()
+        self.latency = collections.defaultdict(Latency)
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, name, func, args=(), done=None, priority=0):
+        """
+        Queue a task in the lane of the given key.
+
+        :param key: The lane - tasks of a lane are run serially.
+        :param name: Name of the task, latencies are tracked per name.
+        :param func: The function to call.
+        :param args: Arguments for the function.
+        :param done: Called with the result and error (or None) once the
+            task is finished.
+        :param priority: Tasks with higher priority are run first.
+        """
+        with self.lock:
+            lane = self.lanes.setdefault(key, [])
+            item = (-priority, next(self.sequence),
+                    (name, func, args, done, time.time()))
+            heapq.heappush(lane, item)
+            if lane[0] is item and key not in self.active:
+                # new head of the lane - (re)queue it with its priority.
+                self._ready(key)
+
+    def _ready(self, key):
+        """
+        Queue a lane for the workers - needs to hold the lock.
+        """
+        self.ready.put((self.lanes[key][0][0], next(self.sequence), key))
+
+    def _work(self):
+        """
+        Worker loop - takes a lane and runs its next task.
+        """
+        while True:
+            _, _, key = self.ready.get()
+            if key is None:
+                break
+            with self.lock:
+                if key in self.active or key not in self.lanes:
+                    # lane was queued again & is already served.
+                    continue
+                self.active.add(key)
+                name, func, args, done, queued = \
+                    heapq.heappop(self.lanes[key])[2]
+            started = time.time()
+            res = err = None
+            try:
+                res = func(*args)
+            except Exception as error:
+                err = error
+            finished = time.time()
+            self.record(name, started - queued, finished - started)
+            with self.lock:
+                self.active.discard(key)
+                if len(self.lanes[key]) > 0:
+                    self._ready(key)
+                else:
+                    self.lanes.pop(key)
+            if done is not None:
+                done(res, err)
+
+    def record(self, name, wait, run):
+        """
+        Record the latency of a call.
+
+        :param name: Name of the call.
+        :param wait: Seconds the call was queued.
+        :param run: Seconds the call ran.
+        """
+        with self.lock:
+            self.latency[name].add(wait, run)
+
+    def depth(self):
+        """
+        Return the number of tasks waiting to be run.
+        """
+        with self.lock:
+            return sum(len(lane) for lane in self.lanes.values())
+
+    def stats(self):
+        """
+        Return queue depth, number of running tasks & latencies per task name.
+        """
+        with self.lock:
+            return {'queued': sum(len(lane) for lane in self.lanes.values()),
+                    'running': len(self.active),
+                    'lanes': dict((str(key), len(lane))
+                                  for key, lane in self.lanes.items()),
+                    'latency': dict((name, item.summary())
+                                    for name, item in self.latency.items())}
+
+    def stop(self):
+        """
+        Stop the workers.
+        """
+        for _ in self.threads:
+            self.ready.put((float('-inf'), next(self.sequence), None))
+
+
+class Latency(object):
+    """
+    Tracks the time tasks waited in the queue and the time they ran.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.wait = 0.0
+        self.run = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+
+    def add(self, wait, run):
+        """
+        Record a finished task.
+
+        :param wait: Seconds the task was queued.
+        :param run: Seconds the task ran.
+        """
+        self.count += 1
+        self.wait += wait
+        self.run += run
+        self.max_wait = max(self.max_wait, wait)
+        self.max_run = max(self.max_run, run)
+
+    def summary(self):
+        """
+        Return count, average & max wait and run times.
+        """
+        return {'count': self.count,
+                'avg_wait': round(self.wait / self.count, 4),
+                'max_wait': round(self.max_wait, 4),
+                'avg_run': round(self.run / self.count, 4),
+                'max_run': round(self.max_run, 4)}
@@ -3,34 +3,135 @@ Adapters for different languages.
 """
 
 import code
+import collections
+import multiprocessing
+import resource
+import signal
 import sys
+import threading
+import time
 
 import StringIO
 
+from suricate.data import connection
+from suricate.data import object_store
+
+LOCK = threading.Lock()
+
+# per run limits: CPU seconds, memory (KB on top of the preload), wall clock
+# seconds & output size (characters) - and wall clock seconds for starting a
+# worker (running the preload).
+LIMITS = {'cpu': 300,
+          'memory': 2 * 1024 * 1024,
+          'wall': 600,
+          'output': 1024 * 1024,
+          'start': 60}
+
+
+class LimitExceeded(Exception):
+    """
+    Raised in a worker process if a run exceeds a limit.
+    """
+
+    pass
+
+
+class ThreadOutput(object):
+    """
+    Replacement for sys.stdout & sys.stderr which writes to a buffer per
+    thread - so interpreters can run concurrently.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def redirect(self, buf):
+        """
+        Redirect the output of the current thread.
+
+        :param buf: The buffer or None to write to the original stream.
+        """
+        self.local.buf = buf
+
+    def _target(self):
+        buf = getattr(self.local, 'buf', None)
+        return self.stream if buf is None else buf
+
+    def write(self, data):
+        """
+        Write to the buffer of the current thread.
+
+        :param data: The data.
+        """
+        self._target().write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def _install():
+    """
+    Make sure sys.stdout & sys.stderr are thread aware.
+    """
+    with LOCK:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr)
+    return sys.stdout, sys.stderr
+
+
+class StreamBuffer(StringIO.StringIO):
+    """
+    Buffer which also hands everything written to it to a callback.
+    """
+
+    def __init__(self, callback):
+        StringIO.StringIO.__init__(self)
+        self.callback = callback
+
+    def write(self, data):
+        """
+        Write to the buffer & the callback.
+
+        :param data: The data.
+        """
+        StringIO.StringIO.write(self, data)
+        self.callback(data)
+
 
 def grep_stdout(func):
     """
-    Wrap stderr and stdout to a str return value.
+    Wrap stderr and stdout to a str return value. If the wrapped object has
+    an on_output callback stdout is also handed to it while it is written.
     :param func:
     """
 
-    def wrap(*args):
+    def wrap(obj, *args):
         """
         Wraps a function.
 
+        :param obj: The wrapped object.
         :param args: Bunch of Arguments.
         """
-        old_out = sys.stdout
-        old_err = sys.stderr
-        sys.stdout = StringIO.StringIO()
-        sys.stderr = StringIO.StringIO()
-        func(*args)
-        err = sys.stderr.getvalue()
-        out = sys.stdout.getvalue().strip().split('\n')
-        sys.stdout.close()
-        sys.stderr.close()
-        sys.stdout = old_out
-        sys.stderr = old_err
+        stdout, stderr = _install()
+        if getattr(obj, 'on_output', None) is not None:
+            out_buf = StreamBuffer(obj.on_output)
+        else:
+            out_buf = StringIO.StringIO()
+        err_buf = StringIO.StringIO()
+        stdout.redirect(out_buf)
+        stderr.redirect(err_buf)
+        try:
+            func(obj, *args)
+        finally:
+            stdout.redirect(None)
+            stderr.redirect(None)
+        err = err_buf.getvalue()
+        out = out_buf.getvalue().strip().split('\n')
+        out_buf.close()
+        err_buf.close()
         return out, err
     return wrap
 
@@ -40,22 +141,51 @@ class PythonWrapper(object):
     Wrapper to use Python for Analytics.
     """
 
-    def __init__(self, uid, token, mongo_uri, sdk):
+    def __init__(self, uid, token, mongo_uri, sdk, warm=False):
         self.console = code.InteractiveConsole()
         # set User identifier and tell where object store is.
-        self.console.push('UID = \'' + str(uid) + '\'')
-        self.console.push('TOKEN = \'' + str(token) + '\'')
+        self.bind(uid, token)
         self.console.push('OBJECT_STORE_URI = \'' + str(mongo_uri) + '\'')
         # This preload will be downloaded with the notebook.
         self.preload = file(sdk).read()
+        # warm interpreters run the preload once & only reset it per run.
+        self.warm = warm
+        # optional callback receiving the output while it is produced.
+        self.on_output = None
+        if warm:
+            self.load()
+
+    def bind(self, uid, token):
+        """
+        Set the user the code runs for.
+
+        :param uid: Identifier of the user.
+        :param token: Token of the user.
+        """
+        self.console.push('UID = \'' + str(uid) + '\'')
+        self.console.push('TOKEN = \'' + str(token) + '\'')
+
+    @grep_stdout
+    def load(self):
+        """
+        Run the preload.
+        """
+        self.console.runcode(self.preload)
 
     @grep_stdout
-    def run(self, src):
+    def run(self, src, inputs=None):
         """
         Run some code.
+
+        :param src: The code.
+        :param inputs: Messages available to the code as MESSAGES.
         """
         self.console.resetbuffer()
-        self.console.runcode(self.preload)
+        self.console.locals['MESSAGES'] = inputs or []
+        if not self.warm:
+            self.console.runcode(self.preload)
+        elif 'reset' in self.console.locals:
+            self.console.runcode('reset()')
         self.console.runcode(src)
 
     @grep_stdout
@@ -66,6 +196,537 @@ class PythonWrapper(object):
         self.console.push(loc)
 
 
+class ProcessWrapper(object):
+    """
+    Wrapper to use Python for Analytics which runs the code of a project in
+    a warm worker process of a pool.
+    """
+
+    def __init__(self, pool, uid, token):
+        self.pool = pool
+        self.uid = uid
+        self.token = token
+        self.worker = None
+        # resources consumed by the last run or interaction.
+        self.usage = {}
+        # the job being run & a job cancelled before it started.
+        self.lock = threading.Lock()
+        self.job = None
+        self.cancelled = None
+        # True while code runs - the pool does not reap busy workers.
+        self.busy = False
+
+    def _get_worker(self, fresh=False):
+        """
+        Return the worker of this project - recycled ones are replaced.
+        """
+        if self.worker is not None and (fresh or not self.worker.alive):
+            self.pool.forget(self)
+            self.worker.stop()
+            self.worker = None
+        if self.worker is None:
+            self.worker = self.pool.acquire(self.uid, self.token)
+        self.pool.touch(self)
+        return self.worker
+
+    def _done(self):
+        """
+        Mark the worker as idle - it can be reaped from now on.
+        """
+        with self.lock:
+            self.job = None
+            self.busy = False
+        if self.worker is not None:
+            self.pool.touch(self)
+
+    def run(self, src, on_output=None, inputs=None, job=None):
+        """
+        Run some code.
+
+        :param src: The code.
+        :param on_output: Optional callback receiving chunks of the output
+            while the code runs.
+        :param inputs: Messages available to the code as MESSAGES.
+        :param job: Optional identifier of the job the code is run for.
+        """
+        with self.lock:
+            if job is not None and job == self.cancelled:
+                self.cancelled = None
+                self.usage = {}
+                return [''], 'Cancelled.'
+            self.job = job
+            self.busy = True
+        try:
+            worker = self._get_worker(self.pool.expired(self.worker))
+            if on_output is None:
+                res = worker.call('run', (src, inputs))
+            else:
+                res = worker.call('stream', (src, inputs), on_output)
+        finally:
+            self._done()
+        self.usage = worker.usage
+        return res
+
+    def interact(self, loc):
+        """
+        Interact with the interpreter directly.
+        """
+        with self.lock:
+            self.busy = True
+        try:
+            worker = self._get_worker()
+            res = worker.call('interact', loc)
+        finally:
+            self._done()
+        self.usage = worker.usage
+        return res
+
+    def cancel(self, job=None):
+        """
+        Abort the code being run by killing the worker process - it is
+        replaced on the next call. If a job is given only its run is
+        aborted - if it did not start yet it is skipped.
+
+        :param job: Optional identifier of the job.
+        """
+        with self.lock:
+            if job is not None and job != self.job:
+                self.cancelled = job
+                return
+            worker = self.worker
+        if worker is not None:
+            worker.kill()
+
+    def release(self):
+        """
+        Stop the worker process unless code is running - the next call
+        starts with a fresh worker.
+
+        :return: True if the worker was stopped.
+        """
+        with self.lock:
+            if self.busy:
+                return False
+            worker = self.worker
+            self.worker = None
+        self.pool.forget(self)
+        if worker is not None:
+            worker.stop()
+        return True
+
+    def stop(self):
+        """
+        Stop the worker process.
+        """
+        self.pool.forget(self)
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+
+class InterpreterPool(object):
+    """
+    Pool of forked worker processes which have already run the SDK preload.
+    Workers are handed to the projects and recycled after max_runs runs or
+    once their memory grew by more than max_growth KB. Each run is limited
+    as defined by limits (see LIMITS).
+
+    At most max_workers workers are bound to projects - beyond that the
+    least recently used idle ones are stopped, as are those idle for more
+    than max_idle seconds.
+    """
+
+    def __init__(self, mongo_uri, sdk, spares=2, max_runs=50,
+                 max_growth=512 * 1024, limits=None, max_workers=8,
+                 max_idle=600.0):
+        self.mongo_uri = mongo_uri
+        self.sdk = sdk
+        self.spares = spares
+        self.max_runs = max_runs
+        self.max_growth = max_growth
+        self.limits = dict(LIMITS, **(limits or {}))
+        self.max_workers = max_workers
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = collections.deque()
+        # wrappers with a bound worker & their last use - oldest first.
+        self.bound = collections.OrderedDict()
+        self.fill()
+
+    def fill(self):
+        """
+        Start workers until enough warm spares are available.
+        """
+        with self.lock:
+            while len(self.idle) < self.spares:
+                self.idle.append(Worker(self.mongo_uri, self.sdk,
+                                        self.limits))
+
+    def acquire(self, uid, token):
+        """
+        Hand out a warm worker.
+
+        :param uid: Identifier of the user.
+        :param token: Token of the user.
+        """
+        # make room for the new worker.
+        self.reap(1)
+        with self.lock:
+            if len(self.idle) > 0:
+                worker = self.idle.popleft()
+            else:
+                worker = Worker(self.mongo_uri, self.sdk, self.limits)
+        self.fill()
+        worker.call('bind', (uid, token))
+        return worker
+
+    def expired(self, worker):
+        """
+        Check if a worker should be recycled.
+
+        :param worker: The worker.
+        """
+        if worker is None:
+            return False
+        return worker.runs >= self.max_runs or \
+            worker.growth() > self.max_growth
+
+    def touch(self, interpreter):
+        """
+        Mark the worker of an interpreter as just used.
+
+        :param interpreter: The ProcessWrapper.
+        """
+        with self.lock:
+            self.bound.pop(interpreter, None)
+            self.bound[interpreter] = time.time()
+
+    def forget(self, interpreter):
+        """
+        Stop tracking the worker of an interpreter.
+
+        :param interpreter: The ProcessWrapper.
+        """
+        with self.lock:
+            self.bound.pop(interpreter, None)
+
+    def reap(self, room=0):
+        """
+        Stop the workers idle for longer than max_idle and the least
+        recently used ones beyond max_workers - busy ones are kept.
+
+        :param room: Number of workers about to be bound.
+        """
+        now = time.time()
+        with self.lock:
+            bound = self.bound.items()
+        excess = len(bound) + room - self.max_workers
+        for interpreter, used in bound:
+            if excess <= 0 and now - used < self.max_idle:
+                break
+            if interpreter.release():
+                excess -= 1
+
+    def wrapper(self, uid, token):
+        """
+        Return an interpreter backed by this pool.
+
+        :param uid: Identifier of the user.
+        :param token: Token of the user.
+        """
+        return ProcessWrapper(self, uid, token)
+
+    def stop(self):
+        """
+        Stop the spare workers & the idle bound ones.
+        """
+        with self.lock:
+            while len(self.idle) > 0:
+                self.idle.popleft().stop()
+            bound = self.bound.keys()
+        for interpreter in bound:
+            interpreter.release()
+
+
+class Worker(object):
+    """
+    A worker process running a warm Python interpreter.
+    """
+
+    def __init__(self, mongo_uri, sdk, limits=None):
+        self.limits = dict(LIMITS, **(limits or {}))
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child, mongo_uri, sdk,
+                                                     self.limits))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.alive = True
+        # returned by calls once the process is gone.
+        self.error = 'The interpreter died - it will be restarted.'
+        self.runs = 0
+        self.base_rss = None
+        self.rss = 0
+        self.usage = {}
+
+    def call(self, operation, arg, on_output=None):
+        """
+        Let the worker process run, stream, interact or bind.
+
+        :param operation: The operation.
+        :param arg: Argument for it.
+        :param on_output: Callback for the output chunks of streamed runs.
+        :return: Tuple with output lines & errors.
+        """
+        if not self.alive:
+            return [''], self.error
+        try:
+            if self.base_rss is None:
+                # wait for the preload to finish.
+                if not self.conn.poll(self.limits['start']):
+                    self.kill()
+                    self.usage = {'killed': True}
+                    self.error = 'The interpreter did not start within ' + \
+                        str(self.limits['start']) + 's - it will be ' \
+                        'restarted.'
+                    return [''], self.error
+                self.base_rss = self.conn.recv()
+            start = time.time()
+            deadline = start + self.limits['wall']
+            self.conn.send((operation, arg))
+            chunks = []
+            while True:
+                if len(chunks) == 0 and operation != 'bind' and \
+                        not self.conn.poll(max(deadline - time.time(), 0)):
+                    self.kill()
+                    self.usage = {'wall': self.limits['wall'],
+                                  'killed': True}
+                    return [''], 'Wall clock limit of ' + \
+                        str(self.limits['wall']) + 's exceeded - the ' \
+                        'interpreter will be restarted.'
+                msg = self.conn.recv()
+                if msg[0] == 'chunk':
+                    chunks.append(msg[1])
+                    if self.conn.poll(0):
+                        # hand the chunks available over at once.
+                        continue
+                if len(chunks) > 0 and on_output is not None:
+                    on_output(''.join(chunks))
+                chunks = []
+                if msg[0] == 'done':
+                    break
+            _, out, err, self.rss, usage = msg
+        except (EOFError, IOError):
+            self.alive = False
+            self.usage = {'killed': True}
+            return [''], self.error
+        if operation != 'bind':
+            usage['wall'] = round(time.time() - start, 3)
+            self.usage = usage
+        if operation in ('run', 'stream'):
+            self.runs += 1
+        return out, err
+
+    def growth(self):
+        """
+        Return the growth of the worker's max. resident set size in KB.
+        """
+        if self.base_rss is None:
+            return 0
+        return self.rss - self.base_rss
+
+    def stop(self):
+        """
+        Stop the worker process.
+        """
+        self.alive = False
+        try:
+            self.conn.send(('stop', None))
+        except IOError:
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def kill(self):
+        """
+        Kill the worker process - e.g. when it ran out of time.
+        """
+        self.alive = False
+        self.process.terminate()
+        self.process.join(1)
+
+
+def _serve(conn, mongo_uri, sdk, limits):
+    """
+    Main loop of the worker processes.
+    """
+    _after_fork()
+    interpreter = PythonWrapper(None, None, mongo_uri, sdk, warm=True)
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+    _limit_memory(limits['memory'])
+    conn.send(_max_rss())
+    while True:
+        operation, arg = conn.recv()
+        if operation == 'stop':
+            break
+        elif operation == 'bind':
+            interpreter.bind(*arg)
+            conn.send(('done', [''], '', _max_rss(), {}))
+            continue
+        cpu = _cpu_time()
+        _limit_cpu(cpu + limits['cpu'])
+        chunks = None
+        if operation == 'stream':
+            chunks = _Chunks(conn, limits['output'])
+            interpreter.on_output = chunks.write
+        try:
+            if operation == 'interact':
+                out, err = interpreter.interact(arg)
+            else:
+                out, err = interpreter.run(*arg)
+        finally:
+            _limit_cpu(None)
+            interpreter.on_output = None
+        if chunks is not None:
+            chunks.flush()
+        size = sum(len(line) for line in out) + len(err)
+        out, err = _truncate(out, err, limits['output'])
+        conn.send(('done', out, err, _max_rss(),
+                   {'cpu': round(_cpu_time() - cpu, 3),
+                    'max_rss': _max_rss(),
+                    'output': size}))
+    conn.close()
+
+
+def _after_fork():
+    """
+    Replace the locks & shared clients inherited from the parent process -
+    threads of the parent might have held them while it forked.
+    """
+    global LOCK
+    LOCK = threading.Lock()
+    connection.CLIENTS_LOCK = threading.Lock()
+    connection.CLIENTS = {}
+    connection.AUTH_CACHE = connection.AuthCache()
+    object_store.STORES_LOCK = threading.RLock()
+    object_store.STORES = {}
+
+
+class _Chunks(object):
+    """
+    Sends the output of a streamed run line by line to the parent process.
+    """
+
+    def __init__(self, conn, limit):
+        self.conn = conn
+        self.limit = limit
+        self.sent = 0
+        self.partial = ''
+
+    def write(self, data):
+        """
+        Send all complete lines.
+
+        :param data: Output written by the code.
+        """
+        if self.sent >= self.limit:
+            return
+        self.partial += data
+        if '\n' in self.partial:
+            text, self.partial = self.partial.rsplit('\n', 1)
+            self._send(text + '\n')
+
+    def flush(self):
+        """
+        Send what is left.
+        """
+        if self.partial != '':
+            self._send(self.partial)
+            self.partial = ''
+
+    def _send(self, text):
+        text = text[:self.limit - self.sent]
+        if text != '':
+            self.sent += len(text)
+            self.conn.send(('chunk', text))
+
+
+def _cpu_exceeded(signum, frame):
+    """
+    Signal handler for SIGXCPU - aborts the code being run.
+    """
+    raise LimitExceeded('CPU time limit exceeded.')
+
+
+def _cpu_time():
+    """
+    CPU seconds consumed by this process.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _limit_cpu(seconds):
+    """
+    Set the soft CPU limit of this process - None removes it.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        soft = hard
+    else:
+        soft = int(seconds) + 1
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _limit_memory(size):
+    """
+    Limit the address space of this process to its current size plus size
+    KB - RLIMIT_RSS is not enforced by Linux.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[0]) * resource.getpagesize()
+    except IOError:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    soft = current + size * 1024
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _truncate(out, err, size):
+    """
+    Truncate the output lines & errors to size characters each.
+    """
+    res = []
+    total = 0
+    for line in out:
+        if total + len(line) > size:
+            res.append(line[:size - total])
+            res.append('# output truncated after ' + str(size) +
+                       ' characters.')
+            break
+        total += len(line)
+        res.append(line)
+    if len(err) > size:
+        # the end of a traceback is the interesting part.
+        err = '... truncated.\n' + err[-size:]
+    return res, err
+
+
+def _max_rss():
+    """
+    Max. resident set size of this process in KB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
 class RWrapper(object):
     """
     Wrapper to use the R language...
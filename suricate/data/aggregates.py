@@ -0,0 +1,517 @@
+# coding=utf-8
+
+"""
+Incremental aggregations over windows of stream messages. Each message
+updates the aggregates in (amortized) constant time and the windows can be
+persisted between runs.
+"""
+
+__author__ = 'tmetsch'
+
+import collections
+import math
+
+# number of slots a sliding window is made of - values leave it a slot at a
+# time, so windows are accurate to size / SLOTS seconds.
+SLOTS = 100
+
+
+class Stats(object):
+    """
+    Running count, sum, mean & variance (Welford) - values can be removed
+    again.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        """
+        Add a value.
+
+        :param value: The value.
+        """
+        self.count += 1
+        self.sum += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        """
+        Remove a previously added value.
+
+        :param value: The value.
+        """
+        if self.count <= 1:
+            self.__init__()
+            return
+        self.count -= 1
+        self.sum -= value
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    def merge(self, other):
+        """
+        Add the values of another Stats (Chan et al.).
+
+        :param other: The other Stats.
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.sum += other.sum
+        self.count = count
+
+    def variance(self):
+        """
+        Return the (population) variance.
+        """
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
+
+
+class QuantileSketch(object):
+    """
+    Quantile sketch with a relative accuracy of alpha. Values are counted in
+    logarithmically sized bins so they can be added & removed in constant
+    time.
+    """
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = collections.defaultdict(int)
+        self.negative = collections.defaultdict(int)
+        self.zeros = 0
+        self.count = 0
+
+    def _key(self, value):
+        return int(math.ceil(math.log(abs(value), self.gamma)))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        """
+        Add a value.
+
+        :param value: The value.
+        :param count: Use a negative count to remove the value again.
+        """
+        self.count += count
+        if value > 0:
+            bins = self.positive
+        elif value < 0:
+            bins = self.negative
+        else:
+            self.zeros += count
+            return
+        key = self._key(value)
+        bins[key] += count
+        if bins[key] <= 0:
+            bins.pop(key)
+
+    def remove(self, value):
+        """
+        Remove a previously added value.
+
+        :param value: The value.
+        """
+        self.add(value, -1)
+
+    def merge(self, other, sign=1):
+        """
+        Add the counts of another sketch with the same alpha.
+
+        :param other: The other sketch.
+        :param sign: Use -1 to remove the other sketch's values again.
+        """
+        self.count += sign * other.count
+        self.zeros += sign * other.zeros
+        for bins, others in [(self.positive, other.positive),
+                             (self.negative, other.negative)]:
+            for key, count in others.items():
+                bins[key] += sign * count
+                if bins[key] <= 0:
+                    bins.pop(key)
+
+    def quantile(self, quantile):
+        """
+        Return the estimated quantile.
+
+        :param quantile: The quantile (between 0 and 1).
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def state(self):
+        """
+        Return the state of the sketch.
+        """
+        return {'alpha': self.alpha,
+                'positive': sorted(self.positive.items()),
+                'negative': sorted(self.negative.items()),
+                'zeros': self.zeros}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore a sketch.
+
+        :param state: The state as returned by state().
+        """
+        res = cls(state['alpha'])
+        res.positive.update((int(key), count)
+                            for key, count in state['positive'])
+        res.negative.update((int(key), count)
+                            for key, count in state['negative'])
+        res.zeros = state['zeros']
+        res.count = res.zeros + sum(res.positive.values()) + \
+            sum(res.negative.values())
+        return res
+
+
+class SlidingWindow(object):
+    """
+    Aggregates of the messages received during the last size seconds. The
+    window is made of up to slots sub-aggregates of size / slots seconds
+    each - values leave the window one slot at a time (once the slot's start
+    left it), so its state stays bounded however many messages it covers.
+    """
+
+    kind = 'sliding'
+
+    def __init__(self, size, quantiles=(0.5, 0.9, 0.99), alpha=0.01,
+                 slots=SLOTS):
+        self.size = size
+        self.quantiles = list(quantiles)
+        self.alpha = alpha
+        self.slots = slots
+        self.width = float(size) / slots
+        self.last = None
+        # time of the last message added - feeding resumes after it.
+        self.consumed = None
+        # the slots holding values - ordered by their index (start / width).
+        self.parts = []
+        self.sketch = QuantileSketch(alpha)
+
+    def add(self, when, value):
+        """
+        Add the value of a message.
+
+        :param when: Time the message was received.
+        :param value: The numeric value.
+        """
+        self.advance(when)
+        self.consumed = _later(self.consumed, when)
+        self._slot(int(math.floor(when / self.width))).add(value)
+        self.sketch.add(value)
+
+    def _slot(self, index):
+        """
+        Return the slot with the given index - messages rarely arrive out
+        of order so it is looked up from the newest slot backwards.
+        """
+        pos = len(self.parts)
+        while pos > 0 and self.parts[pos - 1].index >= index:
+            if self.parts[pos - 1].index == index:
+                return self.parts[pos - 1]
+            pos -= 1
+        slot = Slot(index, self.alpha)
+        self.parts.insert(pos, slot)
+        return slot
+
+    def advance(self, now):
+        """
+        Drop the slots which left the window.
+
+        :param now: The current time.
+        """
+        self.last = now if self.last is None else max(self.last, now)
+        cutoff = self.last - self.size
+        while len(self.parts) > 0 and \
+                self.parts[0].index * self.width <= cutoff:
+            self.sketch.merge(self.parts.pop(0).sketch, -1)
+
+    def result(self):
+        """
+        Return the aggregates of the window.
+
+        :return: Dict with count, sum, mean, variance, min, max & quantiles
+            (named like p50, p99).
+        """
+        stats = Stats()
+        for slot in self.parts:
+            stats.merge(slot.stats)
+        return _result(stats, self.sketch, self.quantiles,
+                       min([slot.min for slot in self.parts] or [None]),
+                       max([slot.max for slot in self.parts] or [None]))
+
+    def state(self):
+        """
+        Return the state of the window so it can be persisted.
+        """
+        return {'kind': self.kind,
+                'size': self.size,
+                'quantiles': self.quantiles,
+                'alpha': self.alpha,
+                'slots': self.slots,
+                'last': self.last,
+                'consumed': self.consumed,
+                'parts': [slot.state() for slot in self.parts]}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore a window.
+
+        :param state: The state as returned by state().
+        """
+        if 'values' in state:
+            # windows persisted with all their values.
+            res = cls(state['size'], state['quantiles'],
+                      state['sketch']['alpha'])
+            for when, value in state['values']:
+                res.add(when, value)
+        else:
+            res = cls(state['size'], state['quantiles'], state['alpha'],
+                      state['slots'])
+            for item in state['parts']:
+                slot = Slot.from_state(item)
+                res.parts.append(slot)
+                res.sketch.merge(slot.sketch)
+        res.last = state['last']
+        res.consumed = state.get('consumed')
+        return res
+
+
+class Slot(object):
+    """
+    Count, sum, mean, variance, min, max & quantile sketch of the values in
+    one slot of a sliding window.
+    """
+
+    def __init__(self, index, alpha=0.01):
+        self.index = index
+        self.stats = Stats()
+        self.sketch = QuantileSketch(alpha)
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Add a value.
+
+        :param value: The value.
+        """
+        self.stats.add(value)
+        self.sketch.add(value)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def state(self):
+        """
+        Return the state of the slot.
+        """
+        return {'index': self.index,
+                'stats': self.stats.__dict__.copy(),
+                'sketch': self.sketch.state(),
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore a slot.
+
+        :param state: The state as returned by state().
+        """
+        res = cls(state['index'])
+        res.stats.__dict__.update(state['stats'])
+        res.sketch = QuantileSketch.from_state(state['sketch'])
+        res.min = state['min']
+        res.max = state['max']
+        return res
+
+
+class TumblingWindow(object):
+    """
+    Aggregates of the messages received in consecutive, non-overlapping
+    windows of size seconds.
+    """
+
+    kind = 'tumbling'
+
+    def __init__(self, size, quantiles=(0.5, 0.9, 0.99), alpha=0.01):
+        self.size = size
+        self.quantiles = list(quantiles)
+        self.alpha = alpha
+        self.last = None
+        # time of the last message added - feeding resumes after it.
+        self.consumed = None
+        self.start = None
+        self.closed = None
+        self._reset()
+
+    def _reset(self):
+        self.stats = Stats()
+        self.sketch = QuantileSketch(self.alpha)
+        self.min = None
+        self.max = None
+
+    def add(self, when, value):
+        """
+        Add the value of a message.
+
+        :param when: Time the message was received.
+        :param value: The numeric value.
+        :return: Aggregates of the window closed by this message or None.
+        """
+        closed = self.advance(when)
+        self.consumed = _later(self.consumed, when)
+        self.stats.add(value)
+        self.sketch.add(value)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        return closed
+
+    def advance(self, now):
+        """
+        Close the current window if now is past its end.
+
+        :param now: The current time.
+        :return: Aggregates of the closed window or None.
+        """
+        self.last = now if self.last is None else max(self.last, now)
+        start = self.last - self.last % self.size
+        if self.start is None:
+            self.start = start
+        if start == self.start:
+            return None
+        self.closed = self.result()
+        self.start = start
+        self._reset()
+        return self.closed
+
+    def result(self):
+        """
+        Return the aggregates of the current window.
+
+        :return: Dict with start, count, sum, mean, variance, min, max &
+            quantiles.
+        """
+        res = _result(self.stats, self.sketch, self.quantiles, self.min,
+                      self.max)
+        res['start'] = self.start
+        return res
+
+    def state(self):
+        """
+        Return the state of the window so it can be persisted.
+        """
+        return {'kind': self.kind,
+                'size': self.size,
+                'quantiles': self.quantiles,
+                'last': self.last,
+                'consumed': self.consumed,
+                'start': self.start,
+                'closed': self.closed,
+                'stats': self.stats.__dict__.copy(),
+                'sketch': self.sketch.state(),
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore a window.
+
+        :param state: The state as returned by state().
+        """
+        res = cls(state['size'], state['quantiles'],
+                  state['sketch']['alpha'])
+        res.last = state['last']
+        res.consumed = state.get('consumed')
+        res.start = state['start']
+        res.closed = state['closed']
+        res.stats.__dict__.update(state['stats'])
+        res.sketch = QuantileSketch.from_state(state['sketch'])
+        res.min = state['min']
+        res.max = state['max']
+        return res
+
+
+WINDOWS = {'sliding': SlidingWindow, 'tumbling': TumblingWindow}
+
+
+def create(kind, size, quantiles=(0.5, 0.9, 0.99)):
+    """
+    Create a new window.
+
+    :param kind: sliding or tumbling.
+    :param size: Size of the window in seconds.
+    :param quantiles: The quantiles to estimate.
+    """
+    if kind not in WINDOWS:
+        raise AttributeError('Unknown window kind: ' + str(kind))
+    return WINDOWS[kind](size, quantiles)
+
+
+def from_state(state):
+    """
+    Restore a persisted window.
+
+    :param state: The state as returned by the window's state().
+    """
+    return WINDOWS[state['kind']].from_state(state)
+
+
+def _later(first, second):
+    """
+    Return the later of two times - first might be None.
+    """
+    return second if first is None else max(first, second)
+
+
+def _result(stats, sketch, quantiles, minimum, maximum):
+    """
+    Build the aggregates of a window.
+    """
+    return {'count': stats.count,
+            'sum': stats.sum,
+            'mean': stats.mean if stats.count > 0 else None,
+            'variance': stats.variance(),
+            'min': minimum,
+            'max': maximum,
+            'quantiles': dict((_name(q), sketch.quantile(q))
+                              for q in quantiles)}
+
+
+def _name(quantile):
+    """
+    Name of a quantile - e.g. p99 or p99_9 (MongoDB keys cannot hold dots).
+    """
+    return 'p' + ('%g' % (quantile * 100)).replace('.', '_')
@@ -0,0 +1,129 @@
+# coding=utf-8
+
+"""
+Columnar binary encoding for numeric data objects. Each column is stored as
+a contiguous little-endian array - a small header describes name, dtype,
+shape and position of the columns. Decoding does not copy the data.
+"""
+
+__author__ = 'tmetsch'
+
+import json
+import struct
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+MIME_TYPE = 'application/x-suricate-columnar'
+MAGIC = 'SURCOL1\n'
+ALIGN = 8
+
+
+def is_columnar(data):
+    """
+    Check if data can be encoded - a dict of numeric arrays/lists or a
+    numeric pandas DataFrame.
+
+    :param data: The data.
+    :return: True or False.
+    """
+    if pd is not None and isinstance(data, pd.DataFrame):
+        return len(data.columns) > 0 and \
+            all(dtype.kind in 'biuf' for dtype in data.dtypes)
+    if not isinstance(data, dict) or len(data) == 0:
+        return False
+    for val in data.values():
+        if not isinstance(val, (list, tuple, np.ndarray)):
+            return False
+        tmp = np.asarray(val)
+        if tmp.ndim == 0 or tmp.dtype.kind not in 'biuf':
+            return False
+    return True
+
+
+def encode(data):
+    """
+    Encode a dict of numeric arrays (or a DataFrame).
+
+    :param data: The data.
+    :return: Tuple with the encoded data and the column descriptions.
+    """
+    frame = pd is not None and isinstance(data, pd.DataFrame)
+    columns = []
+    arrays = []
+    offset = 0
+    for name in data:
+        arr = np.asarray(data[name])
+        arr = np.ascontiguousarray(arr,
+                                   dtype=arr.dtype.newbyteorder('<'))
+        columns.append({'name': name,
+                        'dtype': arr.dtype.str,
+                        'shape': list(arr.shape),
+                        'offset': offset})
+        arrays.append(arr)
+        offset += _pad(arr.nbytes)
+
+    header = json.dumps({'columns': columns, 'frame': frame})
+    start = _pad(len(MAGIC) + 4 + len(header))
+    buf = bytearray(start + offset)
+    buf[:len(MAGIC)] = MAGIC
+    buf[len(MAGIC):len(MAGIC) + 4] = struct.pack('<I', len(header))
+    buf[len(MAGIC) + 4:len(MAGIC) + 4 + len(header)] = header
+    for col, arr in zip(columns, arrays):
+        pos = start + col['offset']
+        buf[pos:pos + arr.nbytes] = arr.tostring()
+    return str(buf), columns
+
+
+def is_encoded(buf):
+    """
+    Check if a value was encoded by this module.
+
+    :param buf: The value.
+    :return: True or False.
+    """
+    return isinstance(buf, str) and buf.startswith(MAGIC)
+
+
+def decode(buf, as_frame=None):
+    """
+    Decode the data. The arrays are read-only views on the buffer.
+
+    :param buf: The encoded data.
+    :param as_frame: Return a DataFrame - if None a DataFrame is returned
+        when a DataFrame was encoded.
+    :return: Dict with arrays or a DataFrame.
+    """
+    if not is_encoded(buf):
+        raise ValueError('Not a columnar encoded value.')
+    length = struct.unpack('<I', buf[len(MAGIC):len(MAGIC) + 4])[0]
+    header = json.loads(buf[len(MAGIC) + 4:len(MAGIC) + 4 + length])
+    start = _pad(len(MAGIC) + 4 + length)
+
+    res = {}
+    for col in header['columns']:
+        shape = tuple(col['shape'])
+        arr = np.frombuffer(buf, dtype=np.dtype(str(col['dtype'])),
+                            count=int(np.prod(shape)),
+                            offset=start + col['offset'])
+        res[col['name']] = arr.reshape(shape)
+
+    if as_frame is None:
+        as_frame = header['frame']
+    if as_frame:
+        if pd is None:
+            raise ImportError('pandas is needed to return a DataFrame.')
+        names = [col['name'] for col in header['columns']]
+        return pd.DataFrame(res, columns=names, copy=False)
+    return res
+
+
+def _pad(size):
+    """
+    Round up to the next aligned size.
+    """
+    return (size + ALIGN - 1) // ALIGN * ALIGN
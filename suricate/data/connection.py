@@ -0,0 +1,147 @@
+# coding=utf-8
+
+"""
+Connection handling for the MongoDB backed stores & clients.
+"""
+
+__author__ = 'tmetsch'
+
+import contextlib
+import pymongo
+import threading
+import time
+
+from pymongo import errors
+
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(uri):
+    """
+    Return the process-wide MongoClient for an URI. All stores & clients
+    share it and therefore also share its connection pool.
+
+    :param uri: The MongoDB URI.
+    :return: Instance of MongoClient.
+    """
+    with CLIENTS_LOCK:
+        if uri not in CLIENTS:
+            CLIENTS[uri] = pymongo.MongoClient(uri)
+        return CLIENTS[uri]
+
+
+class AuthCache(object):
+    """
+    Caches authenticated database handles per tenant so not every operation
+    needs an extra authentication round-trip.
+    """
+
+    def __init__(self, ttl=300):
+        """
+        Initialize the cache.
+
+        :param ttl: Seconds an authenticated handle stays valid.
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_database(self, client, uid, token):
+        """
+        Return an authenticated database handle for a user.
+
+        :param client: The MongoClient to use.
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :return: The authenticated database.
+        """
+        key = (id(client), uid)
+        now = time.time()
+        stale = None
+        with self.lock:
+            if key in self.entries:
+                cached_token, database, expires = self.entries[key]
+                if cached_token == token and expires > now:
+                    self.hits += 1
+                    return database
+                stale = self.entries.pop(key)
+            self.misses += 1
+
+        database = client[uid]
+        if stale is not None and stale[0] != token:
+            # shared clients only allow one user per database.
+            database.logout()
+        database.authenticate(uid, token)
+
+        with self.lock:
+            self.entries[key] = (token, database, now + self.ttl)
+        return database
+
+    @contextlib.contextmanager
+    def database(self, client, uid, token):
+        """
+        Context manager handing out an authenticated database. If the
+        operations fail because of authentication/authorization problems
+        the cached handle is invalidated.
+
+        :param client: The MongoClient to use.
+        :param uid: User's uid.
+        :param token: Token of the user.
+        """
+        try:
+            yield self.get_database(client, uid, token)
+        except errors.OperationFailure as err:
+            if _is_auth_failure(err):
+                self.invalidate(client, uid)
+            raise
+
+    def invalidate(self, client, uid):
+        """
+        Drop the cached handle of a user.
+
+        :param client: The MongoClient the handle belongs to.
+        :param uid: User's uid.
+        """
+        with self.lock:
+            if self.entries.pop((id(client), uid), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop all cached handles.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Return the hit/miss counters.
+
+        :return: Dict with key/values.
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'size': len(self.entries)}
+
+
+def _is_auth_failure(err):
+    """
+    Check if an error was caused by a failed authentication/authorization.
+
+    :param err: The OperationFailure.
+    :return: True or False.
+    """
+    # 13: Unauthorized, 18: AuthenticationFailed
+    if err.code in (13, 18):
+        return True
+    return 'auth' in str(err).lower()
+
+
+# shared by all stores & clients in this process.
+AUTH_CACHE = AuthCache()
@@ -0,0 +1,126 @@
+# coding=utf-8
+
+"""
+Makes sure the indexes needed by the queries of Suricate exist.
+"""
+
+__author__ = 'tmetsch'
+
+import pymongo
+
+# collection name -> list of index keys.
+INDEXES = {'data_objects': [[('meta.tags', pymongo.ASCENDING)],
+                            [('meta.name', pymongo.ASCENDING)]],
+           'data_streams': [[('meta.tags', pymongo.ASCENDING)]],
+           'data_aggregates': [[('stream', pymongo.ASCENDING),
+                                ('name', pymongo.ASCENDING)]],
+           'data_jobs': [[('created', pymongo.DESCENDING)]],
+           'data_runs': [[('project', pymongo.ASCENDING),
+                          ('ntb_id', pymongo.ASCENDING)]],
+           'data_schedules': [[('next_run', pymongo.ASCENDING)]],
+           'data_triggers': [[('stream', pymongo.ASCENDING)]]}
+# indexes for the collections holding the messages of a stream.
+STREAM_INDEXES = [[('resv', pymongo.ASCENDING)]]
+# indexes for the collections holding the rollups of a stream.
+ROLLUP_INDEXES = [[('res', pymongo.ASCENDING), ('resv', pymongo.ASCENDING)]]
+# index used to expire messages & rollups of streams with a max_age.
+TTL_INDEX = [('ts', pymongo.ASCENDING)]
+
+
+def ensure_indexes(database):
+    """
+    Create the missing indexes of a tenant's database.
+
+    :param database: The database of the tenant.
+    """
+    for name, keys in _required(database):
+        if name.endswith('.rollups'):
+            # one rollup per resolution & time slot.
+            database[name].ensure_index(keys, unique=True)
+        else:
+            database[name].ensure_index(keys)
+
+
+def ensure_stream_indexes(database, iden, max_age=None):
+    """
+    Create the missing indexes for a stream.
+
+    :param database: The database of the tenant.
+    :param iden: Identifier of the stream.
+    :param max_age: If set messages & rollups older than max_age seconds
+        are expired through a TTL index.
+    """
+    for keys in STREAM_INDEXES:
+        database['data_streams.' + str(iden)].ensure_index(keys)
+    for keys in ROLLUP_INDEXES:
+        database['data_streams.' + str(iden) + '.rollups'].ensure_index(
+            keys, unique=True)
+    if max_age is not None:
+        for name in ['data_streams.' + str(iden),
+                     'data_streams.' + str(iden) + '.rollups']:
+            database[name].ensure_index(TTL_INDEX,
+                                        expireAfterSeconds=max_age)
+
+
+def audit(database, slow_ms=100, limit=10):
+    """
+    Report missing indexes and slow queries of a tenant. Slow queries are
+    only reported if profiling is enabled for the database.
+
+    :param database: The database of the tenant.
+    :param slow_ms: Queries taking longer than this are reported.
+    :param limit: Maximum number of slow queries to report.
+    :return: Dict with the missing indexes and the slow queries.
+    """
+    missing = []
+    for name, keys in _required(database):
+        info = database[name].index_information()
+        existing = [_normalize(item['key']) for item in info.values()]
+        if _normalize(keys) not in existing:
+            missing.append((name, keys))
+
+    slow = []
+    profile = database['system.profile']
+    for item in profile.find({'millis': {'$gte': slow_ms}},
+                             sort=[('millis', pymongo.DESCENDING)],
+                             limit=limit):
+        slow.append({'ns': item.get('ns'),
+                     'op': item.get('op'),
+                     'millis': item.get('millis'),
+                     'query': item.get('query', item.get('command'))})
+    return {'missing_indexes': missing, 'slow_queries': slow}
+
+
+def _required(database):
+    """
+    Return all indexes a tenant's database should have.
+
+    :param database: The database of the tenant.
+    :return: List of (collection name, index keys).
+    """
+    res = []
+    for name in sorted(INDEXES):
+        for keys in INDEXES[name]:
+            res.append((name, keys))
+    for obj in database['data_streams'].find(fields={'_id': True}):
+        for keys in STREAM_INDEXES:
+            res.append(('data_streams.' + str(obj['_id']), keys))
+        for keys in ROLLUP_INDEXES:
+            res.append(('data_streams.' + str(obj['_id']) + '.rollups',
+                        keys))
+    return res
+
+
+def _normalize(keys):
+    """
+    Normalize index keys so they can be compared.
+
+    :param keys: List of (field, direction).
+    """
+    res = []
+    for field, direction in keys:
+        if not isinstance(direction, basestring):
+            # Mongo might report directions as floats.
+            direction = int(direction)
+        res.append((str(field), direction))
+    return res
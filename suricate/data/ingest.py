@@ -0,0 +1,116 @@
+# coding=utf-8
+
+"""
+Ingest daemon - runs the stream consumers of a tenant outside of the web
+UI. Several daemons can share the streams of a tenant.
+"""
+
+__author__ = 'tmetsch'
+
+import hashlib
+import time
+
+from pymongo import errors
+
+from suricate.data import connection
+from suricate.data import streaming
+
+
+class IngestDaemon(object):
+    """
+    Watches the streams of a tenant and makes sure the messages of the
+    streams belonging to this shard are ingested & their triggers fired
+    (if the AMQP URI of the execution nodes is given).
+    """
+
+    def __init__(self, mongo_uri, uid, token, shard=0, shards=1,
+                 poll_interval=5.0, max_backoff=60.0, amqp_uri=None,
+                 usage_interval=60.0):
+        if not 0 <= shard < shards:
+            raise AttributeError('Shard needs to be between 0 and ' +
+                                 str(shards - 1))
+        self.client = connection.get_client(mongo_uri)
+        self.auth_cache = connection.AUTH_CACHE
+        self.uid = uid
+        self.token = token
+        self.shard = shard
+        self.shards = shards
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        # seconds between measurements of the storage used by the streams.
+        self.usage_interval = usage_interval
+        self.measured = 0
+        self.service = streaming.IngestService(mongo_uri,
+                                               amqp_uri=amqp_uri)
+        self.running = True
+
+    def owns(self, iden):
+        """
+        Check if a stream belongs to this shard.
+
+        :param iden: Identifier of the stream.
+        :return: True or False.
+        """
+        return int(hashlib.md5(iden).hexdigest(), 16) % self.shards == \
+            self.shard
+
+    def sync(self):
+        """
+        Start ingesting new streams, stop ingesting deleted ones, update the
+        triggers and report the stats (& every usage_interval the storage
+        used) of the ingested ones.
+        """
+        with self.auth_cache.database(self.client, self.uid,
+                                      self.token) as database:
+            collection = database['data_streams']
+            streams = {}
+            for obj in collection.find(fields={'uri': True, 'queue': True,
+                                               'storage': True}):
+                if self.owns(str(obj['_id'])):
+                    streams[str(obj['_id'])] = obj
+
+            for iden in self.service.stats():
+                if iden not in streams:
+                    self.service.remove_stream(iden)
+            for iden, obj in streams.items():
+                self.service.add_stream(self.uid, self.token, iden,
+                                        str(obj['uri']), str(obj['queue']),
+                                        obj.get('storage', 'raw'))
+
+            triggers = dict((iden, {}) for iden in streams)
+            for obj in database[streaming.TRIGGERS].find(
+                    {'stream': {'$in': streams.keys()}}):
+                triggers[obj['stream']][str(obj.pop('_id'))] = obj
+            for iden, items in triggers.items():
+                self.service.set_triggers(iden, items)
+
+            measure = time.time() - self.measured >= self.usage_interval
+            if measure:
+                self.measured = time.time()
+            for iden, stats in self.service.stats().items():
+                update = {'ingest': stats}
+                if measure:
+                    update['usage'] = streaming.storage_usage(database, iden)
+                collection.update({'_id': streams[iden]['_id']},
+                                  {'$set': update})
+
+    def run(self):
+        """
+        Sync periodically until stopped. If the database cannot be reached
+        the daemon backs off exponentially - the consumers keep running.
+        """
+        backoff = self.poll_interval
+        while self.running:
+            try:
+                self.sync()
+                backoff = self.poll_interval
+            except errors.PyMongoError:
+                backoff = min(backoff * 2, self.max_backoff)
+            time.sleep(backoff)
+        self.service.stop()
+
+    def stop(self):
+        """
+        Stop the daemon.
+        """
+        self.running = False
@@ -7,19 +7,73 @@ Wraps around object storage.
 __author__ = 'tmetsch'
 
 import bson
-import pymongo
+import codecs
+import collections
+import copy
+import gridfs
+import json
+import os
+import threading
+import time
 import uuid
 
+from bson import errors
+from urlparse import urlparse
 
-def get_object_stor():
+from suricate.data import connection
+
+STORES = {}
+STORES_LOCK = threading.RLock()
+
+# content larger than this is stored in chunks.
+BLOB_THRESHOLD = 1024 * 1024
+# size of the pieces large strings are checked in.
+CHUNK_SIZE = 64 * 1024
+# values of these types are shared - not copied - by the CachedStore.
+IMMUTABLE = (basestring, int, long, float, bool, type(None), bson.ObjectId)
+
+
+def get_object_stor(uri, cached=False):
     """
     Returns the right instance of a object storage interface object for an
-    given URI.
+    given URI. Instances are shared within the process - one per URI.
+
+    :param uri: URI of the store (mongodb://, file:// or memory:// - the
+        latter two do not check tokens so are meant for tests & single user
+        setups).
+    :param cached: If True the store is wrapped with a CachedStore.
+    :return: Instance of ObjectStore.
+    """
+    with STORES_LOCK:
+        if (uri, cached) in STORES:
+            return STORES[(uri, cached)]
+
+        if cached:
+            store = CachedStore(get_object_stor(uri))
+        else:
+            store = _create_store(uri)
+        STORES[(uri, cached)] = store
+        return store
+
+
+def _create_store(uri):
+    """
+    Create a new store for an URI.
 
+    :param uri: URI of the store.
     :return: Instance of ObjectStore.
     """
-    # TODO: implement
-    pass
+    scheme = urlparse(uri).scheme
+    if scheme == 'mongodb':
+        return MongoStore(uri)
+    elif scheme == 'file':
+        return FileStore(uri)
+    elif scheme == 'memory':
+        return MemoryStore()
+    elif scheme == 'cdmi':
+        raise AttributeError('CDMI object stores are not supported yet: ' +
+                             uri)
+    raise AttributeError('Unsupported object store URI: ' + uri)
 
 
 class ObjectStore(object):
@@ -27,16 +81,34 @@ class ObjectStore(object):
     Stores need to derive from this one.
     """
 
-    def list_objects(self, uid, token, query={}):
+    def list_objects(self, uid, token, query={}, limit=None, after=None,
+                     fields=None):
         """
-        List the objects of a user.
+        List the objects of a user - ordered by their ids.
 
         :param uid: User id.
         :param token: Access token.
         :param query: Optional query.
+        :param limit: Optional maximum number of objects to return.
+        :param after: Optional id - only objects with a greater id are
+            returned (keyset pagination).
+        :param fields: Optional list of meta data entries to return.
         """
         raise NotImplementedError('Needs to be implemented by subclass.')
 
+    def iter_objects(self, uid, token, query={}, fields=None):
+        """
+        Iterate over the objects of a user.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param fields: Optional list of meta data entries to return.
+        """
+        for item in self.list_objects(uid, token, query=query,
+                                      fields=fields):
+            yield item
+
     def create_object(self, uid, token, content):
         """
         Create an object for a user. Returns and id
@@ -57,7 +129,7 @@ class ObjectStore(object):
         """
         raise NotImplementedError('Needs to be implemented by subclass.')
 
-    def update_object(self, uid, token, obj_id, content):
+    def update_object(self, uid, token, obj_id, content, meta=None):
         """
         Add a object for a user.
 
@@ -65,6 +137,8 @@ class ObjectStore(object):
         :param obj_id: Identifier of the object.
         :param uid: User id.
         :param token: Access token.
+        :param meta: Optional meta data entries to set along with the
+            content - entries set to None are removed.
         """
         raise NotImplementedError('Needs to be implemented by subclass.')
 
@@ -78,10 +152,34 @@ class ObjectStore(object):
         """
         raise NotImplementedError('Needs to be implemented by subclass.')
 
+    def read_object(self, uid, token, obj_id, offset=0, length=None):
+        """
+        Read (a range of) the content of an object.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param offset: Position to start reading from.
+        :param length: Number of bytes to read - all if None.
+        """
+        tmp = self.retrieve_object(uid, token, obj_id)['value']
+        return _slice(tmp, offset, length)
+
+    def stream_object(self, uid, token, obj_id):
+        """
+        Return an iterator over the chunks of the content of an object.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        yield _as_text(self.retrieve_object(uid, token, obj_id)['value'])
+
 
 class MongoStore(ObjectStore):
     """
-    Object Storage based on Mongo.
+    Object Storage based on Mongo. Large objects are stored in chunks using
+    GridFS.
     """
 
     auth = False
@@ -90,7 +188,8 @@ class MongoStore(ObjectStore):
         """
         Setup a connection to the Mongo server.
         """
-        self.client = pymongo.MongoClient(uri)
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
 
     def info(self, uid, token):
         """
@@ -101,26 +200,538 @@ class MongoStore(ObjectStore):
         :return: Dict with key/values.
         """
         res = {}
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
-        res['number_of_objects'] = collection.count()
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            res['number_of_objects'] = collection.count()
+            return res
+
+    def list_objects(self, uid, token, query={}, limit=None, after=None,
+                     fields=None):
+        """
+        List the objects of a user - ordered by their ids.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param limit: Optional maximum number of objects to return.
+        :param after: Optional id - only objects with a greater id are
+            returned (keyset pagination).
+        :param fields: Optional list of meta data entries to return.
+        """
+        if after is not None:
+            query = dict(query, _id={'$gt': bson.ObjectId(after)})
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            res = []
+            for item in collection.find(query, fields=_projection(fields),
+                                        sort=[('_id', 1)],
+                                        limit=limit or 0):
+                res.append((str(item['_id']), item.get('meta', {})))
+            return res
+
+    def iter_objects(self, uid, token, query={}, fields=None):
+        """
+        Iterate over the objects of a user using a cursor - objects are
+        fetched in batches.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param fields: Optional list of meta data entries to return.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            cursor = database['data_objects'].find(
+                query, fields=_projection(fields), sort=[('_id', 1)])
+        for item in cursor:
+            yield str(item['_id']), item.get('meta', {})
+
+    def create_object(self, uid, token, content, meta=None):
+        """
+        Create an object for a user. Returns and id
+
+        :param content: Some content - large strings & file like objects
+            are streamed into chunks.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Some meta data.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            if meta is None:
+                meta = {'name': str(uuid.uuid4()),
+                        'mime-type': 'N/A',
+                        'tags': []}
+            tmp = _content(database, content)
+            tmp['meta'] = meta
+            obj_id = collection.insert(tmp)
+            return obj_id
+
+    def retrieve_object(self, uid, token, obj_id):
+        """
+        Add a object for a user.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            tmp = collection.find_one({'_id': bson.ObjectId(obj_id)})
+            tmp.pop('_id')
+            if 'blob' in tmp:
+                value = _blobs(database).get(tmp.pop('blob')).read()
+                if tmp.get('encoding') is not None:
+                    value = value.decode(tmp['encoding'])
+                tmp['value'] = value
+            return tmp
+
+    def read_object(self, uid, token, obj_id, offset=0, length=None):
+        """
+        Read (a range of) the content of an object. Only the needed chunks
+        are loaded for large objects.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param offset: Position to start reading from.
+        :param length: Number of bytes to read - all if None.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            tmp = collection.find_one({'_id': bson.ObjectId(obj_id)},
+                                      fields={'value': True, 'blob': True})
+            if 'blob' not in tmp:
+                return _slice(tmp['value'], offset, length)
+            blob = _blobs(database).get(tmp['blob'])
+            blob.seek(offset)
+            if length is None:
+                return blob.read()
+            return blob.read(length)
+
+    def stream_object(self, uid, token, obj_id):
+        """
+        Return an iterator over the chunks of the content of an object.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            tmp = collection.find_one({'_id': bson.ObjectId(obj_id)},
+                                      fields={'value': True, 'blob': True})
+            if 'blob' not in tmp:
+                blob = [_as_text(tmp['value'])]
+            else:
+                blob = _blobs(database).get(tmp['blob'])
+        for chunk in blob:
+            yield chunk
+
+    def update_object(self, uid, token, obj_id, content, meta=None):
+        """
+        Add a object for a user.
+
+        :param content: Some content.
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Optional meta data entries to set along with the
+            content - entries set to None are removed.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            tmp = _content(database, content)
+            if 'blob' in tmp:
+                upd = {'$set': tmp,
+                       '$unset': {'value': True}}
+            else:
+                upd = {'$set': tmp,
+                       '$unset': {'blob': True, 'length': True,
+                                  'encoding': True}}
+            for key, value in (meta or {}).items():
+                if value is None:
+                    upd['$unset']['meta.' + key] = True
+                else:
+                    upd['$set']['meta.' + key] = value
+            old = collection.find_and_modify({'_id': bson.ObjectId(obj_id)},
+                                             upd, upsert=False,
+                                             fields={'blob': True})
+            if old is not None and 'blob' in old:
+                _blobs(database).delete(old['blob'])
+
+    def delete_object(self, uid, token, obj_id):
+        """
+        Add a object for a user.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_objects']
+            old = collection.find_and_modify({'_id': bson.ObjectId(obj_id)},
+                                             remove=True,
+                                             fields={'blob': True})
+            if old is not None and 'blob' in old:
+                _blobs(database).delete(old['blob'])
+
+
+class CachedStore(ObjectStore):
+    """
+    Read-through cache which can be put in front of any ObjectStore. Keeps
+    the recently used objects in a size bounded LRU. Immutable values (e.g.
+    large strings & columnar buffers) are shared with the callers.
+    """
 
-    def list_objects(self, uid, token, query={}):
+    def __init__(self, store, max_bytes=64 * 1024 * 1024, ttl=60):
         """
-        List the objects of a user.
+        Wrap around a store.
+
+        :param store: The ObjectStore to cache.
+        :param max_bytes: Upper bound for the size of all cached objects.
+        :param ttl: Seconds a cached object is considered fresh.
+        """
+        self.store = store
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+        # number of reads in flight per object & how often it was
+        # invalidated meanwhile - so a value read before an update is not
+        # cached after it.
+        self.loading = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # everything not cached (e.g. info) is handled by the wrapped store.
+        return getattr(self.store, name)
+
+    def list_objects(self, uid, token, query={}, limit=None, after=None,
+                     fields=None):
+        """
+        List the objects of a user - ordered by their ids.
 
         :param uid: User id.
         :param token: Access token.
         :param query: Optional query.
+        :param limit: Optional maximum number of objects to return.
+        :param after: Optional id - only objects with a greater id are
+            returned (keyset pagination).
+        :param fields: Optional list of meta data entries to return.
+        """
+        return self.store.list_objects(uid, token, query=query, limit=limit,
+                                       after=after, fields=fields)
+
+    def iter_objects(self, uid, token, query={}, fields=None):
+        """
+        Iterate over the objects of a user.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param fields: Optional list of meta data entries to return.
+        """
+        return self.store.iter_objects(uid, token, query=query,
+                                       fields=fields)
+
+    def create_object(self, uid, token, content, meta=None):
+        """
+        Create an object for a user. Returns and id
+
+        :param content: Some content.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Some meta data.
+        """
+        return self.store.create_object(uid, token, content, meta=meta)
+
+    def retrieve_object(self, uid, token, obj_id):
+        """
+        Retrieve an object - from the cache if possible.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        key = (uid, str(obj_id))
+        with self.lock:
+            if key in self.entries:
+                cached_token, obj, size, expires = self.entries.pop(key)
+                if cached_token == token and expires > time.time():
+                    self.entries[key] = (cached_token, obj, size, expires)
+                    self.hits += 1
+                    return _copy(obj)
+                self.size -= size
+            self.misses += 1
+            self.loading[key] = self.loading.get(key, 0) + 1
+            generation = self.generations.get(key, 0)
+
+        try:
+            obj = self.store.retrieve_object(uid, token, obj_id)
+            self._add(key, token, obj, generation)
+        finally:
+            with self.lock:
+                self.loading[key] -= 1
+                if self.loading[key] == 0:
+                    self.loading.pop(key)
+                    self.generations.pop(key, None)
+        return obj
+
+    def read_object(self, uid, token, obj_id, offset=0, length=None):
+        """
+        Read (a range of) the content of an object - not cached.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param offset: Position to start reading from.
+        :param length: Number of bytes to read - all if None.
+        """
+        return self.store.read_object(uid, token, obj_id, offset, length)
+
+    def stream_object(self, uid, token, obj_id):
+        """
+        Return an iterator over the chunks of the content of an object - not
+        cached.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        return self.store.stream_object(uid, token, obj_id)
+
+    def update_object(self, uid, token, obj_id, content, meta=None):
+        """
+        Update an object and drop it from the cache.
+
+        :param content: Some content.
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Optional meta data entries to set along with the
+            content - entries set to None are removed.
+        """
+        try:
+            self.store.update_object(uid, token, obj_id, content, meta=meta)
+        finally:
+            self.invalidate(uid, obj_id)
+
+    def delete_object(self, uid, token, obj_id):
+        """
+        Delete an object and drop it from the cache.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        try:
+            self.store.delete_object(uid, token, obj_id)
+        finally:
+            self.invalidate(uid, obj_id)
+
+    def invalidate(self, uid, obj_id):
+        """
+        Remove an object from the cache.
+
+        :param uid: User id.
+        :param obj_id: Identifier of the object.
+        """
+        key = (uid, str(obj_id))
+        with self.lock:
+            if key in self.loading:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def stats(self):
+        """
+        Return counters to help sizing the cache.
+
+        :return: Dict with key/values.
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(self.hits) / total if total else 0.0,
+                    'evictions': self.evictions,
+                    'objects': len(self.entries),
+                    'bytes': self.size}
+
+    def _add(self, key, token, obj, generation):
+        """
+        Add an object to the cache and evict the least recently used ones if
+        needed. Skipped if the object was invalidated since it was read.
+        """
+        size = _size_of(obj)
+        if size > self.max_bytes:
+            return
+        obj = _copy(obj)
+        with self.lock:
+            if self.generations.get(key, 0) != generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            while self.entries and self.size + size > self.max_bytes:
+                _, entry = self.entries.popitem(last=False)
+                self.size -= entry[2]
+                self.evictions += 1
+            self.entries[key] = (token, obj, size, time.time() + self.ttl)
+            self.size += size
+
+
+class MemoryStore(ObjectStore):
+    """
+    Object Storage which keeps everything in memory - useful for testing &
+    caching. Does not check tokens - anybody knowing a uid can access its
+    objects, so do not use it for multi user setups.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def info(self, uid, token):
+        """
+        Return basic infos about the objects.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :return: Dict with key/values.
+        """
+        with self.lock:
+            return {'number_of_objects': len(self.objects.get(uid, {}))}
+
+    def list_objects(self, uid, token, query={}, limit=None, after=None,
+                     fields=None):
+        """
+        List the objects of a user - ordered by their ids.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param limit: Optional maximum number of objects to return.
+        :param after: Optional id - only objects with a greater id are
+            returned (keyset pagination).
+        :param fields: Optional list of meta data entries to return.
+        """
+        with self.lock:
+            objs = self.objects.get(uid, {})
+            res = [(obj_id, _select(copy.deepcopy(objs[obj_id]['meta']),
+                                    fields))
+                   for obj_id in _page(sorted(objs), after)
+                   if _matches(objs[obj_id], query)]
+            return res[:limit]
+
+    def create_object(self, uid, token, content, meta=None):
+        """
+        Create an object for a user. Returns and id
+
+        :param content: Some content.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Some meta data.
+        """
+        if meta is None:
+            meta = {'name': str(uuid.uuid4()),
+                    'mime-type': 'N/A',
+                    'tags': []}
+        obj_id = bson.ObjectId()
+        with self.lock:
+            self.objects.setdefault(uid, {})[str(obj_id)] = \
+                copy.deepcopy({'value': content, 'meta': meta})
+        return obj_id
+
+    def retrieve_object(self, uid, token, obj_id):
+        """
+        Add a object for a user.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        with self.lock:
+            return copy.deepcopy(self.objects[uid][str(obj_id)])
+
+    def update_object(self, uid, token, obj_id, content, meta=None):
+        """
+        Add a object for a user.
+
+        :param content: Some content.
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        :param meta: Optional meta data entries to set along with the
+            content - entries set to None are removed.
+        """
+        with self.lock:
+            tmp = self.objects[uid][str(obj_id)]
+            tmp['value'] = copy.deepcopy(content)
+            _merge_meta(tmp['meta'], copy.deepcopy(meta))
+
+    def delete_object(self, uid, token, obj_id):
+        """
+        Add a object for a user.
+
+        :param obj_id: Identifier of the object.
+        :param uid: User id.
+        :param token: Access token.
+        """
+        with self.lock:
+            self.objects.get(uid, {}).pop(str(obj_id), None)
+
+
+class FileStore(ObjectStore):
+    """
+    Object Storage based on a local directory - one JSON file per object.
+    Like the MemoryStore it does not check tokens - only meant for tests &
+    single user setups.
+    """
+
+    def __init__(self, uri):
+        """
+        Setup the root directory.
+
+        :param uri: URI like file:///var/lib/suricate.
+        """
+        self.root = urlparse(uri).path
+
+    def info(self, uid, token):
+        """
+        Return basic infos about the objects.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :return: Dict with key/values.
+        """
+        return {'number_of_objects': len(self._list(uid))}
+
+    def list_objects(self, uid, token, query={}, limit=None, after=None,
+                     fields=None):
+        """
+        List the objects of a user - ordered by their ids.
+
+        :param uid: User id.
+        :param token: Access token.
+        :param query: Optional query.
+        :param limit: Optional maximum number of objects to return.
+        :param after: Optional id - only objects with a greater id are
+            returned (keyset pagination).
+        :param fields: Optional list of meta data entries to return.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
         res = []
-        for item in collection.find(query):
-            res.append((str(item['_id']), item['meta']))
+        for obj_id in _page(self._list(uid), after):
+            if limit is not None and len(res) >= limit:
+                break
+            tmp = self.retrieve_object(uid, token, obj_id)
+            if _matches(tmp, query):
+                res.append((obj_id, _select(tmp['meta'], fields)))
         return res
 
     def create_object(self, uid, token, content, meta=None):
@@ -132,15 +743,12 @@ class MongoStore(ObjectStore):
         :param token: Access token.
         :param meta: Some meta data.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
         if meta is None:
             meta = {'name': str(uuid.uuid4()),
                     'mime-type': 'N/A',
                     'tags': []}
-        tmp = {'value': content, 'meta': meta}
-        obj_id = collection.insert(tmp)
+        obj_id = bson.ObjectId()
+        self._write(uid, obj_id, {'value': content, 'meta': meta})
         return obj_id
 
     def retrieve_object(self, uid, token, obj_id):
@@ -151,14 +759,10 @@ class MongoStore(ObjectStore):
         :param uid: User id.
         :param token: Access token.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
-        tmp = collection.find_one({'_id': bson.ObjectId(obj_id)})
-        tmp.pop('_id')
-        return tmp
+        with open(self._path(uid, obj_id)) as tmp:
+            return json.load(tmp)
 
-    def update_object(self, uid, token, obj_id, content):
+    def update_object(self, uid, token, obj_id, content, meta=None):
         """
         Add a object for a user.
 
@@ -166,12 +770,13 @@ class MongoStore(ObjectStore):
         :param obj_id: Identifier of the object.
         :param uid: User id.
         :param token: Access token.
+        :param meta: Optional meta data entries to set along with the
+            content - entries set to None are removed.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
-        collection.update({'_id': bson.ObjectId(obj_id)},
-                          {"$set": {'value': content}}, upsert=False)
+        tmp = self.retrieve_object(uid, token, obj_id)
+        tmp['value'] = content
+        _merge_meta(tmp['meta'], meta)
+        self._write(uid, obj_id, tmp)
 
     def delete_object(self, uid, token, obj_id):
         """
@@ -181,10 +786,42 @@ class MongoStore(ObjectStore):
         :param uid: User id.
         :param token: Access token.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_objects']
-        collection.remove({'_id': bson.ObjectId(obj_id)})
+        os.remove(self._path(uid, obj_id))
+
+    def _list(self, uid):
+        """
+        List the identifiers of the objects of a user.
+        """
+        directory = self._path(uid)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(item[:-5] for item in os.listdir(directory)
+                      if item.endswith('.json'))
+
+    def _write(self, uid, obj_id, obj):
+        """
+        Write an object - goes through a temp file so readers never see
+        partial objects.
+        """
+        directory = self._path(uid)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = self._path(uid, obj_id)
+        with open(path + '.tmp', 'w') as tmp:
+            json.dump(obj, tmp)
+        os.rename(path + '.tmp', path)
+
+    def _path(self, uid, obj_id=None):
+        """
+        Return the path to a user's directory or object.
+        """
+        if os.path.basename(uid) != uid or uid in ('', '.', '..'):
+            raise AttributeError('Invalid user id: ' + uid)
+        if obj_id is None:
+            return os.path.join(self.root, uid)
+        # raises an error for anything which is not an ObjectId.
+        obj_id = str(bson.ObjectId(obj_id))
+        return os.path.join(self.root, uid, obj_id + '.json')
 
 
 class CDMIStore(ObjectStore):
@@ -193,4 +830,203 @@ class CDMIStore(ObjectStore):
     Service.
     """
 
-    pass
+    def __init__(self, uri):
+        self.uri = uri
+
+
+def _size_of(obj):
+    """
+    Estimate the size of an object in bytes.
+
+    :param obj: The object as returned by a store.
+    :return: Number of bytes.
+    """
+    try:
+        return len(bson.BSON.encode(obj))
+    except (errors.InvalidDocument, TypeError):
+        return len(repr(obj))
+
+
+def _copy(obj):
+    """
+    Copy an object as returned by a store - immutable values are shared.
+
+    :param obj: The object.
+    :return: The copy.
+    """
+    res = {}
+    for key, val in obj.items():
+        res[key] = val if isinstance(val, IMMUTABLE) else copy.deepcopy(val)
+    return res
+
+
+def _content(database, content):
+    """
+    Return the fields holding the content of an object - content larger
+    than BLOB_THRESHOLD is stored in chunks. Small uploads are stored as
+    binary value.
+
+    :param database: The database of the user.
+    :param content: The content - file like objects are read.
+    :return: Dict with the fields.
+    """
+    if hasattr(content, 'read'):
+        head = content.read(BLOB_THRESHOLD + 1)
+        if len(head) <= BLOB_THRESHOLD:
+            return {'value': bson.Binary(head)}
+        return _put_blob(database, head, rest=content)
+    if isinstance(content, basestring) and len(content) > BLOB_THRESHOLD:
+        return _put_blob(database, content)
+    return {'value': content}
+
+
+def _blobs(database):
+    """
+    Return the GridFS used for large objects.
+
+    :param database: The database of the user.
+    :return: GridFS instance.
+    """
+    return gridfs.GridFS(database, collection='data_blobs')
+
+
+def _put_blob(database, content, rest=None):
+    """
+    Store content in chunks. Text is returned as unicode on retrieval - like
+    for content stored in the document.
+
+    :param database: The database of the user.
+    :param content: String.
+    :param rest: Optional file like object with more (binary) content - it
+        is read chunk by chunk.
+    :return: Dict with the fields referencing the chunks.
+    """
+    encoding = None
+    if isinstance(content, unicode):
+        encoding = 'utf-8'
+        content = content.encode(encoding)
+    elif rest is None and not isinstance(content, bson.Binary) and \
+            _is_utf8(content):
+        encoding = 'utf-8'
+    blob = _blobs(database).new_file()
+    blob.write(content)
+    if rest is not None:
+        blob.write(rest)
+    blob.close()
+    return {'blob': blob._id, 'length': blob.length, 'encoding': encoding}
+
+
+def _is_utf8(value):
+    """
+    Check if a string is valid UTF-8 - piece by piece to save memory.
+
+    :param value: The string.
+    :return: True or False.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for pos in xrange(0, len(value), CHUNK_SIZE):
+            decoder.decode(value[pos:pos + CHUNK_SIZE])
+        decoder.decode('', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _as_text(value):
+    """
+    Return structured values as JSON - strings are returned as they are.
+
+    :param value: The value.
+    """
+    if isinstance(value, basestring):
+        return value
+    return json.dumps(value, default=str)
+
+
+def _slice(value, offset, length):
+    """
+    Return a range of the bytes of a value - text is UTF-8 encoded so the
+    offsets match the ones of objects stored as blobs.
+
+    :param value: The value.
+    :param offset: Position to start from.
+    :param length: Number of bytes - all if None.
+    """
+    value = _as_text(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if length is None:
+        return value[offset:]
+    return value[offset:offset + length]
+
+
+def _projection(fields):
+    """
+    Return the Mongo projection for a list of meta data entries.
+
+    :param fields: List of meta data entries - all if None.
+    """
+    if fields is None:
+        return {'meta': True}
+    elif len(fields) == 0:
+        return {'_id': True}
+    return dict(('meta.' + item, True) for item in fields)
+
+
+def _select(meta, fields):
+    """
+    Return only the selected meta data entries.
+
+    :param meta: The meta data.
+    :param fields: List of meta data entries - all if None.
+    """
+    if fields is None:
+        return meta
+    return dict((key, meta[key]) for key in fields if key in meta)
+
+
+def _page(idens, after):
+    """
+    Return the (sorted) identifiers after a given one.
+
+    :param idens: Sorted list of identifiers.
+    :param after: The identifier to start after - all if None.
+    """
+    if after is None:
+        return idens
+    return [iden for iden in idens if iden > str(after)]
+
+
+def _merge_meta(old, meta):
+    """
+    Set the entries of meta on the old meta data - None removes an entry.
+
+    :param old: The meta data of an object.
+    :param meta: The entries to set - can be None.
+    """
+    for key, value in (meta or {}).items():
+        if value is None:
+            old.pop(key, None)
+        else:
+            old[key] = value
+
+
+def _matches(obj, query):
+    """
+    Check if an object matches a simple query - supports equality checks on
+    (dotted) keys. Lists match if they contain the value.
+
+    :param obj: The object.
+    :param query: Query like {'meta.tags': 'foo'}.
+    :return: True or False.
+    """
+    for key, val in query.items():
+        tmp = obj
+        for item in key.split('.'):
+            if not isinstance(tmp, dict) or item not in tmp:
+                return False
+            tmp = tmp[item]
+        if tmp != val and not (isinstance(tmp, list) and val in tmp):
+            return False
+    return True
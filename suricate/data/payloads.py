@@ -0,0 +1,153 @@
+# coding=utf-8
+
+"""
+Decoding of stream message payloads. Messages are decoded once at ingest
+based on their AMQP content type & encoding.
+"""
+
+__author__ = 'tmetsch'
+
+import bson
+import json
+import zlib
+
+from bson import binary
+from bson import errors
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_TYPES = ('application/json', 'text/json')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+# header marking messages which carry a list of samples.
+BATCH_HEADER = 'x-batch'
+# max. size of a decompressed payload in bytes - larger ones could not be
+# stored as a document anyway.
+MAX_SIZE = 16 * 1024 * 1024
+
+
+def decode(body, content_type=None, content_encoding=None, batch=False):
+    """
+    Decode the payload of a message. Structured payloads which can't be
+    stored as documents (e.g. keys with dots) are rejected.
+
+    :param body: The raw body.
+    :param content_type: AMQP content type.
+    :param content_encoding: AMQP content encoding (gzip, deflate, zstd).
+    :param batch: If True the payload holds a list of samples.
+    :return: List of decoded samples.
+    :raises ValueError: If the payload can't be decoded or stored.
+    """
+    body = decompress(body, content_encoding)
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in JSON_TYPES + MSGPACK_TYPES:
+        if content_type in MSGPACK_TYPES and msgpack is None:
+            raise ValueError('msgpack is needed to decode ' + content_type)
+        try:
+            if content_type in JSON_TYPES:
+                value = json.loads(body)
+            else:
+                value = msgpack.unpackb(body)
+        except Exception as err:
+            raise ValueError('Invalid ' + content_type + ' payload: ' +
+                             str(err))
+        check_storable(value)
+    else:
+        value = as_text(body)
+
+    if batch:
+        if not isinstance(value, list):
+            raise ValueError('Batched messages need to hold a list.')
+        return value
+    return [value]
+
+
+def check_storable(value):
+    """
+    Make sure a decoded payload can be stored as the body of a message.
+
+    :param value: The decoded payload.
+    :raises ValueError: If it can't be stored.
+    """
+    try:
+        bson.BSON.encode({'body': value}, check_keys=True)
+    except errors.BSONError as err:
+        raise ValueError('Payload can not be stored: ' + str(err))
+
+
+def decompress(body, content_encoding):
+    """
+    Decompress a payload.
+
+    :param body: The compressed body.
+    :param content_encoding: gzip, deflate/zlib, zstd or None.
+    :return: The decompressed body.
+    :raises ValueError: If it is broken or larger than MAX_SIZE bytes.
+    """
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity', 'utf-8', 'utf8'):
+        return body
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            return _inflate(body, 16 + zlib.MAX_WBITS)
+        if encoding in ('deflate', 'zlib'):
+            return _inflate(body, zlib.MAX_WBITS)
+    except zlib.error as err:
+        raise ValueError(str(err))
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstandard is needed to decode zstd payloads.')
+        try:
+            if zstandard.frame_content_size(body) <= MAX_SIZE:
+                # also bounds frames without a content size (-1).
+                return zstandard.ZstdDecompressor().decompress(
+                    body, max_output_size=MAX_SIZE)
+        except Exception as err:
+            raise ValueError('Invalid zstd payload: ' + str(err))
+        raise ValueError(_too_large())
+    raise ValueError('Unknown content encoding: ' + encoding)
+
+
+def _inflate(body, wbits):
+    """
+    Decompress a zlib or gzip stream - stops once the output exceeds
+    MAX_SIZE bytes.
+    """
+    tmp = zlib.decompressobj(wbits)
+    # the extra byte only ends up in unused_data if the stream is complete.
+    res = tmp.decompress(body + '\0', MAX_SIZE + 1)
+    if len(res) > MAX_SIZE:
+        raise ValueError(_too_large())
+    if tmp.unused_data == '':
+        raise ValueError('Incomplete or truncated stream.')
+    return res
+
+
+def _too_large():
+    """
+    Error message for payloads exceeding MAX_SIZE.
+    """
+    return 'Decompressed payload exceeds ' + str(MAX_SIZE) + ' bytes.'
+
+
+def as_text(body):
+    """
+    Return the body as text - binary payloads are wrapped so they can be
+    stored.
+
+    :param body: The body.
+    """
+    if isinstance(body, unicode):
+        return body
+    try:
+        body.decode('utf-8')
+        return body
+    except UnicodeDecodeError:
+        return binary.Binary(body)
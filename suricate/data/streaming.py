@@ -7,11 +7,42 @@ Supports Data streams through services like AMQP.
 __author__ = 'tmetsch'
 
 import bson
+import collections
+import datetime
+import json
 import pika
-import pymongo
+import pika.exceptions
+import Queue
 import threading
 import time
 
+from pymongo import errors
+from suricate.data import aggregates
+from suricate.data import connection
+from suricate.data import indexes
+from suricate.data import payloads
+
+# seconds of messages packed into one document for bucketed storage.
+BUCKET_SIZE = 60
+# max. number of messages per bucket document - busier buckets continue in
+# a new document (with the same resv) to stay below the 16MB document limit.
+MAX_PER_BUCKET = 1000
+# resolutions (in seconds) for which rollups of numeric messages are kept.
+RESOLUTIONS = (1, 60)
+# supported retention policies.
+RETENTION_KEYS = ('max_age', 'max_bytes', 'max_docs')
+# number of latest messages kept on the stream's document.
+LATEST_SIZE = 20
+# block compressors MongoDB can use to store messages compressed at rest.
+COMPRESSORS = ('snappy', 'zlib', 'zstd')
+# errors on storing messages after which they are redelivered - batches
+# failing otherwise are rejected without requeueing (dead-lettered).
+TRANSIENT_ERRORS = (errors.ConnectionFailure, IOError)
+# collection holding the triggers which run notebooks on new messages.
+TRIGGERS = 'data_triggers'
+# conditions a trigger can have on the (numeric) messages.
+CONDITIONS = ('above', 'below')
+
 
 class StreamClient(object):
     """
@@ -22,7 +53,8 @@ class StreamClient(object):
         """
         Initialize StreamingClient.
         """
-        self.client = pymongo.MongoClient(uri)
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
 
     def list_streams(self, uid, token, query={}):
         """
@@ -33,37 +65,202 @@ class StreamClient(object):
         :param query: Optional query.
         :return: List of identifiers.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        res = []
-        for obj in collection.find(query):
-            res.append(str(obj['_id']))
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            res = []
+            for obj in collection.find(query):
+                res.append(str(obj['_id']))
+            return res
 
-    def get_messages(self, uid, token, interval, iden):
+    def get_messages(self, uid, token, interval, iden, resolution=None,
+                     limit=None, order=1, query=None, count_only=False):
         """
-        Retrieve list of messages.
+        Retrieve messages. If a resolution is given the rollups (count,
+        min, max & mean) of the numeric messages are returned instead.
 
         :param uid: User's uid.
         :param token: Token of the user.
         :param interval: Intervall to get messages from.
         :param iden: Identifier for the stream
-        :return: List of messages.
+        :param resolution: Optional resolution in seconds (see RESOLUTIONS).
+        :param limit: Maximum number of messages.
+        :param order: 1 for oldest first, -1 for latest first.
+        :param query: Filter on the body of the messages.
+        :param count_only: Only return the number of messages.
+        :return: Lazy cursor over the messages (or the number of messages).
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            begin = time.time() - interval
+            end = time.time()
+
+            if resolution is not None:
+                return _get_rollups(database, iden, begin, end, resolution)
+            return _get_messages(database, iden, begin, end, limit=limit,
+                                 order=order, query=query,
+                                 count_only=count_only)
+
+    def tail(self, uid, token, iden, since=None, batch_size=100,
+             timeout=None, max_wait=2.0):
+        """
+        Generator yielding batches of new messages as they arrive. While
+        idle the stream is polled with a growing interval (capped streams
+        are followed with a tailable cursor instead).
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier for the stream
+        :param since: Only messages received after this time (in seconds
+            since the epoch) are returned - defaults to now.
+        :param batch_size: Maximum number of messages per batch.
+        :param timeout: Stop after this many seconds without new messages.
+        :param max_wait: Maximum seconds between polls.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            stream = database['data_streams'].find_one(
+                {'_id': bson.ObjectId(iden)},
+                fields={'storage': True, 'retention': True})
+            if stream is None:
+                raise AttributeError('Unknown stream: ' + str(iden))
+            position = StreamTail(database, iden,
+                                  stream.get('storage', 'raw'),
+                                  'max_bytes' in stream.get('retention', {}),
+                                  time.time() if since is None else since)
+
+            wait = min(0.1, max_wait)
+            idle = time.time()
+            while True:
+                batch = position.fetch(batch_size)
+                if len(batch) > 0:
+                    wait = min(0.1, max_wait)
+                    idle = time.time()
+                    for i in range(0, len(batch), batch_size):
+                        yield batch[i:i + batch_size]
+                    continue
+                if timeout is not None and time.time() - idle >= timeout:
+                    return
+                time.sleep(wait)
+                wait = min(wait * 2, max_wait)
+
+    def latest(self, uid, token, iden, num=1):
+        """
+        Retrieve the latest messages of a stream.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier for the stream
+        :param num: Number of messages - up to LATEST_SIZE are served from
+            the stream's document.
+        :return: List of dicts with time & body - latest first.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        begin = time.time() - interval
-        end = time.time()
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return _get_latest(database, iden, num)
 
-        collection = database['data_streams.' + str(iden)]
-        items = collection.aggregate([
-            {"$match": {"resv": {"$gt": begin, "$lte": end}}},
-            {"$project": {"_id": 0, "body": 1}},
-            {"$sort": {"resv": 1}}
-        ])['result']
+    def load_window(self, uid, token, iden, name):
+        """
+        Load a persisted window of aggregates.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier for the stream
+        :param name: Name of the window.
+        :return: The window (see aggregates module) or None.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            tmp = database['data_aggregates'].find_one({'stream': iden,
+                                                        'name': name})
+            if tmp is None:
+                return None
+            return aggregates.from_state(tmp['state'])
+
+    def save_window(self, uid, token, iden, name, window):
+        """
+        Persist a window of aggregates.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier for the stream
+        :param name: Name of the window.
+        :param window: The window.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database['data_aggregates'].update({'stream': iden,
+                                                'name': name},
+                                               {'$set': {'state':
+                                                         window.state()}},
+                                               upsert=True)
+
+
+class StreamTail(object):
+    """
+    Remembers the position in a stream and fetches the messages after it.
+    """
 
-        return list(items)
+    def __init__(self, database, iden, storage, capped, since):
+        self.collection = database['data_streams.' + str(iden)]
+        self.storage = storage
+        self.capped = capped
+        self.last = since
+        self.last_id = None
+        self.cursor = None
+
+    def fetch(self, limit):
+        """
+        Return the messages after the current position and move on.
+
+        :param limit: Maximum number of messages (not applied to bucketed
+            streams as their messages have no identifier to resume on).
+        :return: List of dicts with time & body.
+        """
+        if self.storage == 'bucket':
+            res = self._fetch_buckets()
+        elif self.capped:
+            res = self._fetch_tailable(limit)
+        else:
+            res = self._fetch_raw(limit)
+        if len(res) > 0:
+            self.last = res[-1]['time']
+        return res
+
+    def _fetch_raw(self, limit):
+        query = {'resv': {'$gt': self.last}}
+        if self.last_id is not None:
+            # messages can share a timestamp - resume on their ids.
+            query = {'$or': [query, {'resv': self.last,
+                                     '_id': {'$gt': self.last_id}}]}
+        res = []
+        for item in self.collection.find(query,
+                                         fields={'resv': True, 'body': True},
+                                         sort=[('resv', 1), ('_id', 1)],
+                                         limit=limit):
+            res.append({'time': item['resv'], 'body': item['body']})
+            self.last_id = item['_id']
+        return res
+
+    def _fetch_tailable(self, limit):
+        if self.cursor is None or not self.cursor.alive:
+            # capped collections keep the insertion (= time) order.
+            self.cursor = self.collection.find(
+                {'resv': {'$gt': self.last}},
+                fields={'resv': True, 'body': True}, tailable=True,
+                await_data=True)
+        res = []
+        while len(res) < limit:
+            try:
+                item = self.cursor.next()
+            except StopIteration:
+                break
+            res.append({'time': item['resv'], 'body': item['body']})
+        return res
+
+    def _fetch_buckets(self):
+        return list(self.collection.aggregate([
+            {"$match": {"resv": {"$gt": self.last - BUCKET_SIZE}}},
+            {"$unwind": "$msgs"},
+            {"$match": {"msgs.resv": {"$gt": self.last}}},
+            {"$project": {"_id": 0, "time": "$msgs.resv",
+                          "body": "$msgs.body"}},
+            {"$sort": {"time": 1}}
+        ], cursor={}))
 
 
 class AMQPClient(object):
@@ -72,8 +269,8 @@ class AMQPClient(object):
     """
 
     def __init__(self, uri):
-        self.client = pymongo.MongoClient(uri)
-        self.cache = {}
+        self.client = connection.get_client(uri)
+        self.auth_cache = connection.AUTH_CACHE
         self.uri = uri
 
     def info(self, uid, token):
@@ -85,86 +282,143 @@ class AMQPClient(object):
         :return: Dict with key/values.
         """
         res = {}
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        res['number_of_streams'] = collection.count()
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            res['number_of_streams'] = collection.count()
+            total = 0
+            for obj in collection.find(fields={'retention': True,
+                                               'ingest': True,
+                                               'usage': True}):
+                iden = str(obj['_id'])
+                retention = _describe(obj.get('retention', {}))
+                if 'usage' in obj:
+                    # measured by the ingest daemon.
+                    usage = obj['usage']
+                    total += usage['size']
+                    res['stream ' + iden] = '%d bytes in %d msgs (%s)' % \
+                        (usage['size'], usage['count'], retention)
+                else:
+                    res['stream ' + iden] = 'not measured yet (%s)' % \
+                        retention
+                if 'ingest' in obj:
+                    # reported by the ingest daemon.
+                    stats = obj['ingest']
+                    res['ingest ' + iden] = '%.1f msgs/sec, lag %.1f sec' % \
+                        (stats['msgs_per_sec'], stats['lag'])
+            res['size_of_streams'] = total
+            return res
 
     def list_streams(self, uid, token):
         """
-        List available streams. Make sure AMQP clients are up & running.
+        List available streams.
 
         :param uid: User's uid.
         :param token: Token of the user.
         :return: List of ids.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        res = []
-        for obj in collection.find():
-            tmp = {'iden': str(obj['_id']), 'meta': obj['meta']}
-            if str(obj['_id']) not in self.cache:
-                iden = str(obj['_id'])
-                content = collection.find_one({'_id': bson.ObjectId(iden)})
-                uri = content['uri']
-                queue = content['queue']
-                self.cache[iden] = StreamConsumer(uid, token, iden,
-                                                  self.uri, str(uri),
-                                                  str(queue))
-                self.cache[iden].start()
-            res.append(tmp)
-        return res
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            res = []
+            for obj in collection.find(fields={'meta': True}):
+                tmp = {'iden': str(obj['_id']), 'meta': obj['meta']}
+                res.append(tmp)
+            return res
 
-    def create(self, uid, token, uri, queue):
+    def create(self, uid, token, uri, queue, storage='raw', retention=None,
+               compression=None):
         """
         Create a new stream.
 
+        The retention policy can hold a max_age (in seconds) - older
+        messages & rollups are expired using a TTL index - or a max_bytes &
+        max_docs limit - messages are then kept in a capped collection.
+
+        Messages are decoded at ingest based on their content type (JSON,
+        msgpack) & encoding (gzip, deflate, zstd). Messages with an x-batch
+        header carry a list of samples which are stored individually.
+
         :param uid: User's uid.
         :param token: Token of the user.
         :param uri: URI of the RabbitMQ server.
         :param queue: Queue name
+        :param storage: 'raw' stores a document per message, 'bucket' packs
+            the messages in documents per BUCKET_SIZE seconds.
+        :param retention: Optional dict with the retention policy.
+        :param compression: Optional block compressor (see COMPRESSORS) used
+            by MongoDB to store the messages compressed at rest.
         :return: Identifier.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        tmp = {'uri': uri, 'queue': queue, 'meta': {'name': 'N/A',
-                                                    'mime-type': 'rabbitmq',
-                                                    'tags': []}}
-        obj_id = collection.insert(tmp)
-        return obj_id
+        if storage not in ('raw', 'bucket'):
+            raise AttributeError('Unknown storage mode: ' + str(storage))
+        if compression is not None and compression not in COMPRESSORS:
+            raise AttributeError('Unknown compression: ' + str(compression))
+        retention = _check_retention(retention or {}, storage)
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            tmp = {'uri': uri, 'queue': queue, 'storage': storage,
+                   'retention': retention, 'compression': compression,
+                   'meta': {'name': 'N/A',
+                            'mime-type': 'rabbitmq',
+                            'tags': []}}
+            obj_id = collection.insert(tmp)
+            options = {}
+            if 'max_bytes' in retention:
+                options.update(capped=True, size=retention['max_bytes'],
+                               max=retention.get('max_docs'))
+            if compression is not None:
+                options['storageEngine'] = {'wiredTiger': {
+                    'configString': 'block_compressor=' + compression}}
+            if len(options) > 0:
+                database.create_collection('data_streams.' + str(obj_id),
+                                           **options)
+            indexes.ensure_stream_indexes(database, obj_id,
+                                          retention.get('max_age'))
+            return obj_id
 
-    def retrieve(self, uid, token, iden):
+    def retrieve(self, uid, token, iden, limit=None, order=1, query=None,
+                 count_only=False):
         """
         Retrieve a stream.
 
         :param uid: User's uid.
         :param token: Token of the user.
         :param iden: Identifier of the stream
-        :return: URI, Queue name and msgs from last minute.
+        :param limit: Maximum number of messages.
+        :param order: 1 for oldest first, -1 for latest first.
+        :param query: Filter on the body of the messages.
+        :param count_only: Only return the number of messages.
+        :return: URI, Queue name and msgs (or their number) from last minute.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        # get URI
-        content = collection.find_one({'_id': bson.ObjectId(iden)})
-        uri = content['uri']
-        queue = content['queue']
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            # get URI
+            content = collection.find_one({'_id': bson.ObjectId(iden)})
+            uri = content['uri']
+            queue = content['queue']
 
-        # Get messages
-        begin = time.time() - 60
-        end = time.time()
+            # Get messages
+            begin = time.time() - 60
+            end = time.time()
 
-        collection = database['data_streams.' + str(iden)]
-        items = collection.aggregate([
-            {"$match": {"resv": {"$gt": begin, "$lte": end}}},
-            {"$project": {"_id": 0, "body": 1}},
-            {"$sort": {"resv": 1}}
-        ])['result']
+            items = _get_messages(database, iden, begin, end,
+                                  content.get('storage', 'raw'), limit=limit,
+                                  order=order, query=query,
+                                  count_only=count_only)
 
-        return uri, queue, list(items)
+            return uri, queue, items
+
+    def latest(self, uid, token, iden, num=1):
+        """
+        Retrieve the latest messages of a stream.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier of the stream
+        :param num: Number of messages.
+        :return: List of dicts with time & body - latest first.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return _get_latest(database, iden, num)
 
     def delete(self, uid, token, iden):
         """
@@ -174,59 +428,1094 @@ class AMQPClient(object):
         :param token: Token of the user.
         :param iden: Identifier of the stream.
         """
-        database = self.client[uid]
-        database.authenticate(uid, token)
-        collection = database['data_streams']
-        collection.remove({'_id': bson.ObjectId(iden)})
-        collection = database['data_streams.' + str(iden)]
-        collection.drop()
+        with self.auth_cache.database(self.client, uid, token) as database:
+            collection = database['data_streams']
+            collection.remove({'_id': bson.ObjectId(iden)})
+            collection = database['data_streams.' + str(iden)]
+            collection.drop()
+            database['data_streams.' + str(iden) + '.rollups'].drop()
+            database['data_aggregates'].remove({'stream': str(iden)})
+            database[TRIGGERS].remove({'stream': str(iden)})
+
+    def add_trigger(self, uid, token, iden, project, ntb_id, condition=None,
+                    threshold=None, debounce=1.0, max_batch=100,
+                    priority=0):
+        """
+        Run a notebook when messages arrive on a stream. Messages arriving
+        within debounce seconds after a run are collected & handed to the
+        next run as one batch (MESSAGES in the notebook).
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier of the stream.
+        :param project: Name of the project.
+        :param ntb_id: Identifier of the notebook.
+        :param condition: Optional - only numeric messages above or below
+            the threshold trigger a run.
+        :param threshold: The threshold for the condition.
+        :param debounce: Min. seconds between two runs.
+        :param max_batch: Max. number of messages per run - the latest are
+            kept.
+        :param priority: Priority of the jobs.
+        :return: Identifier of the trigger.
+        """
+        if condition is not None:
+            if condition not in CONDITIONS:
+                raise AttributeError('Unknown condition: ' + str(condition))
+            if threshold is None:
+                raise AttributeError('A condition needs a threshold.')
+            threshold = float(threshold)
+        if debounce < 0 or max_batch < 1:
+            raise AttributeError('Debounce needs to be >= 0 and max. batch '
+                                 '>= 1.')
+        with self.auth_cache.database(self.client, uid, token) as database:
+            return str(database[TRIGGERS].insert({'stream': str(iden),
+                                                  'project': project,
+                                                  'ntb_id': ntb_id,
+                                                  'condition': condition,
+                                                  'threshold': threshold,
+                                                  'debounce': debounce,
+                                                  'max_batch': max_batch,
+                                                  'priority': priority}))
+
+    def list_triggers(self, uid, token, iden):
+        """
+        List the triggers of a stream.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier of the stream.
+        :return: Dict with the triggers by identifier.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            res = {}
+            for obj in database[TRIGGERS].find({'stream': str(iden)}):
+                res[str(obj.pop('_id'))] = obj
+            return res
+
+    def remove_trigger(self, uid, token, trigger_id):
+        """
+        Remove a trigger.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param trigger_id: Identifier of the trigger.
+        """
+        with self.auth_cache.database(self.client, uid, token) as database:
+            database[TRIGGERS].remove({'_id': bson.ObjectId(trigger_id)})
+
+
+class IngestService(object):
+    """
+    Ingests the messages of all streams. Streams on the same broker share
+    one connection (each stream has its own channel) and a single writer
+    thread stores the messages of all streams. If an AMQP URI for the
+    execution nodes is given the triggers of the streams are fired.
+    """
+
+    def __init__(self, str_uri, batch_size=500, flush_interval=1.0,
+                 amqp_uri=None):
+        self.uri = str_uri
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.brokers = {}
+        self.consumers = {}
+        self.lock = threading.Lock()
+        self.writer = Writer()
+        self.writer.start()
+        self.publisher = None
+        if amqp_uri is not None:
+            self.publisher = TriggerPublisher(amqp_uri)
+            self.publisher.start()
+
+    def has_stream(self, iden):
+        """
+        Check if the messages of a stream are being ingested.
+
+        :param iden: Identifier of the stream.
+        """
+        return iden in self.consumers
+
+    def add_stream(self, uid, token, iden, amqp_uri, queue, storage='raw'):
+        """
+        Start ingesting the messages of a stream.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier of the stream.
+        :param amqp_uri: URI of the RabbitMQ server.
+        :param queue: Queue name.
+        :param storage: Storage mode of the stream.
+        """
+        with self.lock:
+            if iden in self.consumers:
+                return
+            if amqp_uri not in self.brokers:
+                self.brokers[amqp_uri] = BrokerConnection(amqp_uri)
+                self.brokers[amqp_uri].start()
+            consumer = StreamConsumer(uid, token, iden, self.uri, queue,
+                                      self.brokers[amqp_uri], self.writer,
+                                      batch_size=self.batch_size,
+                                      flush_interval=self.flush_interval,
+                                      storage=storage,
+                                      publisher=self.publisher)
+            self.consumers[iden] = consumer
+            consumer.broker.add(consumer)
+
+    def set_triggers(self, iden, triggers):
+        """
+        Set the triggers of an ingested stream.
+
+        :param iden: Identifier of the stream.
+        :param triggers: Dict with the trigger documents by identifier.
+        """
+        with self.lock:
+            consumer = self.consumers.get(iden)
+        if consumer is not None:
+            consumer.set_triggers(triggers)
+
+    def remove_stream(self, iden):
+        """
+        Stop ingesting the messages of a stream.
+
+        :param iden: Identifier of the stream.
+        """
+        with self.lock:
+            consumer = self.consumers.pop(iden, None)
+            if consumer is not None:
+                consumer.broker.remove(consumer)
+
+    def stats(self):
+        """
+        Return lag & throughput of all streams.
+
+        :return: Dict with the stats per stream identifier.
+        """
+        with self.lock:
+            consumers = self.consumers.items()
+        return dict((iden, consumer.stats()) for iden, consumer in consumers)
 
-        self.cache[iden].stop()
-        self.cache.pop(iden)
+    def stop(self):
+        """
+        Stop ingesting - buffered messages are still written and acked.
+        """
+        with self.lock:
+            # the brokers hand over their buffers, then the writer stores
+            # all batches - their acks are sent before the brokers close.
+            for broker in self.brokers.values():
+                broker.stop()
+            self.writer.stop()
+            for broker in self.brokers.values():
+                broker.close()
+            if self.publisher is not None:
+                self.publisher.stop()
+            self.brokers = {}
+            self.consumers = {}
 
 
-class StreamConsumer(threading.Thread):
+class BrokerConnection(threading.Thread):
     """
-    Consumer which extracts messages from a Queue and stores them.
+    One connection to a broker multiplexing the consumers of several
+    streams. Pika connections are not thread-safe so all channel operations
+    are queued up & run by this thread.
     """
 
-    def __init__(self, uid, token, iden, str_uri, amqp_uri, queue):
-        super(StreamConsumer, self).__init__()
-        # for storing msgs.
-        client = pymongo.MongoClient(str_uri)
-        database = client[uid]
-        database.authenticate(uid, token)
-        self.collection = database['data_streams.' + str(iden)]
+    def __init__(self, amqp_uri, tick=0.1, stats_interval=5.0,
+                 max_backoff=60.0):
+        super(BrokerConnection, self).__init__()
+        self.daemon = True
+        self.uri = amqp_uri
+        self.tick = tick
+        self.stats_interval = stats_interval
+        self.max_backoff = max_backoff
+        self.last_stats = 0
+        self.stopped = threading.Event()
+        # set once the buffers are flushed after stopping & on closing.
+        self.flushed = threading.Event()
+        self.closing = threading.Event()
+        self.commands = Queue.Queue()
+        self.consumers = {}
+        # consumers whose channel could not be (re-)opened - retried every
+        # stats_interval.
+        self.parked = {}
+        self.connection = None
+        self.reconnects = 0
+        self.last_error = None
 
-        # amqp conn.
-        self.queue = queue
-        connection = pika.BlockingConnection(pika.URLParameters(amqp_uri))
-        self.channel = connection.channel()
-        self.channel.queue_declare(queue=queue)
+    def add(self, consumer):
+        """
+        Start consuming the messages of a stream.
+
+        :param consumer: The StreamConsumer.
+        """
+        self.commands.put((self._add, (consumer,)))
+
+    def remove(self, consumer):
+        """
+        Stop consuming the messages of a stream.
+
+        :param consumer: The StreamConsumer.
+        """
+        self.commands.put((self._remove, (consumer,)))
+
+    def ack(self, consumer, channel, tag):
+        """
+        Acknowledge all messages up to a tag after they have been stored.
+
+        :param consumer: The StreamConsumer.
+        :param channel: The channel the messages were received on.
+        :param tag: The delivery tag.
+        """
+        self.commands.put((self._ack, (consumer, channel, tag, True)))
+
+    def nack(self, consumer, channel, tag):
+        """
+        Reject all messages up to a tag so they get redelivered.
+
+        :param consumer: The StreamConsumer.
+        :param channel: The channel the messages were received on.
+        :param tag: The delivery tag.
+        """
+        self.commands.put((self._ack, (consumer, channel, tag, False)))
+
+    def reject(self, consumer, channel, tag):
+        """
+        Reject all messages up to a tag without redelivering them - they are
+        dead-lettered if the queue has a dead letter exchange.
+
+        :param consumer: The StreamConsumer.
+        :param channel: The channel the messages were received on.
+        :param tag: The delivery tag.
+        """
+        self.commands.put((self._ack, (consumer, channel, tag, False,
+                                       False)))
+
+    def stop(self):
+        """
+        Stop consuming - returns once the buffered messages are handed to
+        the writer. Acks are still sent until the connection is closed.
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.flushed.wait()
+
+    def close(self):
+        """
+        Send the pending acks and close the connection.
+        """
+        self.closing.set()
+        if self.is_alive():
+            self.join()
 
     def run(self):
         """
-        Strat consuming.
+        Process messages & queued up commands until stopped. Lost
+        connections are re-established with an exponential backoff.
+        """
+        backoff = self.tick
+        while not self.stopped.is_set():
+            try:
+                self.connect()
+                backoff = self.tick
+                while not self.stopped.is_set():
+                    self.connection.process_data_events(time_limit=self.tick)
+                    self.process()
+                self.drain()
+            except pika.exceptions.AMQPError as err:
+                self.reconnects += 1
+                self.last_error = str(err)
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if self.connection is not None and self.connection.is_open:
+                    self.connection.close()
+        # stopped while disconnected - unacked messages are redelivered.
+        self.flushed.set()
+
+    def drain(self):
         """
-        self.channel.basic_consume(self.callback, queue=self.queue,
-                                   no_ack=True)
-        self.channel.start_consuming()
+        Hand the buffered messages to the writer and run the acks of the
+        stored batches until closed.
+        """
+        for consumer in self.consumers.values():
+            consumer.flush()
+        self.flushed.set()
+        while not self.closing.is_set():
+            self.closing.wait(self.tick)
+            self._run_commands()
+        self._run_commands()
+
+    def connect(self):
+        """
+        Connect to the broker and (re-)open the channels of all consumers.
+        """
+        self.connection = pika.BlockingConnection(
+            pika.URLParameters(self.uri))
+        for consumer in self.consumers.values() + self.parked.values():
+            # unacked messages will be redelivered on the new channel.
+            consumer.reset()
+            self._add(consumer)
+
+    def process(self):
+        """
+        Run the queued up commands and flush the buffers which are due.
+        """
+        self._run_commands()
+        now = time.time()
+        for consumer in self.consumers.values():
+            if now - consumer.last_flush >= consumer.flush_interval:
+                consumer.flush()
+            consumer.fire(now)
+        if now - self.last_stats >= self.stats_interval:
+            self.last_stats = now
+            for consumer in self.parked.values():
+                self._add(consumer)
+            for consumer in self.consumers.values():
+                try:
+                    tmp = consumer.channel.queue_declare(
+                        queue=consumer.queue, passive=True)
+                except pika.exceptions.ChannelClosed as err:
+                    # e.g. the queue was deleted - the broker only closed
+                    # the channel of this stream; reopen it.
+                    consumer.errors += 1
+                    consumer.last_error = str(err)
+                    consumer.backlog = None
+                    consumer.reset()
+                    self._add(consumer)
+                    continue
+                consumer.backlog = tmp.method.message_count
+
+    def _run_commands(self):
+        while True:
+            try:
+                func, args = self.commands.get_nowait()
+            except Queue.Empty:
+                break
+            func(*args)
+
+    def _add(self, consumer):
+        self.parked.pop(consumer.iden, None)
+        try:
+            channel = self.connection.channel()
+            channel.queue_declare(queue=consumer.queue)
+            # backpressure: the broker stops delivering when we fall behind.
+            channel.basic_qos(prefetch_count=2 * consumer.batch_size)
+            channel.basic_consume(consumer.callback, queue=consumer.queue)
+        except pika.exceptions.ChannelClosed as err:
+            # a queue the broker refuses must not stop the other streams.
+            consumer.errors += 1
+            consumer.last_error = str(err)
+            self.consumers.pop(consumer.iden, None)
+            self.parked[consumer.iden] = consumer
+            return
+        consumer.channel = channel
+        self.consumers[consumer.iden] = consumer
+
+    def _remove(self, consumer):
+        self.consumers.pop(consumer.iden, None)
+        self.parked.pop(consumer.iden, None)
+        if consumer.channel is not None and consumer.channel.is_open:
+            consumer.channel.close()
+
+    def _ack(self, consumer, channel, tag, stored, requeue=True):
+        if channel is not consumer.channel or not channel.is_open:
+            # tags are only valid on their channel - the broker redelivers.
+            return
+        if stored:
+            channel.basic_ack(delivery_tag=tag, multiple=True)
+        else:
+            channel.basic_nack(delivery_tag=tag, multiple=True,
+                               requeue=requeue)
+
+
+class Writer(threading.Thread):
+    """
+    Stores the batches of messages of all streams and hands the
+    acknowledgements back to the broker connections.
+    """
+
+    def __init__(self):
+        super(Writer, self).__init__()
+        self.daemon = True
+        self.batches = Queue.Queue()
+
+    def submit(self, consumer, batch, channel, tag):
+        """
+        Queue up a batch of messages for storing.
+
+        :param consumer: The StreamConsumer.
+        :param batch: List of messages.
+        :param channel: The channel the messages were received on.
+        :param tag: Delivery tag of the last message.
+        """
+        self.batches.put((consumer, batch, channel, tag))
 
     def stop(self):
         """
-        Stop consuming.
+        Stop once the queued up batches are stored.
+        """
+        self.batches.put(None)
+        self.join()
+
+    def run(self):
+        """
+        Store batches until stopped.
         """
-        self.channel.stop_consuming()
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            self.write(*item)
+
+    def write(self, consumer, batch, channel, tag):
+        """
+        Store a batch and acknowledge it. If storing fails the batch is
+        redelivered - unless the error is permanent, then it is rejected
+        without requeueing so it can't stall the stream.
+
+        :param consumer: The StreamConsumer.
+        :param batch: List of messages.
+        :param channel: The channel the messages were received on.
+        :param tag: Delivery tag of the last message.
+        """
+        try:
+            consumer.store(batch)
+        except TRANSIENT_ERRORS as err:
+            consumer.errors += 1
+            consumer.last_error = str(err)
+            consumer.done(batch, False)
+            consumer.broker.nack(consumer, channel, tag)
+        except Exception as err:
+            consumer.errors += 1
+            consumer.dropped += len(batch)
+            consumer.last_error = str(err)
+            consumer.done(batch, False)
+            consumer.broker.reject(consumer, channel, tag)
+        else:
+            consumer.done(batch, True)
+            consumer.broker.ack(consumer, channel, tag)
+
+
+class StreamConsumer(object):
+    """
+    Buffers the messages of a stream. Full buffers are handed to the writer
+    and acknowledged only after they have been stored. Messages are also
+    handed to the triggers of the stream.
+    """
+
+    def __init__(self, uid, token, iden, str_uri, queue, broker, writer,
+                 batch_size=500, flush_interval=1.0, storage='raw',
+                 publisher=None):
+        # for storing msgs.
+        client = connection.get_client(str_uri)
+        database = connection.AUTH_CACHE.get_database(client, uid, token)
+        self.collection = database['data_streams.' + str(iden)]
+        self.rollups = database['data_streams.' + str(iden) + '.rollups']
+        self.streams = database['data_streams']
+        self.storage = storage
+        self.iden = iden
+        self.queue = queue
+        self.broker = broker
+        self.writer = writer
+        # set by the broker connection.
+        self.channel = None
+
+        # triggers - fired through the publisher.
+        self.uid = uid
+        self.token = token
+        self.publisher = publisher
+        self.triggers = {}
+
+        # buffer.
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_tag = None
+        self.last_flush = time.time()
+
+        # metrics.
+        self.started = time.time()
+        self.inflight = collections.deque()
+        self.history = collections.deque()
+        self.received = 0
+        self.stored = 0
+        self.errors = 0
+        self.dropped = 0
+        self.decode_errors = 0
+        self.last_error = None
+        self.backlog = None
 
     def callback(self, channel, method, properties, body):
         """
-        Callback which stores the messages.
+        Callback which buffers the messages.
 
         :param body: msg body.
         :param properties: msg props.
         :param method: msg method.
         :param channel: channel.
         """
-        tmp = time.time()
-        tmp = {'resv': tmp, 'body': body}
-        self.collection.insert(tmp)
+        now = time.time()
+        headers = properties.headers or {}
+        try:
+            samples = payloads.decode(body, properties.content_type,
+                                      properties.content_encoding,
+                                      bool(headers.get(payloads.BATCH_HEADER)))
+        except Exception as err:
+            # keep the message as it is rather than losing it.
+            self.decode_errors += 1
+            self.last_error = str(err)
+            samples = [payloads.as_text(body)]
+        for sample in samples:
+            self.buffer.append({'resv': now,
+                                'ts': datetime.datetime.utcfromtimestamp(now),
+                                'body': sample})
+            for trigger in self.triggers.values():
+                trigger.add(now, sample)
+        self.last_tag = method.delivery_tag
+        self.received += len(samples)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        self.fire(now)
+
+    def fire(self, now):
+        """
+        Hand the batches of the triggers which are due to the publisher.
+
+        :param now: The current time.
+        """
+        if self.publisher is None:
+            return
+        for trigger in self.triggers.values():
+            if trigger.due(now):
+                self.publisher.publish(self.uid, self.token, trigger.iden,
+                                       trigger.doc, trigger.take(now))
+
+    def set_triggers(self, triggers):
+        """
+        Update the triggers - unchanged ones keep their pending messages.
+
+        :param triggers: Dict with the trigger documents by identifier.
+        """
+        res = {}
+        for iden, doc in triggers.items():
+            if iden in self.triggers and self.triggers[iden].doc == doc:
+                res[iden] = self.triggers[iden]
+            else:
+                res[iden] = Trigger(iden, doc)
+        # swapped at once as the broker connection iterates over them.
+        self.triggers = res
+
+    def flush(self):
+        """
+        Hand the buffered messages to the writer.
+        """
+        self.last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+        batch = self.buffer
+        self.buffer = []
+        self.inflight.append(batch[0]['resv'])
+        self.writer.submit(self, batch, self.channel, self.last_tag)
+
+    def reset(self):
+        """
+        Drop the buffered messages - used when the channel was lost as the
+        broker will redeliver them.
+        """
+        self.buffer = []
+        self.last_tag = None
+
+    def store(self, batch):
+        """
+        Store the messages in bulk and update the rollups & the latest
+        messages.
+
+        :param batch: List of messages.
+        """
+        if self.storage == 'bucket':
+            _bulk_upsert(self.collection, _bucket_updates(batch))
+        else:
+            self.collection.insert(batch)
+        _bulk_upsert(self.rollups, _rollup_updates(batch))
+        self.streams.update({'_id': bson.ObjectId(self.iden)},
+                            _latest_update(batch))
+
+    def done(self, batch, stored):
+        """
+        Update the metrics once the writer is done with a batch.
+
+        :param batch: List of messages.
+        :param stored: True if the messages were stored.
+        """
+        self.inflight.popleft()
+        if stored:
+            self.stored += len(batch)
+            self.history.append((time.time(), len(batch)))
+
+    def stats(self, window=60.0):
+        """
+        Return lag & throughput of the stream.
+
+        :param window: Seconds over which the throughput is calculated.
+        :return: Dict with key/values.
+        """
+        now = time.time()
+        while len(self.history) > 0 and self.history[0][0] < now - window:
+            self.history.popleft()
+        oldest = None
+        if len(self.inflight) > 0:
+            oldest = self.inflight[0]
+        elif len(self.buffer) > 0:
+            oldest = self.buffer[0]['resv']
+        period = max(min(window, now - self.started), 1.0)
+        return {'received': self.received,
+                'stored': self.stored,
+                'msgs_per_sec': sum(item[1] for item in self.history) /
+                period,
+                'lag': now - oldest if oldest is not None else 0.0,
+                'backlog': self.backlog,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'decode_errors': self.decode_errors,
+                'last_error': self.last_error}
+
+
+class Trigger(object):
+    """
+    Collects the messages of a stream matching its condition. A run is due
+    once debounce seconds passed since the last one - messages arriving in
+    between are handed to the run as one micro-batch. The execution node
+    adds the batch to the trigger's job if that one is still queued.
+    """
+
+    def __init__(self, iden, doc):
+        self.iden = iden
+        self.doc = doc
+        self.pending = collections.deque(maxlen=doc.get('max_batch', 100))
+        self.last_run = 0.0
+        self.runs = 0
+
+    def add(self, now, body):
+        """
+        Collect a message if it matches the condition.
+
+        :param now: Time the message was received.
+        :param body: The message body.
+        """
+        condition = self.doc.get('condition')
+        if condition is not None:
+            value = _to_number(body)
+            if value is None:
+                return
+            if condition == 'above' and value <= self.doc['threshold']:
+                return
+            if condition == 'below' and value >= self.doc['threshold']:
+                return
+        self.pending.append({'resv': now, 'body': body})
+
+    def due(self, now):
+        """
+        Check if a run should be triggered.
+
+        :param now: The current time.
+        """
+        return len(self.pending) > 0 and \
+            now - self.last_run >= self.doc.get('debounce', 1.0)
+
+    def take(self, now):
+        """
+        Return the collected messages & start collecting the next batch.
+
+        :param now: The current time.
+        """
+        batch = list(self.pending)
+        self.pending.clear()
+        self.last_run = now
+        self.runs += 1
+        return batch
+
+
+class TriggerPublisher(threading.Thread):
+    """
+    Sends the runs of triggers to the execution nodes of the tenants. Runs
+    are fire & forget - they show up as jobs. Lost connections are
+    re-established with an exponential backoff.
+    """
+
+    def __init__(self, amqp_uri, tick=0.1, max_backoff=60.0):
+        super(TriggerPublisher, self).__init__()
+        self.daemon = True
+        self.uri = amqp_uri
+        self.tick = tick
+        self.max_backoff = max_backoff
+        self.stopped = threading.Event()
+        self.outgoing = Queue.Queue()
+        self.connection = None
+        self.published = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.last_error = None
+
+    def publish(self, uid, token, iden, doc, batch):
+        """
+        Queue up a run of a notebook.
+
+        :param uid: User's uid.
+        :param token: Token of the user.
+        :param iden: Identifier of the trigger.
+        :param doc: The trigger.
+        :param batch: List of the messages for the run.
+        """
+        try:
+            body = json.dumps({'uid': uid,
+                               'token': token,
+                               'project_id': doc['project'],
+                               'notebook_id': doc['ntb_id'],
+                               'priority': doc.get('priority', 0),
+                               'trigger': iden,
+                               'messages': batch,
+                               'max_batch': doc.get('max_batch', 100),
+                               'call': 'trigger_run'})
+        except (TypeError, ValueError) as err:
+            # e.g. binary messages.
+            self.dropped += 1
+            self.last_error = str(err)
+            return
+        self.outgoing.put((uid, body))
+
+    def stop(self):
+        """
+        Stop the publisher.
+        """
+        self.stopped.set()
+
+    def run(self):
+        """
+        Publish the queued up runs until stopped.
+        """
+        backoff = self.tick
+        item = None
+        while not self.stopped.is_set():
+            try:
+                self.connection = pika.BlockingConnection(
+                    pika.URLParameters(self.uri))
+                channel = self.connection.channel()
+                backoff = self.tick
+                while not self.stopped.is_set():
+                    if item is None:
+                        try:
+                            item = self.outgoing.get(timeout=self.tick)
+                        except Queue.Empty:
+                            self.connection.process_data_events(
+                                time_limit=0)
+                            continue
+                    channel.basic_publish(exchange='', routing_key=item[0],
+                                          body=item[1])
+                    item = None
+                    self.published += 1
+            except pika.exceptions.AMQPError as err:
+                # the run in flight is retried after reconnecting.
+                self.reconnects += 1
+                self.last_error = str(err)
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if self.connection is not None and self.connection.is_open:
+                    self.connection.close()
+
+
+def _get_messages(database, iden, begin, end, storage=None, limit=None,
+                  order=1, query=None, count_only=False):
+    """
+    Retrieve the messages of a stream in a time window. Sorting, limiting,
+    filtering & counting is done by the database.
+
+    :param database: The database of the user.
+    :param iden: Identifier of the stream.
+    :param begin: Start of the window (exclusive).
+    :param end: End of the window (inclusive).
+    :param storage: Storage mode of the stream - looked up if None.
+    :param limit: Maximum number of messages.
+    :param order: 1 for oldest first, -1 for latest first.
+    :param query: Filter on the messages - keys need to be body or start
+        with body. (e.g. {'body.status': 'up'}).
+    :param count_only: Only return the number of matching messages.
+    :return: Lazy cursor over the messages (or the number of messages).
+    """
+    if order not in (1, -1):
+        raise AttributeError('Order needs to be 1 or -1.')
+    query = query or {}
+    for key in query:
+        if key != 'body' and not key.startswith('body.'):
+            raise AttributeError('Can only filter on the body of messages.')
+    if storage is None:
+        tmp = database['data_streams'].find_one(
+            {'_id': bson.ObjectId(iden)}, fields={'storage': True})
+        storage = tmp.get('storage', 'raw')
+
+    collection = database['data_streams.' + str(iden)]
+    if storage != 'bucket':
+        cursor = collection.find(dict(query, resv={'$gt': begin,
+                                                   '$lte': end}),
+                                 fields={'_id': False, 'body': True},
+                                 sort=[('resv', order)], limit=limit or 0)
+        if count_only:
+            return cursor.count(with_limit_and_skip=True)
+        return cursor
+
+    match = dict(('msgs.' + key, query[key]) for key in query)
+    match['msgs.resv'] = {'$gt': begin, '$lte': end}
+    pipeline = [
+        {"$match": {"resv": {"$gt": begin - BUCKET_SIZE, "$lte": end}}},
+        {"$unwind": "$msgs"},
+        {"$match": match}
+    ]
+    if count_only:
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$group": {"_id": None, "count": {"$sum": 1}}})
+        res = list(collection.aggregate(pipeline, cursor={}))
+        return res[0]['count'] if len(res) > 0 else 0
+    pipeline.append({"$sort": {"msgs.resv": order}})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"_id": 0, "body": "$msgs.body"}})
+    return collection.aggregate(pipeline, cursor={})
+
+
+def _get_latest(database, iden, num):
+    """
+    Retrieve the latest messages of a stream - served from the stream's
+    document if possible.
+
+    :param database: The database of the user.
+    :param iden: Identifier of the stream.
+    :param num: Number of messages.
+    :return: List of dicts with time & body - latest first.
+    """
+    stream = database['data_streams'].find_one(
+        {'_id': bson.ObjectId(iden)},
+        fields={'storage': True, 'latest': {'$slice': -num}})
+    if stream is None:
+        raise AttributeError('Unknown stream: ' + str(iden))
+    if num <= LATEST_SIZE:
+        return list(reversed(stream.get('latest', [])))
+
+    collection = database['data_streams.' + str(iden)]
+    if stream.get('storage', 'raw') == 'bucket':
+        return list(collection.aggregate([
+            {"$sort": {"resv": -1}},
+            {"$unwind": "$msgs"},
+            {"$sort": {"msgs.resv": -1}},
+            {"$limit": num},
+            {"$project": {"_id": 0, "time": "$msgs.resv",
+                          "body": "$msgs.body"}}
+        ], cursor={}))
+    res = []
+    for item in collection.find(fields={'resv': True, 'body': True},
+                                sort=[('resv', -1)], limit=num):
+        res.append({'time': item['resv'], 'body': item['body']})
+    return res
+
+
+def _latest_update(msgs):
+    """
+    Build the update keeping the latest LATEST_SIZE messages.
+
+    :param msgs: List of messages.
+    :return: The update.
+    """
+    tmp = [{'time': msg['resv'], 'body': msg['body']}
+           for msg in msgs[-LATEST_SIZE:]]
+    return {'$push': {'latest': {'$each': tmp, '$slice': -LATEST_SIZE}}}
+
+
+def _get_rollups(database, iden, begin, end, resolution):
+    """
+    Retrieve the rollups of a stream in a time window.
+
+    :param database: The database of the user.
+    :param iden: Identifier of the stream.
+    :param begin: Start of the window (exclusive).
+    :param end: End of the window (inclusive).
+    :param resolution: Resolution in seconds.
+    :return: List of dicts with time, count, min, max & mean.
+    """
+    if resolution not in RESOLUTIONS:
+        raise AttributeError('Resolution needs to be one of: ' +
+                             str(RESOLUTIONS))
+    collection = database['data_streams.' + str(iden) + '.rollups']
+    res = []
+    for item in collection.find({'res': resolution,
+                                 'resv': {'$gt': begin - resolution,
+                                          '$lte': end}},
+                                sort=[('resv', 1)]):
+        res.append({'time': item['resv'],
+                    'count': item['count'],
+                    'min': item['min'],
+                    'max': item['max'],
+                    'mean': item['sum'] / item['count']})
+    return res
+
+
+def _bucket_updates(msgs):
+    """
+    Group messages into per BUCKET_SIZE seconds documents. A bucket is only
+    updated if it has room for the messages - otherwise a new document is
+    upserted for the same time slot.
+
+    :param msgs: List of messages.
+    :return: List of (query, update) for upserting the buckets.
+    """
+    buckets = {}
+    for msg in msgs:
+        start = msg['resv'] - msg['resv'] % BUCKET_SIZE
+        buckets.setdefault(start, []).append(msg)
+    res = []
+    for start in sorted(buckets):
+        for i in range(0, len(buckets[start]), MAX_PER_BUCKET):
+            chunk = buckets[start][i:i + MAX_PER_BUCKET]
+            tmp = [{'resv': msg['resv'], 'body': msg['body']}
+                   for msg in chunk]
+            res.append(({'resv': start,
+                         'count': {'$lte': MAX_PER_BUCKET - len(tmp)}},
+                        {'$push': {'msgs': {'$each': tmp}},
+                         '$inc': {'count': len(tmp)},
+                         '$max': {'ts': _timestamp(chunk)}}))
+    return res
+
+
+def _rollup_updates(msgs):
+    """
+    Calculate the rollups of the numeric messages for all RESOLUTIONS.
+
+    :param msgs: List of messages.
+    :return: List of (query, update) for upserting the rollups.
+    """
+    slots = {}
+    for msg in msgs:
+        val = _to_number(msg['body'])
+        if val is None:
+            continue
+        for resolution in RESOLUTIONS:
+            key = (resolution, msg['resv'] - msg['resv'] % resolution)
+            if key not in slots:
+                slots[key] = {'count': 0, 'sum': 0.0, 'min': val, 'max': val,
+                              'msgs': []}
+            tmp = slots[key]
+            tmp['count'] += 1
+            tmp['sum'] += val
+            tmp['min'] = min(tmp['min'], val)
+            tmp['max'] = max(tmp['max'], val)
+            tmp['msgs'].append(msg)
+    res = []
+    for key in sorted(slots):
+        tmp = slots[key]
+        res.append(({'res': key[0], 'resv': key[1]},
+                    {'$inc': {'count': tmp['count'], 'sum': tmp['sum']},
+                     '$min': {'min': tmp['min']},
+                     '$max': {'max': tmp['max'],
+                              'ts': _timestamp(tmp['msgs'])}}))
+    return res
+
+
+def _timestamp(msgs):
+    """
+    Return the date of the latest message - used by the TTL indexes.
+
+    :param msgs: List of messages.
+    """
+    return datetime.datetime.utcfromtimestamp(max(msg['resv']
+                                                  for msg in msgs))
+
+
+def _check_retention(retention, storage):
+    """
+    Validate a retention policy.
+
+    :param retention: Dict with the retention policy.
+    :param storage: Storage mode of the stream.
+    :return: The retention policy with integer values.
+    """
+    res = {}
+    for key in retention:
+        if key not in RETENTION_KEYS:
+            raise AttributeError('Unknown retention policy: ' + str(key))
+        if retention[key] is None:
+            continue
+        res[key] = int(retention[key])
+        if res[key] <= 0:
+            raise AttributeError('Retention values need to be positive.')
+    if 'max_docs' in res and 'max_bytes' not in res:
+        raise AttributeError('max_docs needs max_bytes to be set.')
+    if 'max_age' in res and 'max_bytes' in res:
+        # capped collections cannot have a TTL index.
+        raise AttributeError('Streams can either have a max_age or be '
+                             'capped by max_bytes.')
+    if 'max_bytes' in res and storage == 'bucket':
+        # documents in capped collections cannot grow.
+        raise AttributeError('Bucketed streams cannot be capped.')
+    return res
+
+
+def _describe(retention):
+    """
+    Describe a retention policy.
+
+    :param retention: Dict with the retention policy.
+    """
+    if not retention:
+        return 'unbounded'
+    return ', '.join('%s=%s' % (key, retention[key])
+                     for key in RETENTION_KEYS if key in retention)
+
+
+def storage_usage(database, iden):
+    """
+    Return the storage used by the messages & rollups of a stream.
+
+    :param database: The database of the user.
+    :param iden: Identifier of the stream.
+    :return: Dict with size (in bytes) & count (of messages).
+    """
+    res = {'size': 0, 'count': 0}
+    for name in ['data_streams.' + iden, 'data_streams.' + iden + '.rollups']:
+        try:
+            stats = database.command('collstats', name)
+        except errors.OperationFailure:
+            # collection does not exist (yet).
+            continue
+        res['size'] += stats.get('storageSize', 0) + \
+            stats.get('totalIndexSize', 0)
+        if not name.endswith('.rollups'):
+            res['count'] = stats.get('count', 0)
+    return res
+
+
+def _bulk_upsert(collection, updates):
+    """
+    Apply a list of upserts in one round trip.
+
+    :param collection: The collection.
+    :param updates: List of (query, update).
+    """
+    if len(updates) == 0:
+        return
+    bulk = collection.initialize_unordered_bulk_op()
+    for query, update in updates:
+        bulk.find(query).upsert().update_one(update)
+    bulk.execute()
+
+
+def _to_number(body):
+    """
+    Return the numeric value of a message body - None if not numeric.
+
+    :param body: The message body.
+    """
+    if isinstance(body, bool):
+        return None
+    try:
+        return float(body)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,260 @@
+# coding=utf-8
+
+"""
+RPC calls to the execution nodes over AMQP - used by the UI & the cron
+daemon.
+"""
+
+__author__ = 'tmetsch'
+
+import collections
+import json
+import pika
+import Queue
+import threading
+import time
+import uuid
+
+
+class RPCTimeout(Exception):
+    """
+    Raised if no reply arrived in time.
+    """
+
+    pass
+
+
+class Future(object):
+    """
+    The pending reply of an RPC call.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def set_result(self, value):
+        """
+        Set the reply.
+
+        :param value: The reply.
+        """
+        self.value = value
+        self._finish()
+
+    def set_exception(self, error):
+        """
+        Fail the call.
+
+        :param error: The error.
+        """
+        self.error = error
+        self._finish()
+
+    def _finish(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for func in callbacks:
+            func(self)
+
+    def done(self):
+        """
+        Check if the reply arrived (or the call failed).
+        """
+        return self.event.is_set()
+
+    def add_done_callback(self, func):
+        """
+        Call func with this future once it is done.
+
+        :param func: The function.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def result(self, timeout=None):
+        """
+        Wait for the reply.
+
+        :param timeout: Seconds to wait - by default until the deadline of
+            the call.
+        :return: The reply.
+        """
+        if timeout is None and self.deadline is not None:
+            timeout = max(self.deadline - time.time(), 0)
+        if not self.event.wait(timeout):
+            raise RPCTimeout('No reply within ' + str(timeout) + 's.')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class RPCClient(threading.Thread):
+    """
+    A thread safe RPC client using AMQP. All calls share one connection &
+    the direct reply-to queue; replies are matched to the calls by their
+    correlation id. Only the client's thread talks to the broker.
+    """
+
+    json_dec = json.JSONDecoder(object_pairs_hook=collections.OrderedDict)
+    reply_to = 'amq.rabbitmq.reply-to'
+
+    def __init__(self, uri, timeout=60.0, tick=0.05, max_backoff=30.0):
+        super(RPCClient, self).__init__()
+        self.daemon = True
+        self.para = pika.URLParameters(uri)
+        self.timeout = timeout
+        self.tick = tick
+        self.max_backoff = max_backoff
+
+        self.connection = None
+        self.channel = None
+        self.lock = threading.Lock()
+        # correlation id -> (future, deadline)
+        self.pending = {}
+        self.outgoing = Queue.Queue()
+
+    def run(self):
+        """
+        Send the calls & receive the replies. If the connection is lost (or
+        anything else goes wrong) the pending calls fail and the client
+        reconnects.
+        """
+        backoff = self.tick
+        while True:
+            try:
+                if self.connection is None:
+                    self.connect()
+                self.connection.process_data_events(time_limit=self.tick)
+                self.publish()
+                self.expire()
+                backoff = self.tick
+            except Exception as err:
+                self.close()
+                self.fail(err)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def connect(self):
+        """
+        Connect & start consuming from the direct reply-to queue.
+        """
+        self.connection = pika.BlockingConnection(self.para)
+        self.channel = self.connection.channel()
+        self.channel.basic_consume(self.callback, queue=self.reply_to,
+                                   no_ack=True)
+
+    def close(self):
+        """
+        Drop the connection - it is reopened on the next iteration.
+        """
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def publish(self):
+        """
+        Publish the queued calls.
+        """
+        while True:
+            try:
+                uid, body, corr_id = self.outgoing.get_nowait()
+            except Queue.Empty:
+                break
+            with self.lock:
+                if corr_id not in self.pending:
+                    # timed out before it was sent.
+                    continue
+            prop = pika.BasicProperties(reply_to=self.reply_to,
+                                        correlation_id=corr_id)
+            self.channel.basic_publish(exchange='',
+                                       routing_key=uid,
+                                       properties=prop,
+                                       body=body)
+
+    def expire(self):
+        """
+        Fail the calls which did not get a reply in time.
+        """
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, deadline) in self.pending.items()
+                       if deadline <= now]
+            futures = [self.pending.pop(key)[0] for key in expired]
+        for future in futures:
+            future.set_exception(RPCTimeout('No reply in time.'))
+
+    def fail(self, err):
+        """
+        Fail all pending calls - e.g. when the connection was lost.
+
+        :param err: The error.
+        """
+        with self.lock:
+            futures = [item[0] for item in self.pending.values()]
+            self.pending.clear()
+        for future in futures:
+            future.set_exception(err)
+
+    def callback(self, channel, method, props, body):
+        """
+        Handle a response call.
+
+        :param channel: The channel.
+        :param method: The method.
+        :param props: The properties.
+        :param body: The body.
+        """
+        with self.lock:
+            item = self.pending.pop(props.correlation_id, None)
+        if item is None:
+            # reply to a call which timed out.
+            return
+        # making sure order is in place!
+        try:
+            res = self.json_dec.decode(body)
+        except ValueError as err:
+            item[0].set_exception(err)
+            return
+        if res is not None and 'error' in res:
+            item[0].set_exception(AttributeError(res['error']))
+        else:
+            item[0].set_result(res)
+
+    def call_async(self, uid, payload, timeout=None):
+        """
+        Perform an RPC call without waiting for the reply.
+
+        :param uid: Identifier of the user.
+        :param payload: The payload.
+        :param timeout: Seconds to wait for the reply.
+        :return: A Future for the reply.
+        """
+        corr_id = str(uuid.uuid4())
+        deadline = time.time() + (timeout or self.timeout)
+        future = Future(deadline)
+        with self.lock:
+            self.pending[corr_id] = (future, deadline)
+        self.outgoing.put((uid, json.dumps(payload), corr_id))
+        return future
+
+    def call(self, uid, payload, timeout=None):
+        """
+        Perform an RPC call.
+
+        :param uid: Identifier of the user.
+        :param payload: The payload.
+        :param timeout: Seconds to wait for the reply.
+        """
+        return self.call_async(uid, payload, timeout).result()
@@ -7,12 +7,10 @@ from bson import ObjectId
 
 __author__ = 'tmetsch'
 
-import collections
-import json
-import pika
-import pika.exceptions as pikaex
-import uuid
+import threading
 
+from suricate import rpc
+from suricate.analytics import proj_ntb_store
 from suricate.data import object_store
 from suricate.data import streaming
 
@@ -34,19 +32,40 @@ TEMPLATE = '''
 % end
 '''
 
+# default wall clock limit of a run in seconds - as on the execution nodes.
+WALL_LIMIT = 600
+# seconds on top of the wall clock limit for starting an interpreter.
+START_SLACK = 60
+
 
 class API(object):
     """
     Little helper class to abstract the REST and UI from.
     """
 
-    def __init__(self, amqp_uri, mongo_uri):
-        self.clients = {}
+    def __init__(self, amqp_uri, mongo_uri, limits=None):
+        """
+        Initialize the API.
+
+        :param amqp_uri: Connection details for RabbitMQ broker.
+        :param mongo_uri: Connection details for MongoDB.
+        :param limits: resource limits of the runs (see [limits] section of
+            app.conf) - 'wall' bounds the wait for running code.
+        """
+        if limits is None:
+            limits = {}
+        # calls which run code wait for the interpreter - up to the wall
+        # clock limit of a run plus some slack for starting it.
+        self.timeout = limits.get('wall', WALL_LIMIT) + START_SLACK
+        self.client = None
+        self.lock = threading.Lock()
         self.amqp_uri = amqp_uri
 
         # get obj/streaming client up!
-        self.obj_str = object_store.MongoStore(mongo_uri)
+        self.obj_str = object_store.get_object_stor(mongo_uri)
         self.stream = streaming.AMQPClient(mongo_uri)
+        # runs are read directly while their output is streamed.
+        self.runs = proj_ntb_store.NotebookStore(mongo_uri, None)
 
     # Data sources...
 
@@ -61,14 +80,18 @@ class API(object):
         data_info.update(self.stream.info(uid, token))
         return data_info
 
-    def list_data_sources(self, uid, token):
+    def list_data_sources(self, uid, token, after=None, limit=None):
         """
         List available data sources. Return list of ids for objects & streams.
+        Objects are returned page by page.
 
         :param uid: Identifier for the user.
         :param token: The token of the user.
+        :param after: Id of the last object of the previous page.
+        :param limit: Number of objects per page - all if None.
         """
-        tmp = self.obj_str.list_objects(uid, token)
+        tmp = self.obj_str.list_objects(uid, token, limit=limit, after=after,
+                                        fields=['name', 'tags'])
         tmp2 = self.stream.list_streams(uid, token)
         return tmp, tmp2
 
@@ -95,6 +118,41 @@ class API(object):
         tmp = self.obj_str.retrieve_object(uid, token, iden)
         return tmp
 
+    def preview_object(self, iden, uid, token, size=4096):
+        """
+        Retrieve the meta data & the beginning of a data object.
+
+        :param iden: Id of the object.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :param size: Number of bytes to return.
+        """
+        tmp = self.obj_str.list_objects(uid, token,
+                                        query={'_id': ObjectId(iden)})
+        return tmp[0][1], self.obj_str.read_object(uid, token, iden, 0, size)
+
+    def read_object(self, iden, uid, token, offset=0, length=None):
+        """
+        Read (a range of) the content of a data object.
+
+        :param iden: Id of the object.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :param offset: Position to start reading from.
+        :param length: Number of bytes to read - all if None.
+        """
+        return self.obj_str.read_object(uid, token, iden, offset, length)
+
+    def stream_object(self, iden, uid, token):
+        """
+        Return an iterator over the chunks of a data object.
+
+        :param iden: Id of the object.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        """
+        return self.obj_str.stream_object(uid, token, iden)
+
     def delete_object(self, iden, uid, token):
         """
         Delete a data object.
@@ -107,7 +165,8 @@ class API(object):
 
     # Streams
 
-    def create_stream(self, uri, queue, uid, token):
+    def create_stream(self, uri, queue, uid, token, storage='raw',
+                      retention=None, compression=None):
         """
         Create a data stream.
 
@@ -115,19 +174,27 @@ class API(object):
         :param queue: Queue.
         :param uid: Identifier for the user.
         :param token: The token of the user.
+        :param storage: Storage mode (raw or bucket).
+        :param retention: Retention policy (max_age, max_bytes, max_docs).
+        :param compression: Block compressor for storing messages at rest.
         """
-        self.stream.create(uid, token, uri, queue)
+        self.stream.create(uid, token, uri, queue, storage=storage,
+                           retention=retention, compression=compression)
 
-    def retrieve_stream(self, iden, uid, token):
+    def retrieve_stream(self, iden, uid, token, limit=1):
         """
-        Retrieve a data stream.
+        Retrieve a data stream with the number of messages from last minute
+        & the latest messages.
 
         :param iden: Id of the stream.
         :param uid: Identifier for the user.
         :param token: The token of the user.
+        :param limit: Number of latest messages to return.
         """
-        uri, queue, msgs = self.stream.retrieve(uid, token, iden)
-        return uri, queue, msgs
+        uri, queue, count = self.stream.retrieve(uid, token, iden,
+                                                 count_only=True)
+        msgs = self.stream.latest(uid, token, iden, limit)
+        return uri, queue, count, msgs
 
     def delete_stream(self, iden, uid, token):
         """
@@ -139,6 +206,49 @@ class API(object):
         """
         self.stream.delete(uid, token, iden)
 
+    def create_trigger(self, iden, proj_name, ntb_id, uid, token,
+                       condition=None, threshold=None, debounce=1.0,
+                       max_batch=100):
+        """
+        Run a notebook with the messages arriving on a data stream.
+
+        :param iden: Id of the stream.
+        :param proj_name: Name of the project.
+        :param ntb_id: Id of the notebook.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :param condition: Optional - above or below the threshold.
+        :param threshold: The threshold.
+        :param debounce: Min. seconds between two runs.
+        :param max_batch: Max. number of messages per run.
+        :return: Identifier of the trigger.
+        """
+        return self.stream.add_trigger(uid, token, iden, proj_name, ntb_id,
+                                       condition=condition,
+                                       threshold=threshold,
+                                       debounce=debounce,
+                                       max_batch=max_batch)
+
+    def list_triggers(self, iden, uid, token):
+        """
+        List the triggers of a data stream.
+
+        :param iden: Id of the stream.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        """
+        return self.stream.list_triggers(uid, token, iden)
+
+    def delete_trigger(self, trigger_id, uid, token):
+        """
+        Remove a trigger.
+
+        :param trigger_id: Id of the trigger.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        """
+        self.stream.remove_trigger(uid, token, trigger_id)
+
     def set_meta(self, data_src, iden, tags, uid, token):
         """
         Set meta information.
@@ -149,11 +259,11 @@ class API(object):
         :param uid: Identifier for the user.
         :param token: The token of the user.
         """
-        database = self.obj_str.client[uid]
-        database.authenticate(uid, token)
-        collection = database[data_src]
-        collection.update({'_id': ObjectId(iden)},
-                          {"$set": {'meta.tags': tags}})
+        with self.obj_str.auth_cache.database(self.obj_str.client, uid,
+                                              token) as database:
+            collection = database[data_src]
+            collection.update({'_id': ObjectId(iden)},
+                              {"$set": {'meta.tags': tags}})
 
     ####
     # Everything below this is RPC!
@@ -298,7 +408,39 @@ class API(object):
                    'notebook_id': ntb_id,
                    'src': src,
                    'call': 'run_notebook'}
-        self._call_rpc(uid, payload)
+        self._call_rpc(uid, payload, self.timeout)
+
+    def submit_run(self, proj_name, ntb_id, src, uid, token):
+        """
+        RPC call to run a notebook without waiting for it to finish.
+
+        :param proj_name: Name of the project.
+        :param ntb_id: Id of the notebook.
+        :param src: source code to run.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :return: Identifier of the run.
+        """
+        payload = {'uid': uid,
+                   'token': token,
+                   'project_id': proj_name,
+                   'notebook_id': ntb_id,
+                   'src': src,
+                   'call': 'submit_run'}
+        tmp = self._call_rpc(uid, payload)
+        return tmp['run_id']
+
+    def retrieve_run(self, run_id, uid, token, offset=0):
+        """
+        Retrieve state & output of a run.
+
+        :param run_id: Identifier of the run.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :param offset: Only return the output lines from this offset on.
+        :return: The run or None if it is gone.
+        """
+        return self.runs.retrieve_run(run_id, uid, token, offset)
 
     def interact(self, proj_name, ntb_id, loc, uid, token):
         """
@@ -316,24 +458,29 @@ class API(object):
                    'notebook_id': ntb_id,
                    'loc': loc,
                    'call': 'interact'}
-        self._call_rpc(uid, payload)
+        self._call_rpc(uid, payload, self.timeout)
 
     # Jobs.
 
-    def list_jobs(self, uid, token):
+    def list_jobs(self, uid, token, skip=0, limit=None):
         """
-        RPC call to run a notebook.
+        RPC call to list the jobs - newest first.
 
         :param uid: Identifier for the user.
         :param token: The token of the user.
+        :param skip: Number of jobs to skip.
+        :param limit: Max. number of jobs to return.
+        :return: Tuple with the total number of jobs & the jobs by id.
         """
         payload = {'uid': uid,
                    'token': token,
+                   'skip': skip,
+                   'limit': limit,
                    'call': 'list_jobs'}
         tmp = self._call_rpc(uid, payload)
-        return tmp['jobs']
+        return tmp['total'], tmp['jobs']
 
-    def run_job(self, proj_name, ntb_id, src, uid, token):
+    def run_job(self, proj_name, ntb_id, src, uid, token, priority=0):
         """
         RPC call to run a notebook.
 
@@ -342,14 +489,34 @@ class API(object):
         :param src: source code to run.
         :param uid: Identifier for the user.
         :param token: The token of the user.
+        :param priority: Jobs with higher priority are run first.
+        :return: Identifier of the job.
         """
         payload = {'uid': uid,
                    'token': token,
                    'project_id': proj_name,
                    'notebook_id': ntb_id,
                    'src': src,
+                   'priority': priority,
                    'call': 'run_job'}
-        self._call_rpc(uid, payload)
+        tmp = self._call_rpc(uid, payload)
+        return tmp['job_id']
+
+    def cancel_job(self, job_id, uid, token):
+        """
+        RPC call to cancel a queued or running job.
+
+        :param job_id: Identifier of the job.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :return: True if the job was cancelled.
+        """
+        payload = {'uid': uid,
+                   'token': token,
+                   'job_id': job_id,
+                   'call': 'cancel_job'}
+        tmp = self._call_rpc(uid, payload)
+        return tmp['cancelled']
 
     def clear_job_list(self, uid, token):
         """
@@ -363,76 +530,104 @@ class API(object):
                    'call': 'clear_job_list'}
         self._call_rpc(uid, payload)
 
-    def _call_rpc(self, uid, payload):
-        """
-        Make a lovely RPC (blocking) call.
+    # Schedules.
 
-        :param uid: user's id.
-        :param payload: JSON payload for the message.
+    def create_schedule(self, proj_name, ntb_id, uid, token, cron=None,
+                        interval=None, misfire='coalesce', priority=0):
         """
-        if uid not in self.clients:
-            self.clients[uid] = RPCClient(self.amqp_uri)
-        return self.clients[uid].call(uid, payload)
-
+        RPC call to run a notebook on a cron expression or fixed interval.
 
-class RPCClient(object):
-    """
-    An RPC client using AMQP.
-    """
+        :param proj_name: Name of the project.
+        :param ntb_id: Id of the notebook.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        :param cron: A cron expression (minute hour dom month dow) in UTC.
+        :param interval: Or an interval in seconds.
+        :param misfire: Run missed occurrences once (coalesce) or skip them.
+        :param priority: Priority of the jobs.
+        :return: Identifier of the schedule.
+        """
+        payload = {'uid': uid,
+                   'token': token,
+                   'project_id': proj_name,
+                   'notebook_id': ntb_id,
+                   'cron': cron,
+                   'interval': interval,
+                   'misfire': misfire,
+                   'priority': priority,
+                   'call': 'create_schedule'}
+        tmp = self._call_rpc(uid, payload)
+        return tmp['schedule_id']
 
-    json_dec = json.JSONDecoder(object_pairs_hook=collections.OrderedDict)
+    def list_schedules(self, proj_name, uid, token):
+        """
+        RPC call to list the schedules of a project.
 
-    def __init__(self, uri):
-        self.para = pika.URLParameters(uri)
-        self.connection = pika.BlockingConnection(self.para)
+        :param proj_name: Name of the project.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
+        """
+        payload = {'uid': uid,
+                   'token': token,
+                   'project_id': proj_name,
+                   'call': 'list_schedules'}
+        tmp = self._call_rpc(uid, payload)
+        return tmp['schedules']
 
-        self.corr_id = None
-        self.response = None
+    def delete_schedule(self, schedule_id, uid, token):
+        """
+        RPC call to remove a schedule.
 
-    def callback(self, channel, method, props, body):
+        :param schedule_id: Identifier of the schedule.
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
         """
-        Handle a response call.
+        payload = {'uid': uid,
+                   'token': token,
+                   'schedule_id': schedule_id,
+                   'call': 'delete_schedule'}
+        self._call_rpc(uid, payload)
 
-        :param channel: The channel.
-        :param method: The method.
-        :param props: The properties.
-        :param body: The body.
+    def exec_stats(self, uid, token):
         """
-        if self.corr_id == props.correlation_id:
-            self.response = body
+        Return queue depth & per call latencies of the execution node.
 
-    def call(self, uid, payload):
+        :param uid: Identifier for the user.
+        :param token: The token of the user.
         """
-        Perform an RPC call.
+        payload = {'uid': uid,
+                   'token': token,
+                   'call': 'stats'}
+        tmp = self._call_rpc(uid, payload)
+        return tmp['stats']
 
-        :param uid: Identifier of the user.
-        :param payload: The payload.
+    def _call_rpc(self, uid, payload, timeout=None):
         """
-        self.response = None
-        self.corr_id = str(uuid.uuid4())
+        Make a lovely RPC (blocking) call.
 
-        try:
-            channel = self.connection.channel()
-        except pikaex.ChannelClosed:
-            # idle connections are closed...
-            self.connection = pika.BlockingConnection(self.para)
-            channel = self.connection.channel()
+        :param uid: user's id.
+        :param payload: JSON payload for the message.
+        :param timeout: Seconds to wait for the reply.
+        """
+        return self._get_client().call(uid, payload, timeout)
 
-        result = channel.queue_declare(exclusive=True)
-        callback_queue = result.method.queue
-        channel.basic_consume(self.callback, no_ack=True,
-                              queue=callback_queue)
-        prop = pika.BasicProperties(reply_to=callback_queue,
-                                    correlation_id=self.corr_id)
-        channel.basic_publish(exchange='',
-                              routing_key=uid,
-                              properties=prop,
-                              body=json.dumps(payload))
-        while self.response is None:
-            self.connection.process_data_events()
+    def _call_rpc_async(self, uid, payload, timeout=None):
+        """
+        Make an RPC call without waiting for the reply.
 
-        # making sure order is in place!
-        res = self.json_dec.decode(self.response)
-        self.response = None
+        :param uid: user's id.
+        :param payload: JSON payload for the message.
+        :param timeout: Seconds to wait for the reply.
+        :return: A Future for the reply.
+        """
+        return self._get_client().call_async(uid, payload, timeout)
 
-        return res
+    def _get_client(self):
+        """
+        Return the RPC client shared by all requests.
+        """
+        with self.lock:
+            if self.client is None:
+                self.client = rpc.RPCClient(self.amqp_uri)
+                self.client.start()
+            return self.client
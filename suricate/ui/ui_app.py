@@ -10,16 +10,27 @@ that the WSGI middleware adds this.
 __author__ = 'tmetsch'
 
 import bottle
-import csv
 import inspect
 import json
 import os
+import time
 
 from StringIO import StringIO
 from bottle import template
 
+from suricate.data import streaming
 from suricate.ui import api
 
+MIME_TYPES = {'.json': 'application/json',
+              '.csv': 'text/csv'}
+
+# bytes of a data object shown in the UI.
+PREVIEW_SIZE = 64 * 1024
+# number of data objects shown per page.
+PAGE_SIZE = 50
+# seconds between checks for new output of a run.
+RUN_POLL = 0.5
+
 
 class AnalyticsApp(object):
     """
@@ -27,12 +38,14 @@ class AnalyticsApp(object):
     'get_wsgi_app'.
     """
 
-    def __init__(self, mongo_uri, amqp_uri):
+    def __init__(self, mongo_uri, amqp_uri, limits=None):
         """
         Initialize the Web Application
 
         :param mongo_uri: Connection details for MongoDB.
         :param amqp_uri: Connection details for RabbitMQ broker.
+        :param limits: resource limits of the runs (see [limits] section of
+            app.conf).
         """
         # configure bottle
         self.app = bottle.Bottle()
@@ -40,7 +53,7 @@ class AnalyticsApp(object):
             inspect.getfile(inspect.currentframe())))
 
         # API
-        self.api = api.API(amqp_uri, mongo_uri)
+        self.api = api.API(amqp_uri, mongo_uri, limits=limits)
 
         # Routing
         self._setup_routing()
@@ -69,9 +82,15 @@ class AnalyticsApp(object):
                        self.retrieve_data_stream)
         self.app.route('/data/stream/<iden>/delete', ['POST'],
                        self.delete_data_stream)
+        self.app.route('/data/stream/<iden>/triggers', ['POST'],
+                       self.create_trigger)
+        self.app.route('/data/stream/<iden>/triggers/<trigger_id>/delete',
+                       ['POST'], self.delete_trigger)
         # project mgmt
         self.app.route('/analytics', ['GET'],
                        self.list_projects)
+        self.app.route('/analytics/jobs/<job_id>/cancel', ['POST'],
+                       self.cancel_job)
         self.app.route('/analytics/clear', ['POST'],
                        self.clear_job_list)
         self.app.route('/analytics/create', ['POST'],
@@ -80,6 +99,11 @@ class AnalyticsApp(object):
                        self.retrieve_project)
         self.app.route('/analytics/<proj_name>/delete', ['POST'],
                        self.delete_project)
+        # schedules
+        self.app.route('/analytics/<proj_name>/schedules', ['POST'],
+                       self.create_schedule)
+        self.app.route('/analytics/<proj_name>/schedules/<schedule_id>/'
+                       'delete', ['POST'], self.delete_schedule)
         # notebook management
         self.app.route('/analytics/<proj_name>/create', ['POST'],
                        self.create_notebook)
@@ -91,6 +115,8 @@ class AnalyticsApp(object):
                        self.download_notebook)
         self.app.route('/analytics/<proj_name>/<ntb_id>/action', ['POST'],
                        self.action_notebook)
+        self.app.route('/analytics/<proj_name>/<ntb_id>/runs/<run_id>',
+                       ['GET'], self.run_events)
         self.app.route('/analytics/<proj_name>/<ntb_id>/interact', ['POST'],
                        self.interact)
         # tagging
@@ -111,10 +137,13 @@ class AnalyticsApp(object):
         Initial view.
         """
         uid, token = _get_cred()
-        jobs = self.api.list_jobs(uid, token)
+        skip = int(bottle.request.query.get('skip', 0))
+        total, jobs = self.api.list_jobs(uid, token, skip, PAGE_SIZE)
         data_info = self.api.info_data(uid, token)
+        next_skip = skip + PAGE_SIZE if skip + PAGE_SIZE < total else None
         return {'uid': uid,
                 'jobs': jobs,
+                'next_skip': next_skip,
                 'data_info': data_info}
 
     def static(self, filepath):
@@ -132,34 +161,34 @@ class AnalyticsApp(object):
         List all data sources.
         """
         uid, token = _get_cred()
-        objs, streams = self.api.list_data_sources(uid, token)
-        return {'data_objs': objs, 'data_streams': streams, 'uid': uid}
+        after = bottle.request.query.get('after')
+        objs, streams = self.api.list_data_sources(uid, token, after=after,
+                                                   limit=PAGE_SIZE)
+        if len(objs) == PAGE_SIZE:
+            next_page = objs[-1][0]
+        else:
+            next_page = None
+        return {'data_objs': objs, 'data_streams': streams, 'uid': uid,
+                'next_page': next_page}
 
     def create_data_obj(self):
         """
-        Create a new data source.
+        Create a new data source. The upload is streamed into the store
+        without parsing it.
         """
         uid, token = _get_cred()
         upload = bottle.request.files.get('upload')
         fname = bottle.request.files.get('upload').filename
         _, ext = os.path.splitext(upload.filename)
 
-        if ext == '.json':
-            tmp = json.loads(upload.file.read().decode('utf-8-sig'))
-        elif ext == '.csv':
-            reader = csv.reader(upload.file, delimiter=',', quotechar='"')
-            keys = next(reader)
-            out = [{key: val for key, val in zip(keys, prop)}
-                   for prop in reader]
-            tmp = json.dumps(out)
-        else:
+        if ext not in MIME_TYPES:
             return 'File extension not supported.'
 
         meta = {'name': fname,
-                'mime-type': 'application/json',
+                'mime-type': MIME_TYPES[ext],
                 'tags': []}
 
-        self.api.create_object(tmp, uid, token, meta_dat=meta)
+        self.api.create_object(upload.file, uid, token, meta_dat=meta)
         bottle.redirect('/data')
 
     @bottle.view('data_object.tmpl')
@@ -170,9 +199,13 @@ class AnalyticsApp(object):
         :param iden: Data source identifier.
         """
         uid, token = _get_cred()
-        obj = self.api.retrieve_object(iden, uid, token)
-        return {'obj_name': obj['meta']['name'],
-                'content': obj['value'],
+        meta, content = self.api.preview_object(iden, uid, token,
+                                                size=PREVIEW_SIZE)
+        if isinstance(content, str):
+            # preview might end in the middle of a character.
+            content = content.decode('utf-8', 'replace')
+        return {'obj_name': meta['name'],
+                'content': content,
                 'uid': uid}
 
     def delete_data_obj(self, iden):
@@ -192,11 +225,10 @@ class AnalyticsApp(object):
         :param iden: Data source identifier.
         """
         uid, token = _get_cred()
-        tmp = self.api.retrieve_object(iden, uid, token)
         bottle.response.set_header('Content-Type', 'application/json')
         bottle.response.set_header('Content-Disposition',
                                    'inline; filename=data.json')
-        return tmp['value']
+        return self.api.stream_object(iden, uid, token)
 
     def create_data_stream(self):
         """
@@ -205,7 +237,14 @@ class AnalyticsApp(object):
         uid, token = _get_cred()
         uri = bottle.request.forms.get('uri')
         queue = bottle.request.forms.get('queue')
-        self.api.create_stream(uri, queue, uid, token)
+        storage = bottle.request.forms.get('storage', 'raw')
+        retention = {}
+        for key in ['max_age', 'max_bytes']:
+            if bottle.request.forms.get(key):
+                retention[key] = int(bottle.request.forms.get(key))
+        compression = bottle.request.forms.get('compression') or None
+        self.api.create_stream(uri, queue, uid, token, storage=storage,
+                               retention=retention, compression=compression)
         bottle.redirect('/data')
 
     @bottle.view('data_stream.tmpl')
@@ -216,9 +255,11 @@ class AnalyticsApp(object):
         :param iden: Identifier of the stream.
         """
         uid, token = _get_cred()
-        uri, queue, msgs = self.api.retrieve_stream(iden, uid, token)
+        uri, queue, count, msgs = self.api.retrieve_stream(
+            iden, uid, token, limit=streaming.LATEST_SIZE)
+        triggers = self.api.list_triggers(iden, uid, token)
         return {'iden': iden, 'uri': uri, 'queue': queue, 'msgs': msgs,
-                'val': len(msgs), 'uid': uid}
+                'val': count, 'uid': uid, 'triggers': triggers}
 
     def delete_data_stream(self, iden):
         """
@@ -230,6 +271,34 @@ class AnalyticsApp(object):
         self.api.delete_stream(iden, uid, token)
         bottle.redirect('/data')
 
+    def create_trigger(self, iden):
+        """
+        Run a notebook on the messages of a data stream.
+
+        :param iden: Identifier of the stream.
+        """
+        uid, token = _get_cred()
+        forms = bottle.request.forms
+        condition = forms.get('condition') or None
+        threshold = forms.get('threshold') or None
+        self.api.create_trigger(iden, forms.get('proj_name'),
+                                forms.get('ntb_id'), uid, token,
+                                condition=condition, threshold=threshold,
+                                debounce=float(forms.get('debounce', 1.0)),
+                                max_batch=int(forms.get('max_batch', 100)))
+        bottle.redirect('/data/stream/' + iden)
+
+    def delete_trigger(self, iden, trigger_id):
+        """
+        Remove a trigger of a data stream.
+
+        :param iden: Identifier of the stream.
+        :param trigger_id: Identifier of the trigger.
+        """
+        uid, token = _get_cred()
+        self.api.delete_trigger(trigger_id, uid, token)
+        bottle.redirect('/data/stream/' + iden)
+
     def tag_item(self, data_src, iden):
         """
         Tag an data object.
@@ -273,9 +342,11 @@ class AnalyticsApp(object):
         """
         uid, token = _get_cred()
         tmp = self.api.retrieve_project(proj_name, uid, token)
+        schedules = self.api.list_schedules(proj_name, uid, token)
         return {'uid': uid,
                 'proj_name': proj_name,
-                'notebooks': tmp}
+                'notebooks': tmp,
+                'schedules': schedules}
 
     def delete_project(self, proj_name):
         """
@@ -287,6 +358,38 @@ class AnalyticsApp(object):
         self.api.delete_project(proj_name, uid, token)
         bottle.redirect('/analytics')
 
+    # Schedules.
+
+    def create_schedule(self, proj_name):
+        """
+        Run a notebook on a cron expression or a fixed interval.
+
+        :param proj_name: name of the project.
+        """
+        uid, token = _get_cred()
+        ntb_id = bottle.request.forms.get('ntb_id')
+        when = bottle.request.forms.get('when').strip()
+        misfire = bottle.request.forms.get('misfire', 'coalesce')
+        try:
+            # a number is an interval in seconds.
+            self.api.create_schedule(proj_name, ntb_id, uid, token,
+                                     interval=float(when), misfire=misfire)
+        except ValueError:
+            self.api.create_schedule(proj_name, ntb_id, uid, token,
+                                     cron=when, misfire=misfire)
+        bottle.redirect('/analytics/' + proj_name)
+
+    def delete_schedule(self, proj_name, schedule_id):
+        """
+        Remove a schedule.
+
+        :param proj_name: name of the project.
+        :param schedule_id: Identifier of the schedule.
+        """
+        uid, token = _get_cred()
+        self.api.delete_schedule(schedule_id, uid, token)
+        bottle.redirect('/analytics/' + proj_name)
+
     # Notebook mgmt.
 
     def create_notebook(self, proj_name):
@@ -338,7 +441,8 @@ class AnalyticsApp(object):
                 'ntb_name': tmp['meta']['name'],
                 'ntb_id': ntb_id,
                 'src': src,
-                'rendered_dashboard': rend}
+                'rendered_dashboard': rend,
+                'run_id': bottle.request.query.get('run')}
 
     def delete_notebook(self, proj_name, ntb_id):
         """
@@ -383,12 +487,29 @@ class AnalyticsApp(object):
             self.api.update_notebook(proj_name, ntb_id, src, uid, token)
             bottle.redirect('/analytics/' + proj_name + '/' + ntb_id)
         elif action == 'Run':
-            self.api.run_notebook(proj_name, ntb_id, src, uid, token)
-            bottle.redirect('/analytics/' + proj_name + '/' + ntb_id)
+            run_id = self.api.submit_run(proj_name, ntb_id, src, uid, token)
+            bottle.redirect('/analytics/' + proj_name + '/' + ntb_id +
+                            '?run=' + run_id)
         elif action == 'Run Job':
             self.api.run_job(proj_name, ntb_id, src, uid, token)
             bottle.redirect('/')
 
+    def run_events(self, proj_name, ntb_id, run_id):
+        """
+        Stream the output of a run as server-sent events. A 'done' event is
+        sent once the run finished. The request stays open while the run
+        lasts - so serve the app with a threaded or async WSGI server.
+
+        :param proj_name: name of the project.
+        :param ntb_id: Identifier for the notebook.
+        :param run_id: Identifier of the run.
+        """
+        uid, token = _get_cred()
+        bottle.response.content_type = 'text/event-stream'
+        bottle.response.set_header('Cache-Control', 'no-cache')
+        # runs are killed once they exceed the wall clock limit.
+        return _run_events(self.api, run_id, uid, token, self.api.timeout)
+
     def interact(self, proj_name, ntb_id):
         """
         Interact with a notebook's interpreter.
@@ -401,6 +522,16 @@ class AnalyticsApp(object):
         self.api.interact(proj_name, ntb_id, loc, uid, token)
         bottle.redirect('/analytics/' + proj_name + '/' + ntb_id)
 
+    def cancel_job(self, job_id):
+        """
+        Cancel a job.
+
+        :param job_id: Identifier of the job.
+        """
+        uid, token = _get_cred()
+        self.api.cancel_job(job_id, uid, token)
+        bottle.redirect('/')
+
     def clear_job_list(self):
         """
         Clear job list.
@@ -410,6 +541,34 @@ class AnalyticsApp(object):
         bottle.redirect('/')
 
 
+def _run_events(the_api, run_id, uid, token, idle):
+    """
+    Generate the server-sent events for the output of a run. Stops if the
+    run produced no output for idle seconds.
+    """
+    offset = 0
+    last_output = time.time()
+    while True:
+        run = the_api.retrieve_run(run_id, uid, token, offset)
+        if run is None:
+            yield 'event: done\ndata: ""\n\n'
+            break
+        for line in run['out']:
+            yield 'data: ' + json.dumps(line) + '\n\n'
+        if len(run['out']) > 0:
+            offset += len(run['out'])
+            last_output = time.time()
+        if run['state'] in ('done', 'failed'):
+            yield 'event: done\ndata: ' + json.dumps(run['err']) + '\n\n'
+            break
+        if time.time() - last_output > idle:
+            yield 'event: done\ndata: ' + \
+                json.dumps('No output for ' + str(idle) + 's - the run '
+                           'was probably interrupted.') + '\n\n'
+            break
+        time.sleep(RUN_POLL)
+
+
 def _get_cred():
     """
     Retrieve user credentials.
@@ -0,0 +1,230 @@
+# coding=utf-8
+
+"""
+Unit test for the scheduled notebooks.
+"""
+
+__author__ = 'tmetsch'
+
+import calendar
+import datetime
+import mox
+import unittest
+
+from pymongo import errors
+
+from suricate import rpc
+from suricate.analytics import cron
+from suricate.analytics import proj_ntb_store
+
+
+def _ts(*args):
+    """
+    Seconds since epoch of a UTC date.
+    """
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+class CronExpressionTest(unittest.TestCase):
+    """
+    Test the parsing & matching of cron expressions.
+    """
+
+    def test_next_time_for_success(self):
+        """
+        Test if the next matching minute is found.
+        """
+        now = _ts(2015, 3, 10, 12, 7, 30)
+        self.assertEquals(cron.CronExpression('*/15 * * * *').next_time(now),
+                          _ts(2015, 3, 10, 12, 15))
+        self.assertEquals(cron.CronExpression('0 3 * * *').next_time(now),
+                          _ts(2015, 3, 11, 3, 0))
+        self.assertEquals(cron.CronExpression('30 8 1 1,6 *').next_time(now),
+                          _ts(2015, 6, 1, 8, 30))
+        self.assertEquals(cron.CronExpression('0 0 * * *').next_time(
+            _ts(2015, 12, 31, 23, 59)), _ts(2016, 1, 1, 0, 0))
+
+    def test_next_time_for_sanity(self):
+        """
+        Test if day of month & week are combined like cron does.
+        """
+        now = _ts(2015, 3, 10, 12, 0)  # a tuesday.
+        # sunday as 0 or 7.
+        self.assertEquals(cron.CronExpression('0 0 * * 7').next_time(now),
+                          _ts(2015, 3, 15, 0, 0))
+        self.assertEquals(cron.CronExpression('0 0 * * 1-5').next_time(now),
+                          _ts(2015, 3, 11, 0, 0))
+        # both restricted: either matches.
+        self.assertEquals(cron.CronExpression('0 0 20 * 6').next_time(now),
+                          _ts(2015, 3, 14, 0, 0))
+        # strictly after.
+        self.assertEquals(cron.CronExpression('0 12 * * *').next_time(now),
+                          _ts(2015, 3, 11, 12, 0))
+
+    def test_parse_for_failure(self):
+        """
+        Test if invalid expressions are rejected.
+        """
+        self.assertRaises(AttributeError, cron.CronExpression, '* * * *')
+        self.assertRaises(AttributeError, cron.CronExpression, '60 * * * *')
+        self.assertRaises(AttributeError, cron.CronExpression, '5-1 * * * *')
+        self.assertRaises(ValueError, cron.CronExpression, 'a * * * *')
+        self.assertRaises(AttributeError,
+                          cron.CronExpression('0 0 31 2 *').next_time, 0)
+        self.assertRaises(AttributeError, cron.validate)
+        self.assertRaises(AttributeError, cron.validate, None, 0)
+        self.assertRaises(AttributeError, cron.validate, None, 5, 'foo')
+
+    def test_next_run_for_success(self):
+        """
+        Test if intervals stay in phase & missed occurrences are coalesced.
+        """
+        self.assertEquals(cron.next_run({'interval': 10}, 100), 110)
+        self.assertEquals(cron.next_run({'interval': 10, 'next_run': 100},
+                                        100), 110)
+        self.assertEquals(cron.next_run({'interval': 10, 'next_run': 100},
+                                        135), 140)
+        self.assertEquals(cron.next_run({'cron': '* * * * *',
+                                         'next_run': 0}, 90), 120)
+
+
+class CronDaemonTest(unittest.TestCase):
+    """
+    Test the triggering of schedules.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.schedules = self.mocker.CreateMock(proj_ntb_store.ScheduleStore)
+        self.jobs = self.mocker.CreateMock(proj_ntb_store.JobStore)
+        self.stor = self.mocker.CreateMock(proj_ntb_store.NotebookStore)
+        self.rpc = self.mocker.CreateMock(rpc.RPCClient)
+        self.cut = DaemonWrapper(self.schedules, self.jobs, self.stor,
+                                 self.rpc)
+        self.schedule = {'_id': 's1', 'project': 'qwe', 'ntb_id': 'n1',
+                         'interval': 10, 'next_run': 100,
+                         'misfire': 'coalesce', 'priority': 2,
+                         'last_job': 'j1'}
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_check_for_success(self):
+        """
+        Test if due schedules are submitted as jobs.
+        """
+        self.schedules.due('foo', 'bar', 101).AndReturn([self.schedule])
+        self.jobs.retrieve_job('j1', 'foo', 'bar').AndReturn(
+            {'state': 'done'})
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn(
+            {'src': 'print 1'})
+        self.rpc.call('foo', {'uid': 'foo', 'token': 'bar',
+                              'project_id': 'qwe', 'notebook_id': 'n1',
+                              'src': 'print 1', 'priority': 2,
+                              'schedule': 's1',
+                              'call': 'run_job'}).AndReturn({'job_id': 'j2'})
+        self.schedules.update_schedule('s1', 'foo', 'bar', inc='runs',
+                                       last_run=101, last_job='j2',
+                                       last_error=None, next_run=110)
+        self.mocker.ReplayAll()
+
+        self.cut.check(101)
+
+        self.mocker.VerifyAll()
+
+    def test_trigger_for_sanity(self):
+        """
+        Test if missed occurrences are run once or skipped.
+        """
+        del self.schedule['last_job']
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn(
+            {'src': 'print 1'})
+        self.rpc.call('foo', mox.IgnoreArg()).AndReturn({'job_id': 'j2'})
+        self.schedules.update_schedule('s1', 'foo', 'bar', inc='runs',
+                                       last_run=1005, last_job='j2',
+                                       last_error=None, next_run=1010)
+        self.schedules.update_schedule('s1', 'foo', 'bar', inc='skipped',
+                                       next_run=1010)
+        self.mocker.ReplayAll()
+
+        self.cut.trigger(self.schedule, 1005)
+        self.cut.trigger(dict(self.schedule, misfire='skip'), 1005)
+
+        self.mocker.VerifyAll()
+
+    def test_trigger_for_failure(self):
+        """
+        Test if a schedule is skipped while its previous job is running.
+        """
+        self.jobs.retrieve_job('j1', 'foo', 'bar').AndReturn(
+            {'state': 'running'})
+        self.schedules.update_schedule('s1', 'foo', 'bar', inc='skipped',
+                                       next_run=110)
+        self.mocker.ReplayAll()
+
+        self.cut.trigger(self.schedule, 101)
+
+        self.mocker.VerifyAll()
+
+    def test_check_for_failure(self):
+        """
+        Test if failing schedules are recorded & don't stop the others.
+        """
+        del self.schedule['last_job']
+        broken = {'_id': 's2', 'cron': 'foo', 'next_run': 100}
+        self.schedules.due('foo', 'bar', 101).AndReturn([self.schedule,
+                                                         broken])
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn(
+            {'src': 'print 1'})
+        self.rpc.call('foo', mox.IgnoreArg()).AndRaise(
+            AttributeError('Quota exceeded.'))
+        self.schedules.update_schedule('s1', 'foo', 'bar', inc='failed',
+                                       last_error='Quota exceeded.',
+                                       next_run=110)
+        self.schedules.update_schedule('s2', 'foo', 'bar', enabled=False,
+                                       last_error=mox.IsA(str))
+        self.mocker.ReplayAll()
+
+        self.cut.check(101)
+
+        self.mocker.VerifyAll()
+
+    def test_run_for_failure(self):
+        """
+        Test if the daemon backs off while the database is unreachable.
+        """
+        self.rpc.start()
+        self.schedules.due('foo', 'bar', mox.IsA(float)).AndRaise(
+            errors.AutoReconnect('down'))
+        self.mocker.StubOutWithMock(cron.time, 'sleep')
+        cron.time.sleep(2.0).WithSideEffects(lambda _: self.cut.stop())
+        self.mocker.ReplayAll()
+
+        self.cut.run()
+
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+
+class DaemonWrapper(cron.CronDaemon):
+    """
+    Wraps around the CronDaemon and disables the connections.
+    """
+
+    def __init__(self, schedules, jobs, stor, rpc):
+        self.uid = 'foo'
+        self.token = 'bar'
+        self.tick = 1.0
+        self.max_backoff = 60.0
+        self.schedules = schedules
+        self.jobs = jobs
+        self.stor = stor
+        self.rpc = rpc
+        self.running = True
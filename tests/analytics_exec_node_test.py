@@ -1,7 +1,9 @@
+import threading
 import time
 import unittest
 
-from suricate.analytics import exec_node, proj_ntb_store
+from suricate.analytics import exec_node, proj_ntb_store, scheduler
+from suricate.analytics import wrapper
 
 
 class ExecNodeTest(unittest.TestCase):
@@ -76,15 +78,18 @@ class ExecNodeTest(unittest.TestCase):
         # list jobs
         self.payload['call'] = 'list_jobs'
         time.sleep(2)
-        self.assertEquals(self.cut._handle(self.payload)['jobs'].values()[0],
-                          {'project': 'qwe', 'ntb_name': 'abc.py',
-                           'state': 'running', 'ntb_id': self.ntb_id})
+        tmp = self.cut._handle(self.payload)['jobs'].values()[0]
+        self.assertEquals((tmp['project'], tmp['ntb_name'], tmp['state'],
+                           tmp['ntb_id']),
+                          ('qwe', 'abc.py', 'running', self.ntb_id))
         time.sleep(10)
         tmp = self.cut._handle(self.payload)['jobs'].values()[0]
         self.assertEquals(tmp['project'], 'qwe')
         self.assertEquals(tmp['ntb_name'], 'abc.py')
         self.assertEquals(tmp['ntb_id'], self.ntb_id)
-        self.assertIsNot(tmp['state'].find('done'), -1)
+        self.assertEquals(tmp['state'], 'done')
+        self.assertGreater(tmp['duration'], 0)
+        self.cut.jobs.clear_jobs('foo', 'bar')
 
         # retrieve it
         self.payload['call'] = 'retrieve_notebook'
@@ -108,4 +113,13 @@ class ClassUnderTestWrapper(exec_node.ExecNode):
         self.uri = mongo_uri
         self.sdk = sdk
         # store
-        self.stor = proj_ntb_store.NotebookStore(mongo_uri, 'foo')
\ No newline at end of file
+        self.stor = proj_ntb_store.NotebookStore(mongo_uri, 'foo')
+        self.jobs = proj_ntb_store.JobStore(mongo_uri)
+        self.schedules = proj_ntb_store.ScheduleStore(mongo_uri)
+        self.recovered = False
+        self.lock = threading.Lock()
+        self.pool = wrapper.InterpreterPool(mongo_uri, sdk)
+        self.scheduler = scheduler.Scheduler()
+        self.quotas = exec_node.QUOTAS
+        self.usage = {}
+        self.wrappers = {}
\ No newline at end of file
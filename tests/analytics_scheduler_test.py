@@ -0,0 +1,478 @@
+# coding=utf-8
+
+"""
+Unit test for the scheduler of the execution node.
+"""
+
+__author__ = 'tmetsch'
+
+import json
+import mox
+import Queue
+import threading
+import unittest
+
+from suricate.analytics import exec_node
+from suricate.analytics import proj_ntb_store
+from suricate.analytics import scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    """
+    Test the scheduler.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.cut = scheduler.Scheduler(workers=2)
+        self.results = Queue.Queue()
+
+    def tearDown(self):
+        """
+        Stop the workers.
+        """
+        self.cut.stop()
+
+    def _done(self, res, err):
+        self.results.put((res, err))
+
+    def test_init_for_failure(self):
+        """
+        Test if a pool without workers is refused.
+        """
+        self.assertRaises(AttributeError, scheduler.Scheduler, 0)
+
+    def test_submit_for_priority(self):
+        """
+        Test if interactive calls overtake queued jobs of the same lane.
+        """
+        block = threading.Event()
+        order = []
+        self.cut.submit('a', 'slow', block.wait, (5,), self._done)
+        self.cut.submit('a', 'job', order.append, ('job p0',), self._done)
+        self.cut.submit('a', 'job', order.append, ('job p5',), self._done, 5)
+        self.cut.submit('a', 'run', order.append, ('interactive p10',),
+                        self._done, 10)
+        block.set()
+        for _ in range(4):
+            self.results.get(timeout=5)
+        self.assertEquals(order, ['interactive p10', 'job p5', 'job p0'])
+
+    def test_submit_for_sanity(self):
+        """
+        Test if the tasks of a lane run in order while other lanes proceed.
+        """
+        block = threading.Event()
+        order = []
+        self.cut.submit('a', 'slow', block.wait, (5,), self._done)
+        self.cut.submit('a', 'fast', order.append, ('a',), self._done)
+        self.cut.submit('b', 'fast', order.append, ('b',), self._done)
+
+        # b is not blocked by the slow task of a.
+        self.assertEquals(self.results.get(timeout=5), (None, None))
+        self.assertEquals(order, ['b'])
+        self.assertEquals(self.cut.depth(), 1)
+
+        block.set()
+        self.results.get(timeout=5)
+        self.results.get(timeout=5)
+        self.assertEquals(order, ['b', 'a'])
+        self.assertEquals(self.cut.depth(), 0)
+
+    def test_submit_for_success(self):
+        """
+        Test if lanes with higher priority are served first & lanes of the
+        same priority in FIFO order.
+        """
+        self.cut.stop()
+        self.cut = scheduler.Scheduler(workers=1)
+        block = threading.Event()
+        order = []
+        self.cut.submit('x', 'slow', block.wait, (5,), self._done)
+        for key, priority in [('a', 0), ('b', 0), ('c', 10), ('d', 0)]:
+            self.cut.submit(key, 'job', order.append, (key,), self._done,
+                            priority)
+        block.set()
+        for _ in range(5):
+            self.results.get(timeout=5)
+        self.assertEquals(order, ['c', 'a', 'b', 'd'])
+
+    def test_submit_for_failure(self):
+        """
+        Test if errors are handed to the callback.
+        """
+        self.cut.submit('a', 'div', lambda: 1 / 0, (), self._done)
+        res, err = self.results.get(timeout=5)
+        self.assertIsNone(res)
+        self.assertIsInstance(err, ZeroDivisionError)
+
+    def test_stats_for_success(self):
+        """
+        Test if latencies are tracked per call.
+        """
+        self.cut.submit('a', 'foo', max, (1, 2), self._done)
+        self.assertEquals(self.results.get(timeout=5), (2, None))
+        self.cut.record('bar', 0.0, 0.5)
+        res = self.cut.stats()
+        self.assertEquals(res['queued'], 0)
+        self.assertEquals(res['running'], 0)
+        self.assertEquals(res['latency']['foo']['count'], 1)
+        self.assertEquals(res['latency']['bar']['max_run'], 0.5)
+
+
+class ExecNodeTest(unittest.TestCase):
+    """
+    Test the dispatching of calls in the execution node.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.channel = self.mocker.CreateMockAnything()
+        self.sched = self.mocker.CreateMock(scheduler.Scheduler)
+        self.stor = self.mocker.CreateMock(proj_ntb_store.NotebookStore)
+        self.jobs = self.mocker.CreateMock(proj_ntb_store.JobStore)
+        self.cut = NodeWrapper(self.channel, self.sched, self.stor,
+                               self.jobs)
+        self.cut.schedules = self.mocker.CreateMock(
+            proj_ntb_store.ScheduleStore)
+        self.method = Frame(delivery_tag=1)
+        self.props = Frame(correlation_id='1', reply_to='foo')
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_callback_for_success(self):
+        """
+        Test if store calls are answered right away.
+        """
+        self.jobs.list_jobs('foo', 'bar', 0, None).AndReturn((0, {}))
+        self.sched.record('list_jobs', 0.0, mox.IsA(float))
+        self.channel.basic_publish(exchange='', routing_key='foo',
+                                   properties=mox.IgnoreArg(),
+                                   body=mox.Func(lambda body: json.loads(
+                                       body) == {'total': 0, 'jobs': {}}))
+        self.channel.basic_ack(delivery_tag=1)
+        self.mocker.ReplayAll()
+
+        self.cut.callback(self.channel, self.method, self.props,
+                          json.dumps({'uid': 'foo', 'token': 'bar',
+                                      'call': 'list_jobs'}))
+
+        self.mocker.VerifyAll()
+
+    def test_callback_for_sanity(self):
+        """
+        Test if interpreter calls are queued in the lane of the project and
+        answered once done.
+        """
+        body = {'uid': 'foo', 'token': 'bar', 'project_id': 'qwe',
+                'call': 'run_notebook'}
+        done = []
+        self.sched.submit('qwe', 'run_notebook', self.cut._handle, (body,),
+                          mox.Func(lambda func: done.append(func) or True),
+                          exec_node.INTERACTIVE_PRIORITY)
+        self.mocker.ReplayAll()
+
+        self.cut.callback(self.channel, self.method, self.props,
+                          json.dumps(body))
+
+        self.mocker.VerifyAll()
+        self.mocker.ResetAll()
+
+        # the worker finished - the connection thread replies.
+        self.channel.basic_publish(exchange='', routing_key='foo',
+                                   properties=mox.IgnoreArg(),
+                                   body=json.dumps({'error': 'boom'}))
+        self.channel.basic_ack(delivery_tag=1)
+        self.mocker.ReplayAll()
+
+        done[0](None, ValueError('boom'))
+        self.cut.send_replies()
+
+        self.mocker.VerifyAll()
+
+    def test_callback_for_failure(self):
+        """
+        Test if errors are reported to the caller.
+        """
+        self.sched.record('foo', 0.0, mox.IsA(float))
+        self.channel.basic_publish(exchange='', routing_key='foo',
+                                   properties=mox.IgnoreArg(),
+                                   body=json.dumps({'error': 'Cannot handle '
+                                                             'this action: '
+                                                             'foo'}))
+        self.channel.basic_ack(delivery_tag=1)
+        self.mocker.ReplayAll()
+
+        self.cut.callback(self.channel, self.method, self.props,
+                          json.dumps({'uid': 'foo', 'token': 'bar',
+                                      'call': 'foo'}))
+
+        self.mocker.VerifyAll()
+
+    def test_handle_for_success(self):
+        """
+        Test if submitted runs are queued in the project's lane & their id
+        is returned right away.
+        """
+        interpreter = object()
+        self.cut.wrappers = {'qwe': interpreter}
+        self.stor.create_run('qwe', 'n1', 'foo', 'bar').AndReturn('r1')
+        self.sched.submit('qwe', 'run_notebook', self.cut._stream_run,
+                          ('r1', 'qwe', 'n1', 'print 1', interpreter, 'foo',
+                           'bar'), None, exec_node.INTERACTIVE_PRIORITY)
+        self.mocker.ReplayAll()
+
+        self.assertEquals(self.cut._handle({'uid': 'foo', 'token': 'bar',
+                                            'project_id': 'qwe',
+                                            'notebook_id': 'n1',
+                                            'src': 'print 1',
+                                            'call': 'submit_run'}),
+                          {'run_id': 'r1'})
+
+        self.mocker.VerifyAll()
+
+    def test_run_job_for_success(self):
+        """
+        Test if jobs are registered & queued with their priority.
+        """
+        interpreter = object()
+        self.cut.wrappers = {'qwe': interpreter}
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn(
+            {'meta': {'name': 'abc.py'}})
+        self.jobs.create_job({'project': 'qwe', 'ntb_id': 'n1',
+                              'ntb_name': 'abc.py', 'src': 'print 1',
+                              'priority': 5, 'schedule': None}, 'foo',
+                             'bar').AndReturn('j1')
+        self.sched.submit('qwe', 'run_job', self.cut._run_job,
+                          ('j1', 'qwe', interpreter, 'foo', 'bar'), None, 5)
+        self.mocker.ReplayAll()
+
+        self.assertEquals(self.cut._handle({'uid': 'foo', 'token': 'bar',
+                                            'project_id': 'qwe',
+                                            'notebook_id': 'n1',
+                                            'src': 'print 1',
+                                            'priority': 5,
+                                            'call': 'run_job'}),
+                          {'job_id': 'j1'})
+
+        self.mocker.VerifyAll()
+
+    def test_trigger_run_for_success(self):
+        """
+        Test if triggered runs are queued as jobs with their messages and
+        not answered.
+        """
+        interpreter = object()
+        self.cut.wrappers = {'qwe': interpreter}
+        self.jobs.coalesce_job('t1', [{'resv': 1.0, 'body': 42}], 'foo',
+                               'bar', None).AndReturn(None)
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn(
+            {'meta': {'name': 'abc.py'}, 'src': 'print MESSAGES'})
+        self.jobs.create_job({'project': 'qwe', 'ntb_id': 'n1',
+                              'ntb_name': 'abc.py', 'src': 'print MESSAGES',
+                              'priority': 0, 'trigger': 't1',
+                              'inputs': [{'resv': 1.0, 'body': 42}]}, 'foo',
+                             'bar').AndReturn('j1')
+        self.sched.submit('qwe', 'run_job', self.cut._run_job,
+                          ('j1', 'qwe', interpreter, 'foo', 'bar'), None, 0)
+        self.sched.record('trigger_run', 0.0, mox.IsA(float))
+        self.channel.basic_ack(delivery_tag=1)
+        self.mocker.ReplayAll()
+
+        self.cut.callback(self.channel, self.method, Frame(reply_to=None),
+                          json.dumps({'uid': 'foo', 'token': 'bar',
+                                      'project_id': 'qwe',
+                                      'notebook_id': 'n1',
+                                      'trigger': 't1',
+                                      'messages': [{'resv': 1.0,
+                                                    'body': 42}],
+                                      'call': 'trigger_run'}))
+
+        self.mocker.VerifyAll()
+
+    def test_trigger_run_for_sanity(self):
+        """
+        Test if triggered runs are coalesced while the trigger's job is
+        still queued.
+        """
+        self.cut.wrappers = {'qwe': object()}
+        self.jobs.coalesce_job('t1', [{'resv': 2.0, 'body': 43}], 'foo',
+                               'bar', 10).AndReturn('j1')
+        self.mocker.ReplayAll()
+
+        self.assertEquals(self.cut._handle({'uid': 'foo', 'token': 'bar',
+                                            'project_id': 'qwe',
+                                            'notebook_id': 'n1',
+                                            'trigger': 't1',
+                                            'messages': [{'resv': 2.0,
+                                                          'body': 43}],
+                                            'max_batch': 10,
+                                            'call': 'trigger_run'}),
+                          {'job_id': 'j1'})
+
+        self.mocker.VerifyAll()
+
+    def test_run_job_for_sanity(self):
+        """
+        Test if jobs record their usage & cancelled jobs are skipped.
+        """
+        interpreter = Frame(run=lambda src, inputs, job: (['1'], ''),
+                            usage={'cpu': 1.0})
+        self.jobs.start_job('j1', 'foo', 'bar').AndReturn(
+            {'ntb_id': 'n1', 'src': 'print 1'})
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn({})
+        self.stor.update_notebook('qwe', 'n1', {'src': 'print 1',
+                                                'out': ['1'], 'err': ''},
+                                  'foo', 'bar')
+        self.jobs.finish_job('j1', 'foo', 'bar', usage={'cpu': 1.0},
+                             duration=mox.IsA(float))
+        self.jobs.start_job('j2', 'foo', 'bar').AndReturn(None)
+        self.mocker.ReplayAll()
+
+        self.cut._run_job('j1', 'qwe', interpreter, 'foo', 'bar')
+        self.cut._run_job('j2', 'qwe', interpreter, 'foo', 'bar')
+
+        self.mocker.VerifyAll()
+
+    def test_delete_notebook_for_success(self):
+        """
+        Test if the schedules of deleted notebooks & projects are removed.
+        """
+        self.stor.delete_notebook('qwe', 'n1', 'foo', 'bar')
+        self.cut.schedules.delete_schedules('qwe', 'foo', 'bar', 'n1')
+        self.stor.delete_project('qwe', 'foo', 'bar')
+        self.cut.schedules.delete_schedules('qwe', 'foo', 'bar')
+        self.mocker.ReplayAll()
+
+        self.cut._handle({'uid': 'foo', 'token': 'bar', 'project_id': 'qwe',
+                          'notebook_id': 'n1', 'call': 'delete_notebook'})
+        self.cut._handle({'uid': 'foo', 'token': 'bar', 'project_id': 'qwe',
+                          'call': 'delete_project'})
+
+        self.mocker.VerifyAll()
+
+    def test_cancel_job_for_success(self):
+        """
+        Test if cancelling a running job stops its interpreter.
+        """
+        interpreter = self.mocker.CreateMockAnything()
+        self.cut.wrappers = {'qwe': interpreter}
+        self.jobs.cancel_job('j1', 'foo', 'bar').AndReturn(
+            {'project': 'qwe', 'state': 'running'})
+        interpreter.cancel('j1')
+        self.jobs.cancel_job('j2', 'foo', 'bar').AndReturn(None)
+        self.mocker.ReplayAll()
+
+        body = {'uid': 'foo', 'token': 'bar', 'call': 'cancel_job',
+                'job_id': 'j1'}
+        self.assertEquals(self.cut._handle(body), {'cancelled': True})
+        body['job_id'] = 'j2'
+        self.assertEquals(self.cut._handle(body), {'cancelled': False})
+
+        self.mocker.VerifyAll()
+
+    def test_recover_for_success(self):
+        """
+        Test if queued jobs of a previous run of the node are queued again.
+        """
+        interpreter = object()
+        self.cut.wrappers = {'qwe': interpreter}
+        self.cut.recovered = False
+        self.jobs.interrupt_jobs('foo', 'bar')
+        self.stor.interrupt_runs('foo', 'bar')
+        self.jobs.list_queued('foo', 'bar').AndReturn(
+            [{'_id': 'j1', 'project': 'qwe', 'priority': 2}])
+        self.sched.submit('qwe', 'run_job', self.cut._run_job,
+                          ('j1', 'qwe', interpreter, 'foo', 'bar'), None, 2)
+        self.mocker.ReplayAll()
+
+        self.cut._recover('foo', 'bar')
+        self.cut._recover('foo', 'bar')
+
+        self.mocker.VerifyAll()
+
+    def test_stream_run_for_success(self):
+        """
+        Test if the output of a run is appended to the run as it comes.
+        """
+        def run(src, on_output):
+            on_output('a\nb')
+            return ['a', 'b'], ''
+
+        interpreter = Frame(run=run, usage={})
+        self.stor.update_run('r1', 'foo', 'bar', state='running')
+        self.stor.update_run('r1', 'foo', 'bar', lines=['a'])
+        self.stor.retrieve_notebook('qwe', 'n1', 'foo', 'bar').AndReturn({})
+        self.stor.update_notebook('qwe', 'n1', {'src': 'print 1',
+                                                'out': ['a', 'b'],
+                                                'err': ''}, 'foo', 'bar')
+        self.stor.update_run('r1', 'foo', 'bar', lines=['b'], state='done',
+                             err='', usage={})
+        self.mocker.ReplayAll()
+
+        self.cut._stream_run('r1', 'qwe', 'n1', 'print 1', interpreter,
+                             'foo', 'bar')
+
+        self.mocker.VerifyAll()
+
+    def test_handle_for_failure(self):
+        """
+        Test if projects which used up their quota cannot run code.
+        """
+        self.cut.quotas = {'cpu': 10, 'wall': None}
+        self.cut.usage = {'qwe': {'runs': 3, 'cpu': 12.0, 'wall': 20.0,
+                                  'max_rss': 0}}
+        self.assertRaises(AttributeError, self.cut._handle,
+                          {'uid': 'foo', 'token': 'bar', 'project_id': 'qwe',
+                           'call': 'run_notebook'})
+
+    def test_account_for_success(self):
+        """
+        Test if the resources used by runs add up per project.
+        """
+        interpreter = Frame(usage={'cpu': 1.5, 'wall': 2.0, 'max_rss': 10})
+        self.assertEquals(self.cut._account('qwe', interpreter),
+                          interpreter.usage)
+        interpreter.usage = {'cpu': 0.5, 'wall': 1.0, 'max_rss': 5}
+        self.cut._account('qwe', interpreter)
+        self.assertEquals(self.cut.usage['qwe'], {'runs': 2, 'cpu': 2.0,
+                                                  'wall': 3.0,
+                                                  'max_rss': 10})
+
+
+class Frame(object):
+    """
+    Stands in for AMQP methods & properties.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class NodeWrapper(exec_node.ExecNode):
+    """
+    Wraps around the ExecNode and disables the listening.
+    """
+
+    def __init__(self, channel, sched, stor, jobs):
+        self.uid = 'foo'
+        self.channel = channel
+        self.scheduler = sched
+        self.stor = stor
+        self.jobs = jobs
+        self.recovered = True
+        self.lock = threading.Lock()
+        self.replies = Queue.Queue()
+        self.quotas = exec_node.QUOTAS
+        self.usage = {}
+        self.wrappers = {}
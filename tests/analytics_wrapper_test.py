@@ -0,0 +1,250 @@
+# coding=utf-8
+
+"""
+Unit test for the interpreter wrappers & the pool of warm interpreters.
+"""
+
+__author__ = 'tmetsch'
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from suricate.analytics import wrapper
+from suricate.data import connection
+from suricate.data import object_store
+
+SDK = '''
+PRELOADS = globals().get('PRELOADS', 0) + 1
+RESETS = 0
+
+
+def reset():
+    global RESETS
+    RESETS += 1
+'''
+
+
+class PythonWrapperTest(unittest.TestCase):
+    """
+    Test the in-process interpreter.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sdk = os.path.join(self.tmp_dir, 'sdk.py')
+        with open(self.sdk, 'w') as tmp:
+            tmp.write(SDK)
+
+    def tearDown(self):
+        """
+        Remove the SDK.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_for_success(self):
+        """
+        Test if a warm interpreter only resets the preload.
+        """
+        cut = wrapper.PythonWrapper('foo', 'bar', 'mongodb://', self.sdk,
+                                    warm=True)
+        cut.run('pass')
+        self.assertEquals(cut.run('print PRELOADS, RESETS, UID'),
+                          (['1 2 foo'], ''))
+
+        cut = wrapper.PythonWrapper('foo', 'bar', 'mongodb://', self.sdk)
+        cut.run('pass')
+        self.assertEquals(cut.run('print PRELOADS, RESETS'), (['2 0'], ''))
+
+        self.assertEquals(cut.run('print len(MESSAGES)', [{'body': 1}]),
+                          (['1'], ''))
+        self.assertEquals(cut.run('print len(MESSAGES)'), (['0'], ''))
+
+    def test_run_for_sanity(self):
+        """
+        Test if the output of concurrent runs is not mixed up.
+        """
+        res = {}
+
+        def run(name):
+            cut = wrapper.PythonWrapper('foo', 'bar', 'mongodb://', self.sdk)
+            res[name] = cut.run('for i in range(200):\n    print "' + name +
+                                '"')
+
+        threads = [threading.Thread(target=run, args=(name,))
+                   for name in ['a', 'b', 'c']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in ['a', 'b', 'c']:
+            self.assertEquals(res[name], ([name] * 200, ''))
+
+
+class InterpreterPoolTest(unittest.TestCase):
+    """
+    Test the pool of warm interpreter processes.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        sdk = os.path.join(self.tmp_dir, 'sdk.py')
+        with open(sdk, 'w') as tmp:
+            tmp.write(SDK)
+        self.cut = wrapper.InterpreterPool('mongodb://', sdk, spares=1,
+                                           max_runs=2)
+
+    def tearDown(self):
+        """
+        Stop the workers & remove the SDK.
+        """
+        self.cut.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_for_success(self):
+        """
+        Test if runs are done in a warm process keeping its state.
+        """
+        interpreter = self.cut.wrapper('foo', 'bar')
+        self.assertEquals(interpreter.run('x = 1\nprint PRELOADS, UID'),
+                          (['1 foo'], ''))
+        self.assertEquals(interpreter.interact('print x + 1'), (['2'], ''))
+        self.assertEquals(interpreter.run('print MESSAGES[0]["body"]',
+                                          inputs=[{'body': 42}]),
+                          (['42'], ''))
+        self.assertNotEquals(interpreter.worker.process.pid, os.getpid())
+        interpreter.stop()
+
+    def test_run_for_sanity(self):
+        """
+        Test if workers are recycled after max. runs.
+        """
+        interpreter = self.cut.wrapper('foo', 'bar')
+        interpreter.run('pass')
+        first = interpreter.worker.process.pid
+        interpreter.run('pass')
+        self.assertEquals(interpreter.worker.process.pid, first)
+        self.assertEquals(interpreter.run('print RESETS'), (['1'], ''))
+        self.assertNotEquals(interpreter.worker.process.pid, first)
+        interpreter.stop()
+
+    def test_run_for_failure(self):
+        """
+        Test if a crashed worker is replaced.
+        """
+        interpreter = self.cut.wrapper('foo', 'bar')
+        out, err = interpreter.run('import os\nos._exit(1)')
+        self.assertNotEquals(err, '')
+        self.assertEquals(interpreter.run('print PRELOADS'), (['1'], ''))
+        interpreter.stop()
+
+    def test_limits_for_failure(self):
+        """
+        Test if runs exceeding their limits are stopped.
+        """
+        self.cut.limits.update({'cpu': 1, 'wall': 3, 'output': 50})
+        self.cut.stop()
+        interpreter = self.cut.wrapper('foo', 'bar')
+
+        out, err = interpreter.run('print "x" * 100')
+        self.assertEquals(out[0], 'x' * 50)
+        self.assertEquals(interpreter.usage['output'], 100)
+
+        out, err = interpreter.run('while True:\n    pass')
+        self.assertIn('LimitExceeded', err)
+        self.assertGreaterEqual(interpreter.usage['cpu'], 1)
+
+        out, err = interpreter.run('import time\ntime.sleep(10)')
+        self.assertIn('Wall clock limit', err)
+        self.assertTrue(interpreter.usage['killed'])
+        self.assertEquals(interpreter.run('print 1'), (['1'], ''))
+        interpreter.stop()
+
+    def test_fork_for_failure(self):
+        """
+        Test if workers started while locks are held don't deadlock & slow
+        starts are aborted.
+        """
+        self.cut.stop()
+        interpreter = self.cut.wrapper('foo', 'bar')
+        with connection.CLIENTS_LOCK, object_store.STORES_LOCK:
+            out, err = interpreter.run('from suricate.data import '
+                                       'object_store\n'
+                                       'print object_store.get_object_stor('
+                                       '"memory://").__class__.__name__')
+        self.assertEquals((out, err), (['MemoryStore'], ''))
+        interpreter.stop()
+
+        with open(self.cut.sdk, 'a') as tmp:
+            tmp.write('import time\ntime.sleep(10)\n')
+        self.cut.limits['start'] = 1
+        self.cut.stop()
+        out, err = interpreter.run('print 1')
+        self.assertIn('did not start', err)
+        self.assertFalse(interpreter.worker.alive)
+
+    def test_cancel_for_sanity(self):
+        """
+        Test if only the run of the cancelled job is aborted.
+        """
+        interpreter = self.cut.wrapper('foo', 'bar')
+        interpreter.run('x = 1', job='j1')
+        pid = interpreter.worker.process.pid
+        # j2 did not start yet - j1 keeps its worker & j2 is skipped.
+        interpreter.cancel('j2')
+        self.assertTrue(interpreter.worker.alive)
+        self.assertEquals(interpreter.worker.process.pid, pid)
+        self.assertEquals(interpreter.run('print x', job='j2'),
+                          ([''], 'Cancelled.'))
+        self.assertEquals(interpreter.run('print x', job='j3'), (['1'], ''))
+
+        timer = threading.Timer(0.5, interpreter.cancel, ['j4'])
+        timer.start()
+        out, err = interpreter.run('import time\ntime.sleep(10)', job='j4')
+        timer.join()
+        self.assertIn('died', err)
+        self.assertFalse(interpreter.worker.alive)
+        interpreter.stop()
+
+    def test_reap_for_sanity(self):
+        """
+        Test if the workers of least recently used & idle projects are
+        stopped.
+        """
+        self.cut.max_workers = 1
+        first = self.cut.wrapper('foo', 'bar')
+        second = self.cut.wrapper('foo', 'bar')
+        first.run('x = 1')
+        worker = first.worker
+        second.run('y = 1')
+        self.assertIsNone(first.worker)
+        self.assertFalse(worker.alive)
+        self.assertEquals(self.cut.bound.keys(), [second])
+        out, err = first.run('print x')
+        self.assertIn('NameError', err)
+        self.assertIsNone(second.worker)
+
+        self.cut.max_idle = 0
+        self.cut.reap()
+        self.assertIsNone(first.worker)
+        self.assertEquals(len(self.cut.bound), 0)
+
+    def test_stream_for_success(self):
+        """
+        Test if the output of a run is handed over while the code runs.
+        """
+        interpreter = self.cut.wrapper('foo', 'bar')
+        chunks = []
+        out, err = interpreter.run('import time\nprint "a"\ntime.sleep(0.2)'
+                                   '\nprint "b",', chunks.append)
+        self.assertEquals((out, err), (['a', 'b'], ''))
+        self.assertEquals(chunks, ['a\n', 'b\n'])
+        interpreter.stop()
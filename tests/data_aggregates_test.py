@@ -0,0 +1,138 @@
+# coding=utf-8
+
+"""
+Unit test for the incremental aggregations.
+"""
+
+__author__ = 'tmetsch'
+
+import json
+import random
+import unittest
+
+import numpy as np
+
+from suricate.data import aggregates
+
+
+class SlidingWindowTest(unittest.TestCase):
+    """
+    Test the sliding window.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        random.seed(42)
+        self.values = [random.gauss(10, 3) for _ in range(500)]
+
+    def test_add_for_sanity(self):
+        """
+        Test if the aggregates match the ones of the values in the window.
+        """
+        cut = aggregates.SlidingWindow(100)
+        for i, value in enumerate(self.values):
+            cut.add(float(i), value)
+        tmp = cut.result()
+        window = np.asarray(self.values[-100:])
+
+        self.assertEquals(tmp['count'], 100)
+        self.assertAlmostEquals(tmp['sum'], window.sum())
+        self.assertAlmostEquals(tmp['mean'], window.mean())
+        self.assertAlmostEquals(tmp['variance'], window.var())
+        self.assertEquals(tmp['min'], window.min())
+        self.assertEquals(tmp['max'], window.max())
+        for key, quantile in [('p50', 50), ('p90', 90), ('p99', 99)]:
+            expected = np.percentile(window, quantile)
+            self.assertTrue(abs(tmp['quantiles'][key] - expected) <
+                            0.05 * abs(expected) + 0.5)
+
+    def test_advance_for_sanity(self):
+        """
+        Test if values leave the window over time.
+        """
+        cut = aggregates.SlidingWindow(10)
+        cut.add(1.0, 5.0)
+        cut.add(2.0, -1.0)
+        cut.advance(11.5)
+        self.assertEquals(cut.result()['count'], 1)
+        self.assertEquals(cut.result()['min'], -1.0)
+        cut.advance(100.0)
+        self.assertEquals(cut.result()['count'], 0)
+        self.assertEquals(cut.result()['mean'], None)
+        # the time of the last message is kept apart from the current time.
+        self.assertEquals((cut.last, cut.consumed), (100.0, 2.0))
+        cut = aggregates.from_state(json.loads(json.dumps(cut.state())))
+        self.assertEquals(cut.consumed, 2.0)
+
+    def test_state_for_sanity(self):
+        """
+        Test if a restored window continues where the old one stopped.
+        """
+        cut = aggregates.SlidingWindow(100)
+        other = aggregates.SlidingWindow(100)
+        for i, value in enumerate(self.values[:250]):
+            cut.add(float(i), value)
+            other.add(float(i), value)
+        state = json.loads(json.dumps(cut.state()))
+        cut = aggregates.from_state(state)
+        for i, value in enumerate(self.values[250:]):
+            cut.add(float(i + 250), value)
+            other.add(float(i + 250), value)
+        self.assertEquals(cut.result(), other.result())
+
+    def test_state_for_success(self):
+        """
+        Test if the state of a window stays bounded & windows persisted with
+        all their values are restored.
+        """
+        cut = aggregates.SlidingWindow(100)
+        for i in range(20000):
+            cut.add(i / 100.0, self.values[i % 500])
+        self.assertEquals(cut.result()['count'], 10000)
+        self.assertEquals(len(cut.state()['parts']), 100)
+
+        state = {'kind': 'sliding', 'size': 10, 'quantiles': [0.5],
+                 'last': 3.0, 'consumed': 3.0,
+                 'values': [[2.0, 1.0], [3.0, 4.0]],
+                 'stats': {}, 'sketch': {'alpha': 0.01}, 'mins': [],
+                 'maxs': []}
+        cut = aggregates.from_state(state)
+        tmp = cut.result()
+        self.assertEquals((tmp['count'], tmp['mean']), (2, 2.5))
+        self.assertEquals((tmp['min'], tmp['max']), (1.0, 4.0))
+        self.assertEquals(cut.consumed, 3.0)
+
+
+class TumblingWindowTest(unittest.TestCase):
+    """
+    Test the tumbling window.
+    """
+
+    def test_add_for_sanity(self):
+        """
+        Test if windows are closed when a message of the next one arrives.
+        """
+        cut = aggregates.create('tumbling', 10)
+        self.assertEquals(cut.add(1.0, 1.0), None)
+        self.assertEquals(cut.add(5.0, 3.0), None)
+        tmp = cut.add(12.0, 10.0)
+        self.assertEquals(tmp['start'], 0.0)
+        self.assertEquals(tmp['count'], 2)
+        self.assertEquals(tmp['mean'], 2.0)
+        self.assertEquals(tmp['variance'], 1.0)
+        self.assertEquals((tmp['min'], tmp['max']), (1.0, 3.0))
+        self.assertEquals(cut.result()['count'], 1)
+        self.assertEquals(cut.result()['start'], 10.0)
+
+        # restored windows still close.
+        cut = aggregates.from_state(json.loads(json.dumps(cut.state())))
+        self.assertEquals(cut.advance(25.0)['mean'], 10.0)
+        self.assertEquals(cut.closed['mean'], 10.0)
+
+    def test_create_for_failure(self):
+        """
+        Test if unknown windows are rejected.
+        """
+        self.assertRaises(AttributeError, aggregates.create, 'foo', 10)
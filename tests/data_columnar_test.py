@@ -0,0 +1,64 @@
+# coding=utf-8
+
+"""
+Unit test for the columnar encoding.
+"""
+
+__author__ = 'tmetsch'
+
+import numpy as np
+import unittest
+
+from suricate.data import columnar
+
+
+class ColumnarTest(unittest.TestCase):
+    """
+    Test encoding & decoding.
+    """
+
+    def test_is_columnar_for_sanity(self):
+        """
+        Test which data can be encoded.
+        """
+        self.assertTrue(columnar.is_columnar({'server1': [10, 20, 30]}))
+        self.assertTrue(columnar.is_columnar({'a': np.zeros((2, 3)),
+                                              'b': [True, False]}))
+        self.assertFalse(columnar.is_columnar({}))
+        self.assertFalse(columnar.is_columnar({'mean': 1.5}))
+        self.assertFalse(columnar.is_columnar({'a': ['foo', 'bar']}))
+        self.assertFalse(columnar.is_columnar([1, 2, 3]))
+
+    def test_encode_for_success(self):
+        """
+        Test if data survives a round trip.
+        """
+        data = {'server1': [10, 20, 30, 10],
+                'server2': np.arange(6, dtype='>f4').reshape(2, 3)}
+        buf, columns = columnar.encode(data)
+        self.assertTrue(columnar.is_encoded(buf))
+        self.assertEquals(sorted(col['name'] for col in columns),
+                          ['server1', 'server2'])
+
+        res = columnar.decode(buf)
+        np.testing.assert_array_equal(res['server1'], [10, 20, 30, 10])
+        np.testing.assert_array_equal(res['server2'],
+                                      data['server2'])
+        self.assertEquals(res['server2'].dtype.str, '<f4')
+        self.assertEquals(res['server2'].shape, (2, 3))
+
+    def test_decode_for_sanity(self):
+        """
+        Test if decoded arrays are views on the buffer.
+        """
+        buf, _ = columnar.encode({'a': [1.0, 2.0], 'b': []})
+        res = columnar.decode(buf)
+        self.assertFalse(res['a'].flags.owndata)
+        self.assertFalse(res['a'].flags.writeable)
+        self.assertEquals(res['b'].shape, (0,))
+
+    def test_decode_for_failure(self):
+        """
+        Test if not encoded values are rejected.
+        """
+        self.assertRaises(ValueError, columnar.decode, '{"a": [1, 2]}')
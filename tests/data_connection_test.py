@@ -0,0 +1,117 @@
+# coding=utf-8
+
+"""
+Unit test for the connection handling.
+"""
+
+__author__ = 'tmetsch'
+
+import mox
+import unittest
+
+from pymongo import MongoClient
+from pymongo import errors
+from pymongo.database import Database
+
+from suricate.data import connection
+
+
+class AuthCacheTest(unittest.TestCase):
+    """
+    Test the cache for authenticated database handles.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.cut = connection.AuthCache(ttl=60)
+        self.mongo_client = self.mocker.CreateMock(MongoClient)
+        self.mongo_db = self.mocker.CreateMock(Database)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.UnsetStubs()
+        self.mocker.ResetAll()
+
+    def test_get_database_for_success(self):
+        """
+        Test if second lookup is served from the cache.
+        """
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+
+        self.mocker.ReplayAll()
+        self.assertEquals(self.cut.get_database(self.mongo_client, '123',
+                                                'abc'), self.mongo_db)
+        self.assertEquals(self.cut.get_database(self.mongo_client, '123',
+                                                'abc'), self.mongo_db)
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats(), {'hits': 1, 'misses': 1,
+                                             'invalidations': 0, 'size': 1})
+
+    def test_get_database_for_sanity(self):
+        """
+        Test if new token or expired entries lead to authentication.
+        """
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.logout()
+        self.mongo_db.authenticate('123', 'efg')
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'efg')
+
+        self.mocker.ReplayAll()
+        self.cut.get_database(self.mongo_client, '123', 'abc')
+        self.cut.ttl = -1
+        self.cut.get_database(self.mongo_client, '123', 'efg')
+        self.cut.get_database(self.mongo_client, '123', 'efg')
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['misses'], 3)
+
+    def test_database_for_failure(self):
+        """
+        Test if auth failures invalidate the cached handle.
+        """
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+
+        self.mocker.ReplayAll()
+        try:
+            with self.cut.database(self.mongo_client, '123', 'abc'):
+                raise errors.OperationFailure('not authorized', code=13)
+        except errors.OperationFailure:
+            pass
+        with self.cut.database(self.mongo_client, '123', 'abc') as dbs:
+            self.assertEquals(dbs, self.mongo_db)
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['invalidations'], 1)
+
+    def test_database_for_sanity(self):
+        """
+        Test if other failures do not invalidate the cached handle.
+        """
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+
+        self.mocker.ReplayAll()
+        try:
+            with self.cut.database(self.mongo_client, '123', 'abc'):
+                raise errors.OperationFailure('exception: bad query', code=2)
+        except errors.OperationFailure:
+            pass
+        with self.cut.database(self.mongo_client, '123', 'abc'):
+            pass
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['hits'], 1)
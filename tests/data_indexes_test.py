@@ -0,0 +1,108 @@
+# coding=utf-8
+
+"""
+Unit test for the index handling.
+"""
+
+__author__ = 'tmetsch'
+
+import mox
+import unittest
+
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from suricate.data import indexes
+
+
+class IndexesTest(unittest.TestCase):
+    """
+    Test creation & audit of indexes.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.mongo_db = self.mocker.CreateMock(Database)
+        self.mongo_coll = self.mocker.CreateMock(Collection)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_ensure_indexes_for_sanity(self):
+        """
+        Test if indexes for objects, streams and messages are created.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find(fields={'_id': True}).AndReturn([{'_id': 'a'}])
+        self.mongo_db.__getitem__('data_aggregates').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.ensure_index([('stream', 1), ('name', 1)])
+        self.mongo_db.__getitem__('data_jobs').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('created', -1)])
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('meta.tags', 1)])
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('meta.name', 1)])
+        self.mongo_db.__getitem__('data_runs').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('project', 1), ('ntb_id', 1)])
+        self.mongo_db.__getitem__('data_schedules').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.ensure_index([('next_run', 1)])
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('meta.tags', 1)])
+        self.mongo_db.__getitem__('data_triggers').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.ensure_index([('stream', 1)])
+        self.mongo_db.__getitem__('data_streams.a').AndReturn(self.mongo_coll)
+        self.mongo_coll.ensure_index([('resv', 1)])
+        self.mongo_db.__getitem__('data_streams.a.rollups').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.ensure_index([('res', 1), ('resv', 1)], unique=True)
+
+        self.mocker.ReplayAll()
+        indexes.ensure_indexes(self.mongo_db)
+        self.mocker.VerifyAll()
+
+    def test_audit_for_sanity(self):
+        """
+        Test if missing indexes and slow queries are reported.
+        """
+        existing = {'_id_': {'key': [('_id', 1)]},
+                    'meta.tags_1': {'key': [('meta.tags', 1.0)]}}
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find(fields={'_id': True}).AndReturn([])
+        for _ in range(8):
+            self.mongo_db.__getitem__(mox.IsA(str)).AndReturn(
+                self.mongo_coll)
+            self.mongo_coll.index_information().AndReturn(existing)
+        self.mongo_db.__getitem__('system.profile').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.find({'millis': {'$gte': 100}},
+                             sort=[('millis', -1)],
+                             limit=10).AndReturn([{'ns': 'foo.data_objects',
+                                                   'op': 'query',
+                                                   'millis': 250,
+                                                   'query': {'a': 1}}])
+
+        self.mocker.ReplayAll()
+        tmp = indexes.audit(self.mongo_db)
+        self.mocker.VerifyAll()
+
+        self.assertEquals(tmp['missing_indexes'],
+                          [('data_aggregates', [('stream', 1), ('name', 1)]),
+                           ('data_jobs', [('created', -1)]),
+                           ('data_objects', [('meta.name', 1)]),
+                           ('data_runs', [('project', 1), ('ntb_id', 1)]),
+                           ('data_schedules', [('next_run', 1)]),
+                           ('data_triggers', [('stream', 1)])])
+        self.assertEquals(tmp['slow_queries'], [{'ns': 'foo.data_objects',
+                                                 'op': 'query',
+                                                 'millis': 250,
+                                                 'query': {'a': 1}}])
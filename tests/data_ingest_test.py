@@ -0,0 +1,124 @@
+# coding=utf-8
+
+"""
+Unit test for the ingest daemon.
+"""
+
+__author__ = 'tmetsch'
+
+import mox
+import unittest
+
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from suricate.data import connection
+from suricate.data import ingest
+from suricate.data import streaming
+
+
+class IngestDaemonTest(unittest.TestCase):
+    """
+    Test the ingest daemon.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.mongo_db = self.mocker.CreateMock(Database)
+        self.mongo_coll = self.mocker.CreateMock(Collection)
+        self.service = self.mocker.CreateMock(streaming.IngestService)
+        self.cut = DaemonWrapper(self.mongo_db, self.service)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_owns_for_sanity(self):
+        """
+        Test if every stream belongs to exactly one shard.
+        """
+        idens = ['%024x' % i for i in range(100)]
+        owned = []
+        for shard in range(3):
+            self.cut.shard = shard
+            self.cut.shards = 3
+            owned.append(set(iden for iden in idens if self.cut.owns(iden)))
+        self.assertEquals(sum(len(item) for item in owned), 100)
+        self.assertEquals(set.union(*owned), set(idens))
+        self.assertTrue(all(len(item) > 0 for item in owned))
+
+    def test_sync_for_success(self):
+        """
+        Test if new streams are added, deleted ones removed, triggers set &
+        stats reported.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find(fields={'uri': True, 'queue': True,
+                                     'storage': True}).AndReturn(
+            [{'_id': 'foo', 'uri': u'amqp://', 'queue': u'queue'}])
+        self.service.stats().AndReturn({'bar': {}})
+        self.service.remove_stream('bar')
+        self.service.add_stream('uid', 'token', 'foo', 'amqp://', 'queue',
+                                'raw')
+        self.mongo_db.__getitem__('data_triggers').AndReturn(self.mongo_coll)
+        self.mongo_coll.find({'stream': {'$in': ['foo']}}).AndReturn(
+            [{'_id': 't1', 'stream': 'foo', 'debounce': 0.5}])
+        self.service.set_triggers('foo', {'t1': {'stream': 'foo',
+                                                 'debounce': 0.5}})
+        self.service.stats().AndReturn({'foo': {'lag': 0.0}})
+        self.mocker.StubOutWithMock(streaming, 'storage_usage')
+        streaming.storage_usage(self.mongo_db, 'foo').AndReturn(
+            {'size': 10, 'count': 1})
+        self.mongo_coll.update({'_id': 'foo'},
+                               {'$set': {'ingest': {'lag': 0.0},
+                                         'usage': {'size': 10,
+                                                   'count': 1}}})
+
+        self.mocker.ReplayAll()
+        self.cut.sync()
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+    def test_init_for_failure(self):
+        """
+        Test if invalid shards are rejected.
+        """
+        self.assertRaises(AttributeError, ingest.IngestDaemon,
+                          'mongodb://localhost', 'uid', 'token', 3, 3)
+
+
+class DaemonWrapper(ingest.IngestDaemon):
+    """
+    Wraps around the IngestDaemon and hands out a mocked database.
+    """
+
+    def __init__(self, database, service):
+        self.client = None
+        self.auth_cache = CacheWrapper(database)
+        self.uid = 'uid'
+        self.token = 'token'
+        self.shard = 0
+        self.shards = 1
+        self.service = service
+        self.usage_interval = 60.0
+        self.measured = 0
+        self.running = True
+
+
+class CacheWrapper(connection.AuthCache):
+    """
+    Hands out the given database without authenticating.
+    """
+
+    def __init__(self, database):
+        super(CacheWrapper, self).__init__()
+        self.mongo_db = database
+
+    def get_database(self, client, uid, token):
+        return self.mongo_db
@@ -6,16 +6,61 @@ Unit test for the object store part.
 
 __author__ = 'tmetsch'
 
+import StringIO
 import mox
+import shutil
+import tempfile
+import time
 import unittest
 
+from bson import Binary
+from bson import ObjectId
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
 
+from suricate.data import connection
 from suricate.data import object_store
 
 
+class GetObjectStorTest(unittest.TestCase):
+    """
+    Test the factory.
+    """
+
+    def test_get_object_stor_for_success(self):
+        """
+        Test if the right stores are returned.
+        """
+        self.assertIsInstance(object_store.get_object_stor('memory://'),
+                              object_store.MemoryStore)
+        self.assertIsInstance(object_store.get_object_stor('file:///tmp'),
+                              object_store.FileStore)
+        self.assertIsInstance(object_store.get_object_stor('memory://',
+                                                           cached=True),
+                              object_store.CachedStore)
+
+    def test_get_object_stor_for_failure(self):
+        """
+        Test unknown schemes.
+        """
+        self.assertRaises(AttributeError, object_store.get_object_stor,
+                          'foo://bar')
+        # not implemented yet.
+        self.assertRaises(AttributeError, object_store.get_object_stor,
+                          'cdmi://foo')
+
+    def test_get_object_stor_for_sanity(self):
+        """
+        Test if instances are shared.
+        """
+        tmp = object_store.get_object_stor('memory://')
+        self.assertIs(object_store.get_object_stor('memory://'), tmp)
+        self.assertIsNot(object_store.get_object_stor('memory://abc'), tmp)
+        self.assertIs(object_store.get_object_stor('memory://',
+                                                   cached=True).store, tmp)
+
+
 class ObjectStoreTest(unittest.TestCase):
     """
     Test for the uber class :-)
@@ -66,9 +111,9 @@ class MongoStoreTest(unittest.TestCase):
         self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
         self.mongo_db.authenticate('123', 'abc')
         self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
-        self.mongo_coll.find({}).AndReturn([{'_id': 'foo',
-                                             'meta': {'tags': []},
-                                             'content': 'bar'}])
+        self.mongo_coll.find({}, fields={'meta': True}, sort=[('_id', 1)],
+                             limit=0).AndReturn([{'_id': 'foo',
+                                                  'meta': {'tags': []}}])
 
         self.mocker.ReplayAll()
         tmp = self.cut.list_objects('123', 'abc')
@@ -76,6 +121,34 @@ class MongoStoreTest(unittest.TestCase):
 
         self.assertListEqual(tmp, [('foo', {'tags': []})])
 
+    def test_list_objects_for_paging(self):
+        """
+        Test keyset pagination & projection.
+        """
+        query = {'meta.tags': 'a',
+                 '_id': {'$gt': ObjectId('520f896217b168455c7d5fb9')}}
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find(query, fields={'meta.name': True},
+                             sort=[('_id', 1)],
+                             limit=10).AndReturn([{'_id': 'foo',
+                                                   'meta': {'name': 'x'}}])
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find({}, fields={'_id': True},
+                             sort=[('_id', 1)]).AndReturn([{'_id': 'foo'}])
+
+        self.mocker.ReplayAll()
+        tmp = self.cut.list_objects('123', 'abc', query={'meta.tags': 'a'},
+                                    limit=10,
+                                    after='520f896217b168455c7d5fb9',
+                                    fields=['name'])
+        tmp2 = list(self.cut.iter_objects('123', 'abc', fields=[]))
+        self.mocker.VerifyAll()
+
+        self.assertListEqual(tmp, [('foo', {'name': 'x'})])
+        self.assertListEqual(tmp2, [('foo', {})])
+
     def test_create_object_for_sanity(self):
         """
         Test creation.
@@ -119,11 +192,24 @@ class MongoStoreTest(unittest.TestCase):
         self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
         self.mongo_db.authenticate('123', 'abc')
         self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
-        self.mongo_coll.update(mox.IsA(dict), mox.IsA(dict), upsert=False)
+        self.mongo_coll.find_and_modify(mox.IsA(dict), mox.IsA(dict),
+                                        upsert=False,
+                                        fields={'blob': True}).AndReturn({})
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_and_modify(
+            mox.IsA(dict),
+            {'$set': {'value': {'a': 123}, 'meta.mime-type': 'N/A'},
+             '$unset': {'blob': True, 'length': True, 'encoding': True,
+                        'meta.columns': True}},
+            upsert=False, fields={'blob': True}).AndReturn({})
 
         self.mocker.ReplayAll()
         self.cut.update_object('123', 'abc', '520f896217b168455c7d5fb9',
                                {'a': 123})
+        # meta data is updated in the same write.
+        self.cut.update_object('123', 'abc', '520f896217b168455c7d5fb9',
+                               {'a': 123},
+                               meta={'mime-type': 'N/A', 'columns': None})
         self.mocker.VerifyAll()
 
     def test_delete_object_for_sanity(self):
@@ -133,12 +219,354 @@ class MongoStoreTest(unittest.TestCase):
         self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
         self.mongo_db.authenticate('123', 'abc')
         self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
-        self.mongo_coll.remove(mox.IsA(dict))
+        self.mongo_coll.find_and_modify(mox.IsA(dict), remove=True,
+                                        fields={'blob': True}).AndReturn({})
 
         self.mocker.ReplayAll()
         self.cut.delete_object('123', 'abc', '520f896217b168455c7d5fb9')
         self.mocker.VerifyAll()
 
+    def test_create_object_for_blob(self):
+        """
+        Test if large file like objects are stored in chunks - small ones in
+        the document.
+        """
+        self.mocker.StubOutWithMock(object_store, 'BLOB_THRESHOLD')
+        object_store.BLOB_THRESHOLD = 4
+        upload = StringIO.StringIO('a,b\n1,2')
+        self.mocker.StubOutWithMock(object_store, '_put_blob')
+        self.mongo_client.__getitem__('123').MultipleTimes().AndReturn(
+            self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc').MultipleTimes()
+        self.mongo_db.__getitem__('data_objects').MultipleTimes().AndReturn(
+            self.mongo_coll)
+        object_store._put_blob(self.mongo_db, 'a,b\n1',
+                               rest=upload).AndReturn(
+            {'blob': 'foo', 'length': 7, 'encoding': None})
+        self.mongo_coll.insert({'blob': 'foo', 'length': 7,
+                                'encoding': None,
+                                'meta': {'tags': [],
+                                         'name': 'foo'}}).AndReturn('foo123')
+        self.mongo_coll.insert({'value': Binary('a,b'),
+                                'meta': {'tags': [],
+                                         'name': 'bar'}}).AndReturn('bar123')
+
+        self.mocker.ReplayAll()
+        tmp = self.cut.create_object('123', 'abc', upload,
+                                     meta={'tags': [], 'name': 'foo'})
+        tmp2 = self.cut.create_object('123', 'abc',
+                                      StringIO.StringIO('a,b'),
+                                      meta={'tags': [], 'name': 'bar'})
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+        self.assertEquals(tmp, 'foo123')
+        self.assertEquals(tmp2, 'bar123')
+
+    def test_put_blob_for_sanity(self):
+        """
+        Test if the encoding of text is recorded - binary data has none.
+        """
+        blobs = self.mocker.CreateMockAnything()
+        blob = self.mocker.CreateMockAnything()
+        self.mocker.StubOutWithMock(object_store, '_blobs')
+        object_store._blobs(self.mongo_db).MultipleTimes().AndReturn(blobs)
+        blobs.new_file().MultipleTimes().AndReturn(blob)
+        blob.write(mox.IgnoreArg()).MultipleTimes()
+        blob.close().MultipleTimes()
+        blob._id = 'foo'
+        blob.length = 2
+
+        self.mocker.ReplayAll()
+        text = object_store._put_blob(self.mongo_db, '{}')
+        data = object_store._put_blob(self.mongo_db, '\xff\xfe')
+        binary = object_store._put_blob(self.mongo_db, Binary('{}'))
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+        self.assertEquals(text['encoding'], 'utf-8')
+        self.assertEquals(data['encoding'], None)
+        self.assertEquals(binary['encoding'], None)
+
+    def test_read_object_for_sanity(self):
+        """
+        Test ranged reads on chunked and plain objects.
+        """
+        blobs = self.mocker.CreateMockAnything()
+        blob = self.mocker.CreateMockAnything()
+        self.mocker.StubOutWithMock(object_store, '_blobs')
+        self.mongo_client.__getitem__('123').AndReturn(self.mongo_db)
+        self.mongo_db.authenticate('123', 'abc')
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields=mox.IsA(dict)).AndReturn(
+            {'_id': None, 'blob': 'foo'})
+        object_store._blobs(self.mongo_db).AndReturn(blobs)
+        blobs.get('foo').AndReturn(blob)
+        blob.seek(10)
+        blob.read(5).AndReturn('12345')
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields=mox.IsA(dict)).AndReturn(
+            {'_id': None, 'value': u'0123456789'})
+        self.mongo_db.__getitem__('data_objects').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields=mox.IsA(dict)).AndReturn(
+            {'_id': None, 'value': u'gr\xfc\xdfe'})
+
+        self.mocker.ReplayAll()
+        self.assertEquals(self.cut.read_object('123', 'abc',
+                                               '520f896217b168455c7d5fb9',
+                                               10, 5), '12345')
+        self.assertEquals(self.cut.read_object('123', 'abc',
+                                               '520f896217b168455c7d5fb9',
+                                               2, 3), '234')
+        # offsets are bytes of the UTF-8 encoding - like for blobs.
+        self.assertEquals(self.cut.read_object('123', 'abc',
+                                               '520f896217b168455c7d5fb9',
+                                               2, 4), '\xc3\xbc\xc3\x9f')
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+
+class CachedStoreTest(unittest.TestCase):
+    """
+    Test the caching decorator.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.store = self.mocker.CreateMock(object_store.ObjectStore)
+        self.cut = object_store.CachedStore(self.store, max_bytes=100)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_retrieve_object_for_success(self):
+        """
+        Test if objects are served from the cache.
+        """
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': 1})
+
+        self.mocker.ReplayAll()
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', 'a'),
+                          {'value': 1})
+        tmp = self.cut.retrieve_object('123', 'abc', 'a')
+        self.mocker.VerifyAll()
+
+        self.assertEquals(tmp, {'value': 1})
+        # returned objects are copies - immutable values are shared.
+        val = 'x' * 10
+        self.cut.entries[('123', 'b')] = ('abc', {'value': val}, 10,
+                                          time.time() + 60)
+        self.assertTrue(self.cut.retrieve_object('123', 'abc',
+                                                 'b')['value'] is val)
+        tmp['value'] = 2
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', 'a'),
+                          {'value': 1})
+        self.assertEquals(self.cut.stats()['hits'], 3)
+        self.assertEquals(self.cut.stats()['misses'], 1)
+
+    def test_retrieve_object_for_sanity(self):
+        """
+        Test if other tokens & expired entries are not served from cache.
+        """
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': 1})
+        self.store.retrieve_object('123', 'efg', 'a').AndReturn({'value': 1})
+        self.store.retrieve_object('123', 'efg', 'a').AndReturn({'value': 1})
+
+        self.mocker.ReplayAll()
+        self.cut.retrieve_object('123', 'abc', 'a')
+        self.cut.ttl = -1
+        self.cut.retrieve_object('123', 'efg', 'a')
+        self.cut.retrieve_object('123', 'efg', 'a')
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['hit_ratio'], 0.0)
+
+    def test_update_object_for_sanity(self):
+        """
+        Test if updates & deletes invalidate the cache.
+        """
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': 1})
+        self.store.update_object('123', 'abc', 'a', 2, meta=None)
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': 2})
+        self.store.delete_object('123', 'abc', 'a')
+
+        self.mocker.ReplayAll()
+        self.cut.retrieve_object('123', 'abc', 'a')
+        self.cut.update_object('123', 'abc', 'a', 2)
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', 'a'),
+                          {'value': 2})
+        self.cut.delete_object('123', 'abc', 'a')
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['objects'], 0)
+        self.assertEquals(self.cut.stats()['bytes'], 0)
+
+    def test_update_object_for_failure(self):
+        """
+        Test if values read before a concurrent update are not cached.
+        """
+        def update(*_):
+            self.cut.update_object('123', 'abc', 'a', 2)
+
+        self.store.retrieve_object('123', 'abc', 'a').WithSideEffects(
+            update).AndReturn({'value': 1})
+        self.store.update_object('123', 'abc', 'a', 2, meta=None)
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': 2})
+
+        self.mocker.ReplayAll()
+        self.cut.retrieve_object('123', 'abc', 'a')
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', 'a'),
+                          {'value': 2})
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.stats()['objects'], 1)
+        self.assertEquals(self.cut.loading, {})
+        self.assertEquals(self.cut.generations, {})
+
+    def test_eviction_for_sanity(self):
+        """
+        Test if least recently used objects get evicted.
+        """
+        val = 'x' * 30
+        self.store.retrieve_object('123', 'abc', 'a').AndReturn({'value': val})
+        self.store.retrieve_object('123', 'abc', 'b').AndReturn({'value': val})
+        self.store.retrieve_object('123', 'abc', 'c').AndReturn({'value': val})
+        self.store.retrieve_object('123', 'abc', 'b').AndReturn({'value': val})
+
+        self.mocker.ReplayAll()
+        self.cut.retrieve_object('123', 'abc', 'a')
+        self.cut.retrieve_object('123', 'abc', 'b')
+        # a is used again - so b is the least recently used one.
+        self.cut.retrieve_object('123', 'abc', 'a')
+        self.cut.retrieve_object('123', 'abc', 'c')
+        self.cut.retrieve_object('123', 'abc', 'b')
+        self.mocker.VerifyAll()
+
+        self.assertTrue(self.cut.stats()['bytes'] <= 100)
+        self.assertEquals(self.cut.stats()['evictions'], 2)
+
+
+class MemoryStoreTest(unittest.TestCase):
+    """
+    Test the in memory storage.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.cut = object_store.MemoryStore()
+
+    def test_crud_for_sanity(self):
+        """
+        Test create, retrieve, update and delete.
+        """
+        iden = self.cut.create_object('123', 'abc', {'foo': 'bar'},
+                                      meta={'tags': ['a'], 'name': 'foo'})
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', iden),
+                          {'value': {'foo': 'bar'},
+                           'meta': {'tags': ['a'], 'name': 'foo'}})
+        self.assertEquals(self.cut.list_objects('123', 'abc'),
+                          [(str(iden), {'tags': ['a'], 'name': 'foo'})])
+        self.assertEquals(self.cut.list_objects('123', 'abc',
+                                                {'meta.tags': 'a'}),
+                          [(str(iden), {'tags': ['a'], 'name': 'foo'})])
+        self.assertEquals(self.cut.list_objects('123', 'abc',
+                                                {'meta.tags': 'b'}), [])
+        self.assertEquals(self.cut.list_objects('456', 'abc'), [])
+
+        self.cut.update_object('123', 'abc', iden, 'bar')
+        self.assertEquals(self.cut.retrieve_object('123', 'abc',
+                                                   iden)['value'], 'bar')
+        self.assertEquals(self.cut.info('123', 'abc'),
+                          {'number_of_objects': 1})
+        self.cut.update_object('123', 'abc', iden, 'foo',
+                               meta={'name': 'bar', 'tags': None})
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', iden),
+                          {'value': 'foo', 'meta': {'name': 'bar'}})
+
+        self.cut.delete_object('123', 'abc', iden)
+        self.assertEquals(self.cut.list_objects('123', 'abc'), [])
+
+    def test_list_objects_for_paging(self):
+        """
+        Test keyset pagination & projection.
+        """
+        idens = [str(self.cut.create_object('123', 'abc', i,
+                                            meta={'name': str(i),
+                                                  'tags': []}))
+                 for i in range(5)]
+        tmp = self.cut.list_objects('123', 'abc', limit=2, fields=['name'])
+        self.assertEquals(tmp, [(idens[0], {'name': '0'}),
+                                (idens[1], {'name': '1'})])
+        tmp = self.cut.list_objects('123', 'abc', limit=2, after=idens[1])
+        self.assertEquals([item[0] for item in tmp], idens[2:4])
+        tmp = self.cut.list_objects('123', 'abc', limit=2, after=idens[3])
+        self.assertEquals([item[0] for item in tmp], idens[4:])
+        self.assertEquals([item[0] for item in
+                           self.cut.iter_objects('123', 'abc')], idens)
+
+
+class FileStoreTest(unittest.TestCase):
+    """
+    Test the file based storage.
+    """
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cut = object_store.FileStore('file://' + self.tmp_dir)
+
+    def tearDown(self):
+        """
+        Remove the files.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_crud_for_sanity(self):
+        """
+        Test create, retrieve, update and delete.
+        """
+        self.assertEquals(self.cut.list_objects('123', 'abc'), [])
+        iden = self.cut.create_object('123', 'abc', {'foo': 'bar'},
+                                      meta={'tags': ['a'], 'name': 'foo'})
+        self.assertEquals(self.cut.retrieve_object('123', 'abc', iden),
+                          {'value': {'foo': 'bar'},
+                           'meta': {'tags': ['a'], 'name': 'foo'}})
+        self.assertEquals(self.cut.list_objects('123', 'abc',
+                                                {'meta.tags': 'a'}),
+                          [(str(iden), {'tags': ['a'], 'name': 'foo'})])
+
+        self.cut.update_object('123', 'abc', iden, 'bar')
+        self.assertEquals(self.cut.retrieve_object('123', 'abc',
+                                                   iden)['value'], 'bar')
+        self.assertEquals(self.cut.info('123', 'abc'),
+                          {'number_of_objects': 1})
+
+        self.cut.delete_object('123', 'abc', iden)
+        self.assertEquals(self.cut.list_objects('123', 'abc'), [])
+
+    def test_retrieve_object_for_failure(self):
+        """
+        Test if paths outside of the store are rejected.
+        """
+        self.assertRaises(AttributeError, self.cut.retrieve_object,
+                          '..', 'abc', '520f896217b168455c7d5fb9')
+        self.assertRaises(Exception, self.cut.retrieve_object,
+                          '123', 'abc', '../../etc/passwd')
+
 
 class CDMIStoreTest(unittest.TestCase):
     """
@@ -155,4 +583,4 @@ class Wrapper(object_store.MongoStore):
     """
 
     def __init__(self, host, port, uri):
-        pass
\ No newline at end of file
+        self.auth_cache = connection.AuthCache()
@@ -0,0 +1,66 @@
+# coding=utf-8
+
+"""
+Unit test for the payload decoding.
+"""
+
+__author__ = 'tmetsch'
+
+import json
+import unittest
+import zlib
+
+from bson import binary
+
+from suricate.data import payloads
+
+
+class PayloadsTest(unittest.TestCase):
+    """
+    Test decoding of message payloads.
+    """
+
+    def test_decode_for_success(self):
+        """
+        Test if known content types & encodings are decoded.
+        """
+        self.assertEquals(payloads.decode('42'), ['42'])
+        self.assertEquals(payloads.decode('{"a": 1}',
+                                          'application/json; charset=utf-8'),
+                          [{'a': 1}])
+        tmp = zlib.compress(json.dumps([1, 2, 3]))
+        self.assertEquals(payloads.decode(tmp, 'application/json',
+                                          'deflate', batch=True),
+                          [1, 2, 3])
+
+    def test_decode_for_failure(self):
+        """
+        Test if broken payloads are reported.
+        """
+        self.assertRaises(ValueError, payloads.decode, 'foo',
+                          'application/json')
+        self.assertRaises(ValueError, payloads.decode, 'foo', None, 'gzip')
+        self.assertRaises(ValueError, payloads.decode, 'foo', None, 'lz4')
+        # truncated streams & decompression bombs.
+        tmp = zlib.compress('x' * 1000)
+        self.assertRaises(ValueError, payloads.decode, tmp[:-2], None,
+                          'deflate')
+        self.assertEquals(payloads.decode(tmp, None, 'deflate'), ['x' * 1000])
+        payloads.MAX_SIZE = 999
+        self.assertRaises(ValueError, payloads.decode, tmp, None, 'deflate')
+        payloads.MAX_SIZE = 16 * 1024 * 1024
+        self.assertRaises(ValueError, payloads.decode, '{}',
+                          'application/json', batch=True)
+        # can't be stored as documents.
+        self.assertRaises(ValueError, payloads.decode, '{"cpu.load": 5}',
+                          'application/json')
+        self.assertRaises(ValueError, payloads.decode, '[{"$set": 1}]',
+                          'application/json', batch=True)
+
+    def test_as_text_for_sanity(self):
+        """
+        Test if binary payloads are wrapped.
+        """
+        self.assertEquals(payloads.as_text('foo'), 'foo')
+        tmp = payloads.as_text('\xff\xfe')
+        self.assertTrue(isinstance(tmp, binary.Binary))
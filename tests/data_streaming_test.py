@@ -6,22 +6,980 @@ Tests for the streaming support.
 
 __author__ = 'tmetsch'
 
+import StringIO
+import collections
+import datetime
+import gzip
+import json
+import mox
+import pika
+import time
 import unittest
 
+from pika import spec
+from pika.adapters import blocking_connection
+from pymongo import errors
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from suricate.data import aggregates
+from suricate.data import connection
+from suricate.data import indexes
+from suricate.data import streaming
+
 
 class StreamClientTest(unittest.TestCase):
+    """
+    Test the stream client.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.mongo_db = self.mocker.CreateMock(Database)
+        self.mongo_coll = self.mocker.CreateMock(Collection)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_get_messages_for_success(self):
+        """
+        Test if messages are unpacked from the buckets.
+        """
+        self.mongo_db.__getitem__('data_streams.foo').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.aggregate(mox.Func(
+            lambda pipe: pipe[1] == {'$unwind': '$msgs'} and
+            pipe[-2] == {'$limit': 2}), cursor={}).AndReturn(
+                iter([{'body': 'b'}, {'body': 'a'}]))
+
+        self.mocker.ReplayAll()
+        tmp = streaming._get_messages(self.mongo_db, 'foo', 60.0, 120.0,
+                                      'bucket', limit=2, order=-1)
+        self.mocker.VerifyAll()
+        self.assertEquals(list(tmp), [{'body': 'b'}, {'body': 'a'}])
+
+    def test_get_messages_for_sanity(self):
+        """
+        Test if filters, limits & counts are pushed down to the database.
+        """
+        cursor = self.mocker.CreateMockAnything()
+        self.mongo_db.__getitem__('data_streams.foo').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.find({'body.host': 'a',
+                              'resv': {'$gt': 60.0, '$lte': 120.0}},
+                             fields={'_id': False, 'body': True},
+                             sort=[('resv', 1)], limit=0).AndReturn(cursor)
+        cursor.count(with_limit_and_skip=True).AndReturn(5)
+        self.mongo_db.__getitem__('data_streams.foo').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.aggregate(mox.Func(
+            lambda pipe: pipe[2] == {'$match': {
+                'msgs.body.host': 'a',
+                'msgs.resv': {'$gt': 60.0, '$lte': 120.0}}}),
+            cursor={}).AndReturn(iter([{'_id': None, 'count': 3}]))
+
+        self.mocker.ReplayAll()
+        tmp = streaming._get_messages(self.mongo_db, 'foo', 60.0, 120.0,
+                                      'raw', query={'body.host': 'a'},
+                                      count_only=True)
+        self.assertEquals(tmp, 5)
+        tmp = streaming._get_messages(self.mongo_db, 'foo', 60.0, 120.0,
+                                      'bucket', query={'body.host': 'a'},
+                                      count_only=True)
+        self.assertEquals(tmp, 3)
+        self.mocker.VerifyAll()
+
+    def test_get_messages_for_failure(self):
+        """
+        Test if only the body can be filtered on.
+        """
+        self.assertRaises(AttributeError, streaming._get_messages,
+                          self.mongo_db, 'foo', 60.0, 120.0, 'raw',
+                          query={'resv': 1})
+        self.assertRaises(AttributeError, streaming._get_messages,
+                          self.mongo_db, 'foo', 60.0, 120.0, 'raw', order=0)
+
+    def test_get_rollups_for_success(self):
+        """
+        Test if the mean is derived from the rollups.
+        """
+        self.mongo_db.__getitem__('data_streams.foo.rollups').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.find({'res': 60, 'resv': {'$gt': 0.0, '$lte': 120.0}},
+                             sort=[('resv', 1)]).AndReturn(
+            [{'resv': 60.0, 'count': 4, 'sum': 10.0, 'min': 1.0,
+              'max': 4.0}])
+
+        self.mocker.ReplayAll()
+        tmp = streaming._get_rollups(self.mongo_db, 'foo', 60.0, 120.0, 60)
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, [{'time': 60.0, 'count': 4, 'min': 1.0,
+                                 'max': 4.0, 'mean': 2.5}])
+
+    def test_get_rollups_for_failure(self):
+        """
+        Test if unknown resolutions are rejected.
+        """
+        self.assertRaises(AttributeError, streaming._get_rollups,
+                          self.mongo_db, 'foo', 60.0, 120.0, 5)
+
+    def test_tail_for_success(self):
+        """
+        Test if only new messages are yielded in batches until the timeout.
+        """
+        msgs = self.mocker.CreateMock(Collection)
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields={'storage': True,
+                                         'retention': True}).AndReturn(
+            {'storage': 'raw'})
+        self.mongo_db.__getitem__(
+            'data_streams.000000000000000000000001').AndReturn(msgs)
+        msgs.find({'resv': {'$gt': 10.0}}, fields=mox.IgnoreArg(),
+                  sort=[('resv', 1), ('_id', 1)], limit=2).AndReturn(
+            [{'_id': 'a', 'resv': 11.0, 'body': 'x'},
+             {'_id': 'b', 'resv': 12.0, 'body': 'y'}])
+        msgs.find({'$or': [{'resv': {'$gt': 12.0}},
+                           {'resv': 12.0, '_id': {'$gt': 'b'}}]},
+                  fields=mox.IgnoreArg(), sort=mox.IgnoreArg(),
+                  limit=2).AndReturn([])
+
+        self.mocker.ReplayAll()
+        cut = ClientWrapper(self.mongo_db)
+        tmp = list(cut.tail('foo', 'bar', '000000000000000000000001',
+                            since=10.0, batch_size=2, timeout=0))
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, [[{'time': 11.0, 'body': 'x'},
+                                 {'time': 12.0, 'body': 'y'}]])
+
+    def test_tail_for_failure(self):
+        """
+        Test if tailing unknown streams fails.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields=mox.IgnoreArg()).AndReturn(None)
+
+        self.mocker.ReplayAll()
+        cut = ClientWrapper(self.mongo_db)
+        self.assertRaises(AttributeError, list,
+                          cut.tail('foo', 'bar', '000000000000000000000001'))
+        self.mocker.VerifyAll()
+
+    def test_load_window_for_success(self):
+        """
+        Test if persisted windows are restored.
+        """
+        state = aggregates.SlidingWindow(10).state()
+        self.mongo_db.__getitem__('data_aggregates').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.find_one({'stream': 'foo', 'name': 'bar'}).AndReturn(
+            {'state': state})
+        self.mongo_db.__getitem__('data_aggregates').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.update({'stream': 'foo', 'name': 'bar'},
+                               {'$set': {'state': state}}, upsert=True)
+
+        self.mocker.ReplayAll()
+        cut = ClientWrapper(self.mongo_db)
+        tmp = cut.load_window('uid', 'token', 'foo', 'bar')
+        cut.save_window('uid', 'token', 'foo', 'bar', tmp)
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp.size, 10)
+
+    def test_latest_for_success(self):
+        """
+        Test if the latest messages are served from the stream's document.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields={'storage': True,
+                                         'latest': {'$slice': -2}}).AndReturn(
+            {'latest': [{'time': 1.0, 'body': 'a'},
+                        {'time': 2.0, 'body': 'b'}]})
+
+        self.mocker.ReplayAll()
+        cut = ClientWrapper(self.mongo_db)
+        tmp = cut.latest('uid', 'token', '000000000000000000000001', 2)
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, [{'time': 2.0, 'body': 'b'},
+                                {'time': 1.0, 'body': 'a'}])
+
+    def test_latest_for_sanity(self):
+        """
+        Test if more messages than cached are queried.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find_one(mox.IsA(dict),
+                                 fields=mox.IgnoreArg()).AndReturn({})
+        self.mongo_db.__getitem__(
+            'data_streams.000000000000000000000001').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.find(fields={'resv': True, 'body': True},
+                             sort=[('resv', -1)], limit=50).AndReturn(
+            [{'resv': 2.0, 'body': 'b'}])
+
+        self.mocker.ReplayAll()
+        tmp = streaming._get_latest(self.mongo_db,
+                                    '000000000000000000000001', 50)
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, [{'time': 2.0, 'body': 'b'}])
+
+    def test_stream_tail_for_sanity(self):
+        """
+        Test if bucketed streams are unpacked after the position.
+        """
+        self.mongo_db.__getitem__('data_streams.foo').AndReturn(
+            self.mongo_coll)
+        self.mongo_coll.aggregate(mox.Func(
+            lambda pipe: pipe[2] == {'$match': {'msgs.resv': {'$gt': 70.0}}}
+        ), cursor={}).AndReturn(iter([{'time': 71.0, 'body': 'a'}]))
+
+        self.mocker.ReplayAll()
+        cut = streaming.StreamTail(self.mongo_db, 'foo', 'bucket', False,
+                                   70.0)
+        self.assertEquals(cut.fetch(10), [{'time': 71.0, 'body': 'a'}])
+        self.mocker.VerifyAll()
+        self.assertEquals(cut.last, 71.0)
+
+    def test_bucket_updates_for_sanity(self):
+        """
+        Test if messages are grouped per bucket.
+        """
+        msgs = [{'resv': 61.0, 'body': 'a'},
+                {'resv': 62.0, 'body': 'b'},
+                {'resv': 125.0, 'body': 'c'}]
+        tmp = streaming._bucket_updates(msgs)
+        self.assertEquals(tmp, [({'resv': 60.0,
+                                  'count': {'$lte': 998}},
+                                 {'$push': {'msgs': {'$each': msgs[:2]}},
+                                  '$inc': {'count': 2},
+                                  '$max': {'ts': datetime.datetime(
+                                      1970, 1, 1, 0, 1, 2)}}),
+                                ({'resv': 120.0,
+                                  'count': {'$lte': 999}},
+                                 {'$push': {'msgs': {'$each': msgs[2:]}},
+                                  '$inc': {'count': 1},
+                                  '$max': {'ts': datetime.datetime(
+                                      1970, 1, 1, 0, 2, 5)}})])
+
+    def test_bucket_updates_for_failure(self):
+        """
+        Test if full buckets roll over into new documents.
+        """
+        streaming.MAX_PER_BUCKET = 2
+        msgs = [{'resv': 61.0, 'body': 'a'},
+                {'resv': 62.0, 'body': 'b'},
+                {'resv': 63.0, 'body': 'c'}]
+        tmp = streaming._bucket_updates(msgs)
+        streaming.MAX_PER_BUCKET = 1000
+        self.assertEquals([item[0] for item in tmp],
+                          [{'resv': 60.0, 'count': {'$lte': 0}},
+                           {'resv': 60.0, 'count': {'$lte': 1}}])
+        self.assertEquals(tmp[0][1]['$push'], {'msgs': {'$each': msgs[:2]}})
+        self.assertEquals(tmp[1][1]['$push'], {'msgs': {'$each': msgs[2:]}})
+
+    def test_rollup_updates_for_sanity(self):
+        """
+        Test if only numeric messages are rolled up per resolution.
+        """
+        msgs = [{'resv': 61.2, 'body': '2'},
+                {'resv': 61.7, 'body': '4.5'},
+                {'resv': 62.0, 'body': 'foo'}]
+        tmp = streaming._rollup_updates(msgs)
+        latest = datetime.datetime(1970, 1, 1, 0, 1, 1, 700000)
+        self.assertEquals(tmp, [({'res': 1, 'resv': 61.0},
+                                 {'$inc': {'count': 2, 'sum': 6.5},
+                                  '$min': {'min': 2.0},
+                                  '$max': {'max': 4.5, 'ts': latest}}),
+                                ({'res': 60, 'resv': 60.0},
+                                 {'$inc': {'count': 2, 'sum': 6.5},
+                                  '$min': {'min': 2.0},
+                                  '$max': {'max': 4.5, 'ts': latest}})])
 
-    def test_sth_for_success(self):
-        pass
+    def test_check_retention_for_sanity(self):
+        """
+        Test if retention policies are validated.
+        """
+        self.assertEquals(streaming._check_retention({'max_age': '60',
+                                                      'max_bytes': None},
+                                                     'raw'),
+                          {'max_age': 60})
+        self.assertEquals(streaming._check_retention({'max_bytes': 4096,
+                                                      'max_docs': 10},
+                                                     'raw'),
+                          {'max_bytes': 4096, 'max_docs': 10})
+
+    def test_check_retention_for_failure(self):
+        """
+        Test if invalid retention policies are rejected.
+        """
+        self.assertRaises(AttributeError, streaming._check_retention,
+                          {'foo': 1}, 'raw')
+        self.assertRaises(AttributeError, streaming._check_retention,
+                          {'max_age': 0}, 'raw')
+        self.assertRaises(AttributeError, streaming._check_retention,
+                          {'max_docs': 10}, 'raw')
+        self.assertRaises(AttributeError, streaming._check_retention,
+                          {'max_age': 60, 'max_bytes': 4096}, 'raw')
+        self.assertRaises(AttributeError, streaming._check_retention,
+                          {'max_bytes': 4096}, 'bucket')
+
+    def test_storage_usage_for_sanity(self):
+        """
+        Test if the storage of messages and rollups is summed up.
+        """
+        self.mongo_db.command('collstats', 'data_streams.foo').AndReturn(
+            {'storageSize': 100, 'totalIndexSize': 20, 'count': 5})
+        self.mongo_db.command('collstats',
+                              'data_streams.foo.rollups').AndRaise(
+            errors.OperationFailure('ns not found'))
+
+        self.mocker.ReplayAll()
+        tmp = streaming.storage_usage(self.mongo_db, 'foo')
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, {'size': 120, 'count': 5})
 
 
 class AMQPClientTest(unittest.TestCase):
+    """
+    Test the AMQP client.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.mongo_db = self.mocker.CreateMock(Database)
+        self.mongo_coll = self.mocker.CreateMock(Collection)
+        self.cut = AMQPWrapper(self.mongo_db)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+        self.mocker.UnsetStubs()
+
+    def test_create_for_success(self):
+        """
+        Test if capped collections are set up.
+        """
+        self.mocker.StubOutWithMock(indexes, 'ensure_stream_indexes')
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.insert(mox.Func(
+            lambda doc: doc['retention'] == {'max_bytes': 4096})).AndReturn(
+            'foo')
+        self.mongo_db.create_collection('data_streams.foo', capped=True,
+                                        size=4096, max=None)
+        indexes.ensure_stream_indexes(self.mongo_db, 'foo', None)
+
+        self.mocker.ReplayAll()
+        tmp = self.cut.create('bar', 'token', 'amqp://', 'queue',
+                              retention={'max_bytes': 4096})
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, 'foo')
+
+    def test_create_for_sanity(self):
+        """
+        Test if messages can be stored compressed at rest.
+        """
+        self.mocker.StubOutWithMock(indexes, 'ensure_stream_indexes')
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.insert(mox.IsA(dict)).AndReturn('foo')
+        self.mongo_db.create_collection(
+            'data_streams.foo',
+            storageEngine={'wiredTiger': {
+                'configString': 'block_compressor=zstd'}})
+        indexes.ensure_stream_indexes(self.mongo_db, 'foo', None)
+
+        self.mocker.ReplayAll()
+        self.cut.create('bar', 'token', 'amqp://', 'queue',
+                        compression='zstd')
+        self.mocker.VerifyAll()
+
+    def test_create_for_failure(self):
+        """
+        Test if unknown storage modes & compressors are rejected.
+        """
+        self.assertRaises(AttributeError, self.cut.create, 'bar', 'token',
+                          'amqp://', 'queue', storage='foo')
+        self.assertRaises(AttributeError, self.cut.create, 'bar', 'token',
+                          'amqp://', 'queue', compression='lz4')
+
+    def test_add_trigger_for_failure(self):
+        """
+        Test if invalid triggers are rejected.
+        """
+        self.assertRaises(AttributeError, self.cut.add_trigger, 'bar',
+                          'token', 'a', 'qwe', 'n1', condition='equal',
+                          threshold=1)
+        self.assertRaises(AttributeError, self.cut.add_trigger, 'bar',
+                          'token', 'a', 'qwe', 'n1', condition='above')
+        self.assertRaises(AttributeError, self.cut.add_trigger, 'bar',
+                          'token', 'a', 'qwe', 'n1', max_batch=0)
+
+    def test_info_for_sanity(self):
+        """
+        Test if storage usage is reported per stream.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.count().AndReturn(2)
+        self.mongo_coll.find(fields={'retention': True,
+                                     'ingest': True,
+                                     'usage': True}).AndReturn(
+            [{'_id': 'foo', 'retention': {'max_age': 60},
+              'ingest': {'msgs_per_sec': 12.0, 'lag': 0.5},
+              'usage': {'size': 150, 'count': 5}},
+             {'_id': 'bar'}])
+
+        self.mocker.ReplayAll()
+        tmp = self.cut.info('bar', 'token')
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, {'number_of_streams': 2,
+                                'stream foo': '150 bytes in 5 msgs '
+                                              '(max_age=60)',
+                                'ingest foo': '12.0 msgs/sec, lag 0.5 sec',
+                                'stream bar': 'not measured yet '
+                                              '(unbounded)',
+                                'size_of_streams': 150})
+
+    def test_list_streams_for_success(self):
+        """
+        Test if streams are listed.
+        """
+        self.mongo_db.__getitem__('data_streams').AndReturn(self.mongo_coll)
+        self.mongo_coll.find(fields={'meta': True}).AndReturn(
+            [{'_id': 'foo', 'meta': {}}])
+
+        self.mocker.ReplayAll()
+        tmp = self.cut.list_streams('bar', 'token')
+        self.mocker.VerifyAll()
+        self.assertEquals(tmp, [{'iden': 'foo', 'meta': {}}])
+
+
+class IngestServiceTest(unittest.TestCase):
+    """
+    Test the ingestion service.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.mocker.StubOutWithMock(streaming, 'BrokerConnection')
+        self.mocker.StubOutWithMock(streaming, 'StreamConsumer')
+        self.broker = self.mocker.CreateMockAnything()
+        self.cut = streaming.IngestService('mongodb://localhost')
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.cut.writer.stop()
+        self.mocker.ResetAll()
+        self.mocker.UnsetStubs()
+
+    def test_add_stream_for_success(self):
+        """
+        Test if streams on the same broker share one connection.
+        """
+        streaming.BrokerConnection('amqp://').AndReturn(self.broker)
+        self.broker.start()
+        for iden in ['a', 'b']:
+            consumer = self.mocker.CreateMockAnything()
+            consumer.broker = self.broker
+            streaming.StreamConsumer('bar', 'token', iden,
+                                     'mongodb://localhost', 'queue',
+                                     self.broker, self.cut.writer,
+                                     batch_size=500, flush_interval=1.0,
+                                     storage='raw',
+                                     publisher=None).AndReturn(consumer)
+            self.broker.add(consumer)
+        self.broker.remove(mox.IgnoreArg())
+
+        self.mocker.ReplayAll()
+        self.cut.add_stream('bar', 'token', 'a', 'amqp://', 'queue')
+        self.cut.add_stream('bar', 'token', 'b', 'amqp://', 'queue')
+        # already ingested.
+        self.cut.add_stream('bar', 'token', 'a', 'amqp://', 'queue')
+        self.cut.remove_stream('a')
+        self.mocker.VerifyAll()
+
+        self.assertFalse(self.cut.has_stream('a'))
+        self.assertTrue(self.cut.has_stream('b'))
+
+
+class BrokerConnectionTest(unittest.TestCase):
+    """
+    Test the multiplexed broker connection.
+    """
+
+    mocker = mox.Mox()
 
-    def test_sth_for_success(self):
-        pass
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.cut = streaming.BrokerConnection('amqp://localhost')
+        self.cut.last_stats = time.time()
+        self.channel = self.mocker.CreateMock(
+            blocking_connection.BlockingChannel)
+        self.consumer = ConsumerWrapper(2, self.cut, streaming.Writer())
+        self.consumer.channel = self.channel
+        self.cut.consumers['foo'] = self.consumer
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_process_for_success(self):
+        """
+        Test if acks and rejects are run by the connection's thread.
+        """
+        self.channel.is_open = True
+        self.channel.basic_ack(delivery_tag=2, multiple=True)
+        self.channel.basic_nack(delivery_tag=3, multiple=True, requeue=True)
+
+        self.mocker.ReplayAll()
+        self.cut.ack(self.consumer, self.channel, 2)
+        self.cut.nack(self.consumer, self.channel, 3)
+        # tags of old channels are ignored.
+        self.cut.ack(self.consumer, object(), 4)
+        self.cut.process()
+        self.mocker.VerifyAll()
+
+    def test_connect_for_sanity(self):
+        """
+        Test if channels are reopened and buffers dropped on reconnect.
+        """
+        self.mocker.StubOutWithMock(pika, 'BlockingConnection')
+        conn = self.mocker.CreateMockAnything()
+        pika.BlockingConnection(mox.IgnoreArg()).AndReturn(conn)
+        conn.channel().AndReturn(self.channel)
+        self.channel.queue_declare(queue='queue')
+        self.channel.basic_qos(prefetch_count=4)
+        self.channel.basic_consume(self.consumer.callback, queue='queue')
+        self.consumer.buffer = [{'resv': 1.0, 'body': 'foo'}]
+
+        self.mocker.ReplayAll()
+        self.cut.connect()
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+        self.assertEquals(self.consumer.buffer, [])
+        self.assertEquals(self.consumer.channel, self.channel)
+
+    def test_process_for_failure(self):
+        """
+        Test if a queue failing the passive declare only affects its own
+        stream - its channel is reopened or the stream parked.
+        """
+        self.cut.last_stats = 0
+        self.cut.connection = self.mocker.CreateMockAnything()
+        other = ConsumerWrapper(2, self.cut, self.consumer.writer)
+        other.iden = '000000000000000000000002'
+        other.queue = 'other'
+        other.channel = self.mocker.CreateMock(
+            blocking_connection.BlockingChannel)
+        self.cut.consumers = {self.consumer.iden: self.consumer,
+                              other.iden: other}
+        self.consumer.buffer = [{'resv': 1.0, 'body': 'foo'}]
+        self.consumer.last_flush = time.time()
+        other.last_flush = time.time()
+        closed = pika.exceptions.ChannelClosed(404, 'NOT_FOUND')
+        self.channel.queue_declare(queue='queue', passive=True).AndRaise(
+            closed)
+        self.cut.connection.channel().AndReturn(self.channel)
+        self.channel.queue_declare(queue='queue').AndRaise(closed)
+        tmp = spec.Queue.DeclareOk(message_count=42)
+        other.channel.queue_declare(queue='other', passive=True).AndReturn(
+            FrameWrapper(tmp))
+
+        self.mocker.ReplayAll()
+        self.cut.process()
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.consumers.keys(), [other.iden])
+        self.assertEquals(self.cut.parked.keys(), [self.consumer.iden])
+        self.assertEquals(self.consumer.errors, 2)
+        self.assertEquals(self.consumer.buffer, [])
+        self.assertIn('NOT_FOUND', self.consumer.last_error)
+        self.assertEquals(other.backlog, 42)
+
+        # parked streams are retried.
+        self.mocker.ResetAll()
+        self.cut.last_stats = 0
+        self.cut.connection.channel().AndReturn(self.channel)
+        self.channel.queue_declare(queue='queue')
+        self.channel.basic_qos(prefetch_count=4)
+        self.channel.basic_consume(self.consumer.callback, queue='queue')
+        self.channel.queue_declare(queue='queue', passive=True).AndReturn(
+            FrameWrapper(tmp))
+        other.channel.queue_declare(queue='other', passive=True).AndReturn(
+            FrameWrapper(tmp))
+
+        self.mocker.ReplayAll()
+        self.cut.process()
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.cut.parked, {})
+        self.assertEquals(len(self.cut.consumers), 2)
+
+    def test_stop_for_success(self):
+        """
+        Test if the last batch is stored and acked before the connection
+        is closed.
+        """
+        self.mocker.StubOutWithMock(pika, 'BlockingConnection')
+        conn = self.mocker.CreateMockAnything()
+        pika.BlockingConnection(mox.IgnoreArg()).AndReturn(conn)
+        conn.channel().AndReturn(self.channel)
+        self.channel.queue_declare(queue='queue')
+        self.channel.basic_qos(prefetch_count=4)
+        self.channel.basic_consume(self.consumer.callback, queue='queue')
+        conn.process_data_events(time_limit=0.1).MultipleTimes()
+        self.consumer.collection = self.mocker.CreateMock(Collection)
+        self.consumer.rollups = self.mocker.CreateMock(Collection)
+        self.consumer.streams = self.mocker.CreateMock(Collection)
+        self.consumer.collection.insert(mox.Func(lambda docs: len(docs) == 1))
+        self.consumer.streams.update({'_id': mox.IgnoreArg()}, mox.IsA(dict))
+        self.channel.is_open = True
+        self.channel.basic_ack(delivery_tag=7, multiple=True)
+        conn.is_open = True
+        conn.close()
+
+        self.mocker.ReplayAll()
+        service = streaming.IngestService('mongodb://localhost')
+        service.writer.stop()
+        service.writer = self.consumer.writer
+        service.writer.start()
+        service.brokers['amqp://localhost'] = self.cut
+        self.consumer.channel = None
+        self.cut.start()
+        while self.consumer.channel is None:
+            time.sleep(0.01)
+        self.consumer.buffer = [{'resv': 1.0, 'body': 'foo'}]
+        self.consumer.last_tag = 7
+        self.consumer.last_flush = time.time()
+        service.stop()
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+        self.assertFalse(self.cut.is_alive())
+        self.assertEquals(self.consumer.stored, 1)
+
+    def test_process_for_sanity(self):
+        """
+        Test if due buffers are flushed and the backlog is updated.
+        """
+        self.cut.last_stats = 0
+        self.consumer.buffer = [{'resv': 1.0, 'body': 'foo'}]
+        self.consumer.last_tag = 1
+        tmp = spec.Queue.DeclareOk(message_count=42)
+        self.channel.queue_declare(queue='queue', passive=True).AndReturn(
+            FrameWrapper(tmp))
+
+        self.mocker.ReplayAll()
+        self.cut.process()
+        self.mocker.VerifyAll()
+
+        self.assertEquals(self.consumer.buffer, [])
+        self.assertEquals(self.consumer.writer.batches.qsize(), 1)
+        self.assertEquals(self.consumer.backlog, 42)
 
 
 class StreamConsumerTest(unittest.TestCase):
+    """
+    Test the consumer.
+    """
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.broker = self.mocker.CreateMockAnything()
+        self.writer = streaming.Writer()
+        self.cut = ConsumerWrapper(2, self.broker, self.writer)
+        self.cut.collection = self.mocker.CreateMock(Collection)
+        self.cut.rollups = self.mocker.CreateMock(Collection)
+        self.cut.streams = self.mocker.CreateMock(Collection)
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def _drain(self):
+        """
+        Let the writer store the queued up batches.
+        """
+        while not self.writer.batches.empty():
+            self.writer.write(*self.writer.batches.get())
+
+    def test_callback_for_success(self):
+        """
+        Test if messages are stored in bulk and acked after storing.
+        """
+        self.cut.collection.insert(mox.Func(lambda docs: len(docs) == 2))
+        self.cut.streams.update({'_id': mox.IgnoreArg()}, mox.IsA(dict))
+        self.broker.ack(self.cut, None, 2)
+        self.cut.collection.insert(mox.Func(lambda docs: len(docs) == 1))
+        self.cut.streams.update({'_id': mox.IgnoreArg()}, mox.IsA(dict))
+        self.broker.ack(self.cut, None, 3)
+
+        self.mocker.ReplayAll()
+        for i in range(1, 4):
+            self.cut.callback(None, spec.Basic.Deliver(delivery_tag=i),
+                              spec.BasicProperties(), 'msg' + str(i))
+        self.cut.flush()
+        # nothing to flush.
+        self.cut.flush()
+        self._drain()
+        self.mocker.VerifyAll()
+
+        tmp = self.cut.stats()
+        self.assertEquals(tmp['received'], 3)
+        self.assertEquals(tmp['stored'], 3)
+        self.assertEquals(tmp['lag'], 0.0)
+        self.assertTrue(tmp['msgs_per_sec'] > 0)
+
+    def test_callback_for_sanity(self):
+        """
+        Test if payloads are decoded and batches unpacked.
+        """
+        self.cut.batch_size = 10
+        self.mocker.ReplayAll()
+        props = spec.BasicProperties(content_type='application/json',
+                                     content_encoding='gzip',
+                                     headers={'x-batch': True})
+        buf = StringIO.StringIO()
+        tmp = gzip.GzipFile(fileobj=buf, mode='wb')
+        tmp.write('[1, 2.5, {"a": "b"}]')
+        tmp.close()
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=1), props,
+                          buf.getvalue())
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=2),
+                          spec.BasicProperties(content_type='text/json'),
+                          '{broken')
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=3),
+                          spec.BasicProperties(content_type='text/json'),
+                          '{"cpu.load": 5}')
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=4),
+                          spec.BasicProperties(content_encoding='zstd'),
+                          'foo')
+        self.mocker.VerifyAll()
+
+        self.assertEquals([item['body'] for item in self.cut.buffer][:5],
+                          [1, 2.5, {'a': 'b'}, '{broken', '{"cpu.load": 5}'])
+        self.assertEquals(self.cut.received, 6)
+        self.assertEquals(self.cut.decode_errors, 3)
+        self.assertEquals(self.cut.last_tag, 4)
+
+    def test_fire_for_success(self):
+        """
+        Test if triggers are fired right away & later messages are batched
+        until the debounce time passed.
+        """
+        self.cut.batch_size = 10
+        self.cut.publisher = self.mocker.CreateMock(
+            streaming.TriggerPublisher)
+        doc = {'project': 'qwe', 'ntb_id': 'n1', 'condition': 'above',
+               'threshold': 5.0, 'debounce': 10.0, 'max_batch': 2}
+        self.cut.set_triggers({'t1': doc})
+        self.cut.publisher.publish(
+            'foo', 'bar', 't1', doc,
+            mox.Func(lambda batch: [item['body'] for item in batch] ==
+                     ['7']))
+        self.cut.publisher.publish(
+            'foo', 'bar', 't1', doc,
+            mox.Func(lambda batch: [item['body'] for item in batch] ==
+                     ['9', '10']))
+
+        self.mocker.ReplayAll()
+        for i, body in enumerate(['3', '7', '8', 'a', '9', '10']):
+            self.cut.callback(None, spec.Basic.Deliver(delivery_tag=i),
+                              spec.BasicProperties(), body)
+        # unchanged triggers keep their batch.
+        trigger = self.cut.triggers['t1']
+        self.cut.set_triggers({'t1': dict(doc)})
+        self.assertIs(self.cut.triggers['t1'], trigger)
+        self.cut.fire(time.time())
+        self.cut.fire(time.time() + 10)
+        self.mocker.VerifyAll()
+
+    def test_fire_for_sanity(self):
+        """
+        Test if runs are queued up as calls of the execution node.
+        """
+        cut = streaming.TriggerPublisher('amqp://')
+        doc = {'project': 'qwe', 'ntb_id': 'n1', 'priority': 2}
+        cut.publish('foo', 'bar', 't1', doc, [{'resv': 1.0, 'body': 42}])
+        cut.publish('foo', 'bar', 't1', doc, [{'resv': 1.0,
+                                               'body': '\xff'}])
+
+        uid, body = cut.outgoing.get_nowait()
+        self.assertEquals(uid, 'foo')
+        self.assertEquals(json.loads(body), {'uid': 'foo', 'token': 'bar',
+                                             'project_id': 'qwe',
+                                             'notebook_id': 'n1',
+                                             'priority': 2,
+                                             'trigger': 't1',
+                                             'messages': [{'resv': 1.0,
+                                                           'body': 42}],
+                                             'max_batch': 100,
+                                             'call': 'trigger_run'})
+        # binary messages can't be handed over.
+        self.assertTrue(cut.outgoing.empty())
+        self.assertEquals(cut.dropped, 1)
+
+    def test_store_for_sanity(self):
+        """
+        Test if buckets and rollups are upserted in bulk.
+        """
+        self.cut.storage = 'bucket'
+        self.mocker.StubOutWithMock(streaming, '_bulk_upsert')
+        streaming._bulk_upsert(self.cut.collection,
+                               mox.Func(lambda updates: len(updates) == 1))
+        streaming._bulk_upsert(self.cut.rollups,
+                               mox.Func(lambda updates: len(updates) == 2))
+        self.cut.streams.update(
+            {'_id': mox.IgnoreArg()},
+            {'$push': {'latest': {'$each': [{'time': 1.0, 'body': '42'}],
+                                  '$slice': -streaming.LATEST_SIZE}}})
+
+        self.mocker.ReplayAll()
+        self.cut.store([{'resv': 1.0, 'body': '42'}])
+        self.mocker.VerifyAll()
+        self.mocker.UnsetStubs()
+
+    def test_store_for_failure(self):
+        """
+        Test if messages are rejected when they could not be stored.
+        """
+        self.cut.collection.insert(mox.IsA(list)).AndRaise(IOError('foo'))
+        self.broker.nack(self.cut, None, 1)
+
+        self.mocker.ReplayAll()
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=1),
+                          spec.BasicProperties(), 'foo')
+        self.assertTrue(self.cut.stats()['lag'] >= 0.0)
+        self.cut.flush()
+        self._drain()
+        self.mocker.VerifyAll()
+
+        tmp = self.cut.stats()
+        self.assertEquals(tmp['stored'], 0)
+        self.assertEquals(tmp['errors'], 1)
+        self.assertEquals(tmp['last_error'], 'foo')
+
+    def test_write_for_failure(self):
+        """
+        Test if batches which can never be stored are not redelivered.
+        """
+        self.cut.collection.insert(mox.IsA(list)).AndRaise(
+            errors.InvalidDocument('bad key'))
+        self.broker.reject(self.cut, None, 1)
+
+        self.mocker.ReplayAll()
+        self.cut.callback(None, spec.Basic.Deliver(delivery_tag=1),
+                          spec.BasicProperties(), 'foo')
+        self.cut.flush()
+        self._drain()
+        self.mocker.VerifyAll()
+
+        tmp = self.cut.stats()
+        self.assertEquals(tmp['dropped'], 1)
+        self.assertEquals(tmp['errors'], 1)
+
+
+class FrameWrapper(object):
+    """
+    Wraps a method like pika's frames do.
+    """
+
+    def __init__(self, method):
+        self.method = method
+
+
+class ConsumerWrapper(streaming.StreamConsumer):
+    """
+    Wraps around the StreamConsumer and disables the connections.
+    """
+
+    def __init__(self, batch_size, broker, writer):
+        self.iden = '000000000000000000000001'
+        self.queue = 'queue'
+        self.broker = broker
+        self.writer = writer
+        self.channel = None
+        self.batch_size = batch_size
+        self.flush_interval = 1.0
+        self.storage = 'raw'
+        self.buffer = []
+        self.last_tag = None
+        self.last_flush = 0
+        self.started = time.time() - 10
+        self.inflight = collections.deque()
+        self.history = collections.deque()
+        self.received = 0
+        self.stored = 0
+        self.errors = 0
+        self.dropped = 0
+        self.decode_errors = 0
+        self.last_error = None
+        self.backlog = None
+        self.uid = 'foo'
+        self.token = 'bar'
+        self.publisher = None
+        self.triggers = {}
+
+
+class ClientWrapper(streaming.StreamClient):
+    """
+    Wraps around the StreamClient and hands out a mocked database.
+    """
+
+    def __init__(self, database):
+        self.client = None
+        self.auth_cache = CacheWrapper(database)
+
+
+class AMQPWrapper(streaming.AMQPClient):
+    """
+    Wraps around the AMQPClient and hands out a mocked database.
+    """
+
+    def __init__(self, database):
+        self.client = None
+        self.auth_cache = CacheWrapper(database)
+        self.uri = 'mongodb://localhost'
+
+
+class CacheWrapper(connection.AuthCache):
+    """
+    Hands out the given database without authenticating.
+    """
+
+    def __init__(self, database):
+        super(CacheWrapper, self).__init__()
+        self.mongo_db = database
 
-    def test_sth_for_success(self):
-        pass
\ No newline at end of file
+    def get_database(self, client, uid, token):
+        return self.mongo_db
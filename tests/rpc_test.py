@@ -0,0 +1,127 @@
+# coding=utf-8
+
+"""
+Tests the RPC client.
+"""
+
+__author__ = 'tmetsch'
+
+import json
+import mox
+import threading
+import time
+import unittest
+
+from suricate import rpc
+
+
+class RPCClientTest(unittest.TestCase):
+
+    mocker = mox.Mox()
+
+    def setUp(self):
+        """
+        Setup test.
+        """
+        self.cut = rpc.RPCClient('amqp://localhost', timeout=5)
+        self.cut.channel = self.mocker.CreateMockAnything()
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
+    def test_something_for_success(self):
+        pass
+
+    def test_call_async_for_success(self):
+        """
+        Test if replies are matched to the calls by correlation id.
+        """
+        self.cut.channel.basic_publish(exchange='', routing_key='foo',
+                                       properties=mox.IgnoreArg(),
+                                       body=mox.IgnoreArg()).MultipleTimes()
+        self.mocker.ReplayAll()
+
+        first = self.cut.call_async('foo', {'call': 'list_jobs'})
+        second = self.cut.call_async('foo', {'call': 'list_projects'})
+        self.cut.publish()
+        self.mocker.VerifyAll()
+
+        ids = dict((future, key)
+                   for key, (future, _) in self.cut.pending.items())
+        self.cut.callback(None, None, Frame(correlation_id=ids[second]),
+                          '{"projects": []}')
+        self.assertFalse(first.done())
+        self.assertEquals(second.result(0), {'projects': []})
+        self.cut.callback(None, None, Frame(correlation_id=ids[first]),
+                          '{"jobs": {}}')
+        self.assertEquals(first.result(0), {'jobs': {}})
+        self.assertEquals(self.cut.pending, {})
+
+    def test_call_for_sanity(self):
+        """
+        Test if concurrent callers each get their own reply.
+        """
+        res = {}
+
+        def call(name):
+            res[name] = self.cut.call('foo', {'call': name})
+
+        threads = [threading.Thread(target=call, args=(name,))
+                   for name in ['a', 'b', 'c']]
+        for thread in threads:
+            thread.start()
+        while len(self.cut.pending) < 3:
+            time.sleep(0.01)
+        for _ in range(3):
+            _, body, corr_id = self.cut.outgoing.get()
+            self.cut.callback(None, None, Frame(correlation_id=corr_id),
+                              json.dumps({'name': json.loads(body)['call']}))
+        for thread in threads:
+            thread.join()
+        self.assertEquals(res, {'a': {'name': 'a'}, 'b': {'name': 'b'},
+                                'c': {'name': 'c'}})
+
+    def test_call_for_failure(self):
+        """
+        Test if calls time out, errors are raised & late replies ignored.
+        """
+        self.mocker.ReplayAll()
+        future = self.cut.call_async('foo', {}, timeout=0.01)
+        time.sleep(0.02)
+        self.cut.expire()
+        self.assertRaises(rpc.RPCTimeout, future.result, 0)
+        # timed out calls are not sent & late replies are dropped.
+        self.cut.publish()
+        self.cut.callback(None, None, Frame(correlation_id='x'), '{}')
+
+        future = self.cut.call_async('foo', {})
+        key = self.cut.pending.keys()[0]
+        self.cut.callback(None, None, Frame(correlation_id=key),
+                          '{"error": "boom"}')
+        self.assertRaises(AttributeError, future.result, 0)
+
+        future = self.cut.call_async('foo', {})
+        key = self.cut.pending.keys()[0]
+        self.cut.callback(None, None, Frame(correlation_id=key), '{"x"')
+        self.assertRaises(ValueError, future.result, 0)
+
+        future = self.cut.call_async('foo', {})
+        self.cut.fail(IOError('gone'))
+        self.assertRaises(IOError, future.result, 0)
+
+        # callers never wait longer than the deadline of the call.
+        future = self.cut.call_async('foo', {}, timeout=0.01)
+        self.assertRaises(rpc.RPCTimeout, future.result)
+        self.mocker.VerifyAll()
+
+
+class Frame(object):
+    """
+    Stands in for AMQP properties.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
@@ -8,14 +8,10 @@ __author__ = 'tmetsch'
 
 import unittest
 
-
-class APITest(unittest.TestCase):
-
-    def test_something_for_success(self):
-        pass
+from suricate.ui import api
 
 
-class RPCClientTest(unittest.TestCase):
+class APITest(unittest.TestCase):
 
     def test_something_for_success(self):
         pass
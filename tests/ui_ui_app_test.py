@@ -6,10 +6,73 @@ Tests for the UI app.
 
 __author__ = 'tmetsch'
 
+import mox
 import unittest
 
+from suricate.ui import api
+from suricate.ui import ui_app
+
 
 class AnalyticsAppTest(unittest.TestCase):
 
+    mocker = mox.Mox()
+
+    def tearDown(self):
+        """
+        Reset the mocks.
+        """
+        self.mocker.ResetAll()
+
     def test_something_for_success(self):
         pass
+
+    def test_run_events_for_success(self):
+        """
+        Test if the output of a run is streamed as server-sent events.
+        """
+        the_api = self.mocker.CreateMock(api.API)
+        the_api.retrieve_run('r1', 'foo', 'bar', 0).AndReturn(
+            {'state': 'running', 'out': ['a', 'b'], 'err': ''})
+        the_api.retrieve_run('r1', 'foo', 'bar', 2).AndReturn(
+            {'state': 'done', 'out': ['c'], 'err': 'oops'})
+        self.mocker.ReplayAll()
+
+        ui_app.RUN_POLL = 0
+        res = list(ui_app._run_events(the_api, 'r1', 'foo', 'bar', 60))
+
+        self.mocker.VerifyAll()
+        self.assertEquals(res, ['data: "a"\n\n', 'data: "b"\n\n',
+                                'data: "c"\n\n',
+                                'event: done\ndata: "oops"\n\n'])
+
+    def test_run_events_for_failure(self):
+        """
+        Test if streaming stops for runs which are gone.
+        """
+        the_api = self.mocker.CreateMock(api.API)
+        the_api.retrieve_run('r1', 'foo', 'bar', 0).AndReturn(None)
+        self.mocker.ReplayAll()
+
+        res = list(ui_app._run_events(the_api, 'r1', 'foo', 'bar', 60))
+
+        self.mocker.VerifyAll()
+        self.assertEquals(res, ['event: done\ndata: ""\n\n'])
+
+    def test_run_events_for_sanity(self):
+        """
+        Test if streaming stops for runs without output for too long.
+        """
+        the_api = self.mocker.CreateMock(api.API)
+        the_api.retrieve_run('r1', 'foo', 'bar', 0).AndReturn(
+            {'state': 'running', 'out': ['a'], 'err': ''})
+        the_api.retrieve_run('r1', 'foo', 'bar', 1).AndReturn(
+            {'state': 'running', 'out': [], 'err': ''})
+        self.mocker.ReplayAll()
+
+        ui_app.RUN_POLL = 0.1
+        res = list(ui_app._run_events(the_api, 'r1', 'foo', 'bar', 0.05))
+
+        self.mocker.VerifyAll()
+        self.assertEquals(res[0], 'data: "a"\n\n')
+        self.assertIn('No output for 0.05s', res[1])
+        self.assertEquals(len(res), 2)